@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
-"""Harman HiQnet library."""
+"""Harman HiQnet library.
+
+Only the core modules are imported with the package.
+Import the other subsystems explicitly where they are used, such as ``import hiqnet.crawler``.
+"""
 
 __author__ = 'Raphaël Doursenaud'
 
-__all__ = ['device', 'protocol', 'service']
+__all__ = ['cache', 'crawler', 'datatypes', 'device', 'discovery', 'negotiation', 'percent', 'protocol', 'proxy',
+           'sequence', 'service', 'session', 'shared', 'snapshot', 'store', 'subscription', 'sweep']
 
 import device
 import protocol
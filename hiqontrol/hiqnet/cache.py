@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""HiQnet device tree cache.
+
+A device structure only changes with its firmware.
+Crawled trees are stored on disk, keyed by the device manager class name, serial number and software version.
+A cached tree is used instead of crawling when the remote device reports the same key.
+Trees cached for other software versions of the same device are discarded.
+
+File format
+-----------
+All values are big endian. Records are fixed size so the file can be memory mapped and randomly accessed.
+
+- Header (16 bytes)
+    - Magic (4 bytes): ``HQTC``
+    - Format version (UWORD)
+    - Reserved (UWORD)
+    - Number of nodes (ULONG)
+    - Number of parameters (ULONG)
+- Key: class name, serial number and software version (STRING)
+- Nodes (18 bytes each): virtual devices and objects, parents first
+    - Virtual device address (UBYTE) and object address (24 bits)
+    - Class ID (UWORD)
+    - Attributes offset from the start of the attributes section (ULONG)
+    - Attributes length (UWORD)
+    - First parameter index (ULONG)
+    - Number of parameters (UWORD)
+- Parameters (10 bytes each)
+    - Parameter ID (UWORD)
+    - Data type (UBYTE)
+    - Reserved (UBYTE)
+    - Attributes offset from the start of the attributes section (ULONG)
+    - Attributes length (UWORD)
+- Attributes: for each node and parameter, a number of attributes (UWORD) followed by attribute ID (UWORD),
+  data type (UBYTE) and value triplets.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import binascii
+import hashlib
+import mmap
+import os
+import struct
+
+import datatypes
+import device
+from crawler import apply_parameter_attributes, container, object_level
+
+MAGIC = b'HQTC'
+FORMAT_VERSION = 2
+EXTENSION = '.tree'
+
+HEADER = struct.Struct('!4sHHLL')
+NODE = struct.Struct('!LHLHLH')
+PARAMETER = struct.Struct('!HBxLH')
+
+
+def _text(value):
+    """Normalise a key part to text."""
+    if value is None:
+        return u''
+    if isinstance(value, bytes):
+        return binascii.hexlify(value).decode('ascii')
+    return u'%s' % value
+
+
+def _typed(value):
+    """Guess a data type to store an attribute value."""
+    if isinstance(value, bool):
+        return datatypes.UBYTE
+    if isinstance(value, float):
+        return datatypes.FLOAT64
+    if isinstance(value, bytes):
+        return datatypes.BLOCK
+    if isinstance(value, (int, type(2 ** 64))):
+        return datatypes.ULONG64 if value >= 0 else datatypes.LONG64
+    return datatypes.STRING
+
+
+def _attributes(node):
+    """Encode a node or parameter attributes."""
+    encoded = struct.pack('!H', len(node.attributes))
+    for attribute_id, value in sorted(node.attributes.items()):
+        data_type = _typed(value)
+        encoded += struct.pack('!HB', attribute_id, data_type) + datatypes.pack(data_type, value)
+    return encoded
+
+
+def _read_attributes(data, offset, node):
+    """Decode a node or parameter attributes."""
+    attributes_count = struct.unpack_from('!H', data, offset)[0]
+    offset += 2
+    while attributes_count:
+        attribute_id, data_type = struct.unpack_from('!HB', data, offset)
+        node.attributes[attribute_id], offset = datatypes.unpack_from(data_type, data, offset + 3)
+        attributes_count -= 1
+
+
+def tree_key(manager):
+    """Get the cache key of a device.
+
+    :param manager: The device manager
+    :type manager: hiqnet.device.DeviceManager
+    :return: Class name, serial number and software version
+    :rtype: tuple
+    """
+    return _text(manager.class_name), _text(manager.serial_number), _text(manager.software_version)
+
+
+class TreeCache(object):
+    """On disk device trees."""
+    directory = None
+    hits = 0
+    misses = 0
+
+    def __init__(self, directory):
+        """Build a cache.
+
+        :param directory: Where to store the trees
+        :type directory: str
+        """
+        self.directory = directory
+
+    def _prefix(self, key):
+        return hashlib.sha1((key[0] + u'\x00' + key[1]).encode('utf-8')).hexdigest()[:16]
+
+    def path(self, key):
+        """Get a tree file path.
+
+        :param key: Tree key
+        :type key: tuple
+        :rtype: str
+        """
+        version = hashlib.sha1(key[2].encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.directory, self._prefix(key) + '-' + version + EXTENSION)
+
+    def invalidate(self, key):
+        """Remove the trees of the same device with another software version.
+
+        :param key: Current tree key
+        :type key: tuple
+        """
+        if not os.path.isdir(self.directory):
+            return
+        prefix = self._prefix(key) + '-'
+        current = os.path.basename(self.path(key))
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith(EXTENSION) and name != current:
+                os.remove(os.path.join(self.directory, name))
+
+    def save(self, remote):
+        """Store a device tree.
+
+        :param remote: A crawled device
+        :type remote: hiqnet.device.Device
+        :return: The tree file path
+        :rtype: str
+        """
+        key = tree_key(remote.manager)
+        nodes = b''
+        parameters = b''
+        attributes = b''
+        nodes_count = 0
+        parameters_count = 0
+        pending = [(address, 0, vd) for address, vd in sorted(remote.virtual_devices.items())]
+        while pending:
+            vd_address, object_address, node = pending.pop(0)
+            encoded = _attributes(node)
+            nodes += NODE.pack(vd_address << 24 | object_address, getattr(node, 'class_id', None) or 0,
+                               len(attributes), len(encoded), parameters_count, len(node.parameters))
+            attributes += encoded
+            nodes_count += 1
+            for parameter_id, parameter in sorted(node.parameters.items()):
+                encoded = _attributes(parameter)
+                parameters += PARAMETER.pack(parameter_id, parameter.data_type or 0, len(attributes), len(encoded))
+                attributes += encoded
+                parameters_count += 1
+            pending.extend((vd_address, address, obj) for address, obj in sorted(node.objects.items()))
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, nodes_count, parameters_count) \
+            + b''.join(datatypes.pack_string(part) for part in key)
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.invalidate(key)
+        path = self.path(key)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(header + nodes + parameters + attributes)
+        try:
+            os.rename(temporary, path)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(path)
+            os.rename(temporary, path)
+        return path
+
+    def load(self, remote):
+        """Fill a device tree from the cache.
+
+        The device manager class name, serial number and software version must be known.
+
+        :param remote: The device to fill
+        :type remote: hiqnet.device.Device
+        :return: Whether the tree was found
+        :rtype: bool
+        """
+        key = tree_key(remote.manager)
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.misses += 1
+            self.invalidate(key)
+            return False
+        with f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # Empty file
+                self.misses += 1
+                return False
+            try:
+                found = self._read(data, key, remote)
+            finally:
+                data.close()
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    @staticmethod
+    def _read(data, key, remote):
+        if len(data) < HEADER.size:
+            return False
+        magic, version, _, nodes_count, parameters_count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            return False
+        index = HEADER.size
+        stored_key = []
+        for _ in key:
+            part, index = datatypes.unpack_string_from(data, index)
+            stored_key.append(part)
+        if tuple(stored_key) != key:
+            return False
+        parameters_start = index + nodes_count * NODE.size
+        attributes_start = parameters_start + parameters_count * PARAMETER.size
+
+        for node_index in range(nodes_count):
+            address, class_id, attributes_offset, attributes_length, first_parameter, count = \
+                NODE.unpack_from(data, index + node_index * NODE.size)
+            vd_address = address >> 24
+            object_address = address & 0xffffff
+            if not object_address:
+                node = remote.virtual_devices.get(vd_address)
+                if node is None:
+                    node = remote.virtual_devices[vd_address] = device.VirtualDevice(vd_address, class_id)
+            else:
+                parent = container(remote, vd_address, object_address)
+                node = parent.objects[object_address] = device.Object(object_address)
+
+            _read_attributes(data, attributes_start + attributes_offset, node)
+            if object_level(object_address) or vd_address:
+                node.class_name = node.attributes.get(device.ATTRIBUTE_CLASS_NAME, node.class_name)
+                node.name_string = node.attributes.get(device.ATTRIBUTE_NAME_STRING, node.name_string)
+
+            for parameter_index in range(first_parameter, first_parameter + count):
+                parameter_id, data_type, attributes_offset, attributes_length = \
+                    PARAMETER.unpack_from(data, parameters_start + parameter_index * PARAMETER.size)
+                parameter = node.parameters[parameter_id] = device.Parameter(parameter_id, data_type)
+                _read_attributes(data, attributes_start + attributes_offset, parameter)
+                apply_parameter_attributes(parameter)
+        return True
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""HiQnet device tree crawler.
+
+Discovers a remote device structure at runtime:
+
+1. GETVDLIST lists the virtual devices
+2. GETATTR gets the device manager, virtual devices and objects attributes
+3. Objects are probed with GETATTR at each level of their 24 bits address
+   until enough consecutive addresses are missing
+4. MULTPARMGET lists the objects parameters with their data type and value
+5. GETATTR gets each parameter name, range and control law
+
+Requests are pipelined: up to `window` of them are in flight at any time.
+A request that fails is sent again, up to `retries` times. It is then set aside until the crawl is resumed.
+The work queue survives :py:func:`Crawler.stop` so an interrupted crawl resumes where it left off.
+
+With a :py:class:`hiqnet.cache.TreeCache`, the device manager attributes are requested first.
+If a tree is cached for the same class name, serial number and software version, it is used and the crawl stops there.
+Otherwise the tree is cached once crawled, unless a request timed out or failed.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import collections
+import struct
+import time
+
+from twisted.internet import defer
+from twisted.python import log
+
+import device
+from protocol import Command, FullyQualifiedAddress
+from service.pending import ErrorReply
+
+DEFAULT_WINDOW = 8
+"""Maximum number of requests in flight"""
+
+DEFAULT_PROBE_GAP = 4
+"""Consecutive missing object addresses before giving up on a level"""
+
+DEFAULT_PARAMETERS_BATCH = 32
+"""Parameter IDs asked per MULTPARMGET"""
+
+DEFAULT_RETRIES = 2
+"""Times a failed request is sent again"""
+
+# Work items kinds
+VD_LIST = 0
+MANAGER_ATTRIBUTES = 1
+VD_ATTRIBUTES = 2
+OBJECT_PROBE = 3
+PARAMETERS = 4
+PARAMETER_ATTRIBUTES = 5
+
+
+def object_level(object_address):
+    """Get an object depth from its address.
+
+    :param object_address: 24 bits object address
+    :type object_address: int
+    :return: 0 for the virtual device itself, up to 3
+    :rtype: int
+    """
+    if not object_address:
+        return 0
+    if not object_address & 0xffff:
+        return 1
+    if not object_address & 0xff:
+        return 2
+    return 3
+
+
+def child_address(parent_address, index):
+    """Get the address of a child object.
+
+    :param parent_address: 24 bits parent object address or 0 for the virtual device
+    :type parent_address: int
+    :param index: Child index, 1 to 255
+    :type index: int
+    :rtype: int
+    """
+    return parent_address | index << (8 * (2 - object_level(parent_address)))
+
+
+def apply_parameter_attributes(parameter):
+    """Set a parameter properties from its attributes.
+
+    :param parameter: A parameter with its attributes
+    :type parameter: hiqnet.device.Parameter
+    """
+    attributes = parameter.attributes
+    if parameter.data_type is None:
+        parameter.data_type = attributes.get(device.PARAMETER_ATTRIBUTE_DATA_TYPE)
+    parameter.name_string = attributes.get(device.PARAMETER_ATTRIBUTE_NAME_STRING, parameter.name_string)
+    parameter.minimum_value = attributes.get(device.PARAMETER_ATTRIBUTE_MINIMUM_VALUE, parameter.minimum_value)
+    parameter.maximum_value = attributes.get(device.PARAMETER_ATTRIBUTE_MAXIMUM_VALUE, parameter.maximum_value)
+    parameter.control_law = attributes.get(device.PARAMETER_ATTRIBUTE_CONTROL_LAW, parameter.control_law)
+
+
+def container(remote, vd_address, object_address):
+    """Get the virtual device or object containing an object.
+
+    :param remote: The device
+    :type remote: hiqnet.device.Device
+    :param vd_address: Virtual device address
+    :type vd_address: int
+    :param object_address: 24 bits object address
+    :type object_address: int
+    :rtype: hiqnet.device.VirtualDevice or hiqnet.device.Object
+    """
+    node = remote.virtual_devices[vd_address]
+    level = object_level(object_address)
+    if level > 1:
+        node = node.objects[object_address & 0xff0000]
+    if level > 2:
+        node = node.objects[object_address & 0xffff00]
+    return node
+
+
+class Crawler(object):
+    """Fills a device tree from a remote device."""
+    device = None
+    """:type: hiqnet.device.Device"""
+    ip_address = None
+    requests = None
+    """:type: hiqnet.service.pending.PendingRequests"""
+    window = DEFAULT_WINDOW
+    probe_gap = DEFAULT_PROBE_GAP
+    parameters_batch = DEFAULT_PARAMETERS_BATCH
+    retries = DEFAULT_RETRIES
+    progress = None
+    """Called with the crawler after each reply or timeout"""
+    cache = None
+    """:type: hiqnet.cache.TreeCache"""
+    cached = False
+    """Whether the tree came from the cache"""
+    pending = None
+    """Work items not sent yet"""
+    abandoned = None
+    """Work items that failed `retries` times, sent again on resume"""
+    in_flight = 0
+    completed = 0
+    """Requests answered"""
+    timeouts = 0
+    """Requests that timed out, object probes excluded"""
+    errors = 0
+    """Requests that failed otherwise, and replies that couldn't be applied"""
+    misses = 0
+    """Object probes that found nothing"""
+    running = False
+    _elapsed = 0.0
+    _probes = None
+    _attempts = None
+    """Failures by work item"""
+    _started = None
+    _done = None
+    _source = None
+
+    def __init__(self, source, remote, ip_address, requests,
+                 window=DEFAULT_WINDOW, probe_gap=DEFAULT_PROBE_GAP,
+                 parameters_batch=DEFAULT_PARAMETERS_BATCH, progress=None, cache=None, retries=DEFAULT_RETRIES):
+        """Build a crawler.
+
+        :param source: The local device
+        :type source: hiqnet.device.Device
+        :param remote: The remote device to fill
+        :type remote: hiqnet.device.Device
+        :param ip_address: Remote device IPv4 address
+        :type ip_address: str
+        :param requests: Pending requests tracker
+        :type requests: hiqnet.service.pending.PendingRequests
+        :param window: Maximum number of requests in flight
+        :type window: int
+        :param probe_gap: Consecutive missing object addresses before giving up on a level
+        :type probe_gap: int
+        :param parameters_batch: Parameter IDs asked per MULTPARMGET
+        :type parameters_batch: int
+        :param progress: Called with the crawler after each reply or timeout
+        :type progress: callable
+        :param cache: Where to look for and store the tree
+        :type cache: hiqnet.cache.TreeCache
+        :param retries: Times a failed request is sent again
+        :type retries: int
+        """
+        self._source = source
+        self.device = remote
+        self.ip_address = ip_address
+        self.requests = requests
+        self.window = window
+        self.probe_gap = probe_gap
+        self.parameters_batch = parameters_batch
+        self.progress = progress
+        self.cache = cache
+        self.retries = retries
+        if cache is None:
+            self.pending = collections.deque([(VD_LIST, 0, 0, 0), (MANAGER_ATTRIBUTES, 0, 0, 0)])
+        else:
+            # The tree is only crawled if it's not cached
+            self.pending = collections.deque([(MANAGER_ATTRIBUTES, 0, 0, 0)])
+        self._probes = {}
+        self._attempts = {}
+        self.abandoned = []
+
+    @property
+    def elapsed(self):
+        """Time spent crawling, excluding pauses.
+
+        :rtype: float
+        """
+        if self.running:
+            return self._elapsed + time.time() - self._started
+        return self._elapsed
+
+    @property
+    def finished(self):
+        """Whether the whole tree has been crawled.
+
+        :rtype: bool
+        """
+        return not self.pending and not self.in_flight and not self.abandoned
+
+    def crawl(self):
+        """Start or resume crawling.
+
+        :return: Fires with the device when the crawl is finished or stopped
+        :rtype: defer.Deferred
+        """
+        if self._done is None:
+            self._done = defer.Deferred()
+        done = self._done
+        if not self.running:
+            self.running = True
+            self._started = time.time()
+            # Give the failed requests another chance
+            for item in self.abandoned:
+                self._attempts.pop(item, None)
+            self.pending.extend(self.abandoned)
+            self.abandoned = []
+            self._pump()
+        return done
+
+    def stop(self):
+        """Pause crawling.
+
+        Requests in flight are still processed. Call :py:func:`crawl` to resume.
+        """
+        if self.running:
+            self._elapsed = self.elapsed
+            self.running = False
+        if not self.in_flight:
+            self._finish()
+
+    def _finish(self):
+        if self.running:
+            self._elapsed = self.elapsed
+            self.running = False
+        if self.cache is not None and self.finished and not self.cached and not self.timeouts and not self.errors:
+            # A partial tree would be loaded instead of crawled from now on
+            self.cache.save(self.device)
+        done, self._done = self._done, None
+        if done is not None:
+            done.callback(self.device)
+
+    def _pump(self):
+        while self.running and self.pending and self.in_flight < self.window:
+            item = self.pending.popleft()
+            self.in_flight += 1
+            d = self._send(item)
+            d.addCallbacks(self._received, self._failed, callbackArgs=(item,), errbackArgs=(item,))
+            d.addErrback(self._crashed, item)
+            d.addBoth(self._next)
+        if not self.in_flight and (not self.pending or not self.running):
+            self._finish()
+
+    def _send(self, item):
+        kind, vd_address, object_address, first = item
+        destination = FullyQualifiedAddress(device_address=self.device.hiqnet_address,
+                                            vd_address=struct.pack('!B', vd_address),
+                                            object_address=struct.pack('!L', object_address)[1:])
+        command = Command(source=self._source.address, destination=destination)
+        if kind == VD_LIST:
+            command.get_vd_list()
+        elif kind == MANAGER_ATTRIBUTES:
+            command.get_attributes(device.DEVICE_MANAGER_ATTRIBUTES)
+        elif kind in (VD_ATTRIBUTES, OBJECT_PROBE):
+            command.get_attributes(device.OBJECT_ATTRIBUTES)
+        elif kind == PARAMETERS:
+            command.multi_param_get(list(range(first, first + self.parameters_batch)))
+        else:
+            command.get_parameter_attributes(first, device.PARAMETER_ATTRIBUTES)
+        return self.requests.request(command, self.ip_address)
+
+    def _next(self, _):
+        self.in_flight -= 1
+        if self.progress is not None:
+            self.progress(self)
+        self._pump()
+
+    def _received(self, reply, item):
+        kind, vd_address, object_address, first = item
+        if kind == VD_LIST:
+            for address, class_id in reply.virtual_devices:
+                if address not in self.device.virtual_devices:
+                    self.device.virtual_devices[address] = device.VirtualDevice(address, class_id)
+                if address != self.device.manager.address:
+                    self.pending.append((VD_ATTRIBUTES, address, 0, 0))
+        elif kind == MANAGER_ATTRIBUTES:
+            manager = self.device.manager
+            self._apply_attributes(manager, reply)
+            manager.serial_number = manager.attributes.get(device.ATTRIBUTE_SERIAL_NUMBER, manager.serial_number)
+            manager.software_version = manager.attributes.get(device.ATTRIBUTE_SOFTWARE_VERSION,
+                                                              manager.software_version)
+            if self.cache is not None:
+                if self.cache.load(self.device):
+                    self.cached = True
+                    self.pending.clear()
+                else:
+                    self.pending.append((VD_LIST, 0, 0, 0))
+        elif kind == VD_ATTRIBUTES:
+            self._apply_attributes(self.device.virtual_devices[vd_address], reply)
+            self._probe_children(vd_address, 0)
+        elif kind == OBJECT_PROBE:
+            parent = container(self.device, vd_address, object_address)
+            obj = parent.objects.get(object_address)
+            if obj is None:
+                obj = parent.objects[object_address] = device.Object(object_address)
+            self._apply_attributes(obj, reply)
+            self._probe_found(vd_address, object_address)
+            self.pending.append((PARAMETERS, vd_address, object_address, 0))
+            if object_level(object_address) < 3:
+                self._probe_children(vd_address, object_address)
+        elif kind == PARAMETERS:
+            obj = container(self.device, vd_address, object_address).objects[object_address]
+            for parameter_id, data_type, value in reply.parameters:
+                parameter = obj.parameters.get(parameter_id)
+                if parameter is None:
+                    parameter = obj.parameters[parameter_id] = device.Parameter(parameter_id, data_type)
+                    self.pending.append((PARAMETER_ATTRIBUTES, vd_address, object_address, parameter_id))
+                parameter.value = value
+            last = first + self.parameters_batch - 1
+            if last in obj.parameters and last < 0xffff:
+                self.pending.append((PARAMETERS, vd_address, object_address, last + 1))
+        else:
+            parameter = container(self.device, vd_address, object_address).objects[object_address].parameters[first]
+            for attribute_id, data_type, value in reply.attributes:
+                parameter.attributes[attribute_id] = value
+            apply_parameter_attributes(parameter)
+        self.completed += 1
+
+    def _failed(self, failure, item):
+        kind, vd_address, object_address, first = item
+        timeout = failure.check(defer.TimeoutError)
+        if kind == OBJECT_PROBE and not timeout and failure.check(ErrorReply):
+            # No object at this address
+            self.misses += 1
+            self._probe_missed(vd_address, object_address)
+            return
+        if kind != OBJECT_PROBE:
+            if timeout:
+                self.timeouts += 1
+            else:
+                self.errors += 1
+        attempts = self._attempts.get(item, 0) + 1
+        if attempts <= self.retries:
+            self._attempts[item] = attempts
+            self.pending.append(item)
+            return
+        self._attempts.pop(item, None)
+        if kind == OBJECT_PROBE:
+            # Some devices don't answer for missing objects
+            self.misses += 1
+            self._probe_missed(vd_address, object_address)
+        elif kind == MANAGER_ATTRIBUTES and self.cache is not None:
+            # Can't tell if the tree is cached
+            self.pending.append((VD_LIST, 0, 0, 0))
+        else:
+            self.abandoned.append(item)
+
+    def _crashed(self, failure, item):
+        """Count and report the exceptions raised while handling a reply, the item is set aside."""
+        self.errors += 1
+        self.abandoned.append(item)
+        log.err(failure, "Crawler failed handling %r" % (item,))
+
+    @staticmethod
+    def _apply_attributes(node, reply):
+        for attribute_id, data_type, value in reply.attributes:
+            node.attributes[attribute_id] = value
+        node.class_name = node.attributes.get(device.ATTRIBUTE_CLASS_NAME, node.class_name)
+        node.name_string = node.attributes.get(device.ATTRIBUTE_NAME_STRING, node.name_string)
+
+    def _probe_children(self, vd_address, parent_address):
+        """Start probing the children of a virtual device or object."""
+        # [highest index found, highest index probed, answers pending]
+        self._probes[(vd_address, parent_address)] = [0, 0, 0]
+        self._extend_probe(vd_address, parent_address)
+
+    def _extend_probe(self, vd_address, parent_address):
+        probe = self._probes[(vd_address, parent_address)]
+        limit = min(probe[0] + self.probe_gap, 255)
+        while probe[1] < limit:
+            probe[1] += 1
+            probe[2] += 1
+            self.pending.append((OBJECT_PROBE, vd_address, child_address(parent_address, probe[1]), 0))
+
+    def _probe_key(self, vd_address, object_address):
+        level = object_level(object_address)
+        shift = 8 * (3 - level)
+        parent_address = object_address >> (shift + 8) << (shift + 8)
+        return (vd_address, parent_address), object_address >> shift & 0xff
+
+    def _probe_found(self, vd_address, object_address):
+        key, index = self._probe_key(vd_address, object_address)
+        probe = self._probes[key]
+        probe[2] -= 1
+        if index > probe[0]:
+            probe[0] = index
+        self._extend_probe(*key)
+
+    def _probe_missed(self, vd_address, object_address):
+        key, index = self._probe_key(vd_address, object_address)
+        probe = self._probes[key]
+        probe[2] -= 1
+        if not probe[2]:
+            del self._probes[key]
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""HiQnet data types.
+
+Parameters and attributes values are transmitted prefixed by their data type identifier.
+
++----+----------+------------------------------------------------+
+| ID | Name     | Encoding                                       |
++====+==========+================================================+
+| 0  | BYTE     | 8 bits signed                                  |
++----+----------+------------------------------------------------+
+| 1  | UBYTE    | 8 bits unsigned                                |
++----+----------+------------------------------------------------+
+| 2  | WORD     | 16 bits signed                                 |
++----+----------+------------------------------------------------+
+| 3  | UWORD    | 16 bits unsigned                               |
++----+----------+------------------------------------------------+
+| 4  | LONG     | 32 bits signed                                 |
++----+----------+------------------------------------------------+
+| 5  | ULONG    | 32 bits unsigned                               |
++----+----------+------------------------------------------------+
+| 6  | FLOAT32  | IEEE 754 single precision                      |
++----+----------+------------------------------------------------+
+| 7  | FLOAT64  | IEEE 754 double precision                      |
++----+----------+------------------------------------------------+
+| 8  | BLOCK    | UWORD length followed by raw bytes             |
++----+----------+------------------------------------------------+
+| 9  | STRING   | UWORD length followed by null terminated UCS-2 |
++----+----------+------------------------------------------------+
+| 10 | LONG64   | 64 bits signed                                 |
++----+----------+------------------------------------------------+
+| 11 | ULONG64  | 64 bits unsigned                               |
++----+----------+------------------------------------------------+
+
+All values are big endian (network order).
+"""
+
+__author__ = 'Raphaël Doursenaud'
+
+import struct
+
+BYTE = 0
+UBYTE = 1
+WORD = 2
+UWORD = 3
+LONG = 4
+ULONG = 5
+FLOAT32 = 6
+FLOAT64 = 7
+BLOCK = 8
+STRING = 9
+LONG64 = 10
+ULONG64 = 11
+
+NAMES = {
+    BYTE: 'BYTE',
+    UBYTE: 'UBYTE',
+    WORD: 'WORD',
+    UWORD: 'UWORD',
+    LONG: 'LONG',
+    ULONG: 'ULONG',
+    FLOAT32: 'FLOAT32',
+    FLOAT64: 'FLOAT64',
+    BLOCK: 'BLOCK',
+    STRING: 'STRING',
+    LONG64: 'LONG64',
+    ULONG64: 'ULONG64',
+}
+
+STRUCTS = {
+    BYTE: struct.Struct('!b'),
+    UBYTE: struct.Struct('!B'),
+    WORD: struct.Struct('!h'),
+    UWORD: struct.Struct('!H'),
+    LONG: struct.Struct('!l'),
+    ULONG: struct.Struct('!L'),
+    FLOAT32: struct.Struct('!f'),
+    FLOAT64: struct.Struct('!d'),
+    LONG64: struct.Struct('!q'),
+    ULONG64: struct.Struct('!Q'),
+}
+"""Precompiled structures for the fixed size data types."""
+
+FLOATS = (FLOAT32, FLOAT64)
+
+_UWORD = STRUCTS[UWORD]
+
+
+def is_numeric(data_type):
+    """Tell if a data type holds a number.
+
+    :param data_type: Data type identifier
+    :type data_type: int
+    :rtype: bool
+    """
+    return data_type in STRUCTS
+
+
+def pack(data_type, value):
+    """Encode a value.
+
+    :param data_type: Data type identifier
+    :type data_type: int
+    :param value: The value to encode
+    :return: The encoded value, without the data type identifier
+    :rtype: bytes
+    """
+    if data_type == STRING:
+        return pack_string(value)
+    if data_type == BLOCK:
+        return pack_block(value)
+    if data_type not in FLOATS:
+        # Integers may come from an array of doubles
+        value = int(value)
+    try:
+        return STRUCTS[data_type].pack(value)
+    except KeyError:
+        raise ValueError("Unknown data type: " + str(data_type))
+
+
+def unpack_from(data_type, data, index=0):
+    """Decode a value.
+
+    :param data_type: Data type identifier
+    :type data_type: int
+    :param data: Binary data to decode from
+    :type data: bytes
+    :param index: Where the value starts
+    :type index: int
+    :return: The decoded value and the index following it
+    :rtype: tuple
+    """
+    if data_type == STRING:
+        return unpack_string_from(data, index)
+    if data_type == BLOCK:
+        return unpack_block_from(data, index)
+    try:
+        s = STRUCTS[data_type]
+    except KeyError:
+        raise ValueError("Unknown data type: " + str(data_type))
+    return s.unpack_from(data, index)[0], index + s.size
+
+
+def pack_block(value):
+    """Encode a BLOCK.
+
+    :param value: Raw data
+    :type value: bytes
+    :rtype: bytes
+    """
+    return _UWORD.pack(len(value)) + bytes(value)
+
+
+def unpack_block_from(data, index=0):
+    """Decode a BLOCK.
+
+    :param data: Binary data to decode from
+    :type data: bytes
+    :param index: Where the block starts
+    :type index: int
+    :return: The block content and the index following it
+    :rtype: tuple
+    """
+    size = _UWORD.unpack_from(data, index)[0]
+    index += _UWORD.size
+    return data[index:index + size], index + size
+
+
+def pack_string(value):
+    """Encode a STRING.
+
+    :param value: The string
+    :type value: unicode
+    :rtype: bytes
+    """
+    encoded = (value + u'\x00').encode('utf-16-be')  # UCS-2
+    return _UWORD.pack(len(encoded)) + encoded
+
+
+def unpack_string_from(data, index=0):
+    """Decode a STRING.
+
+    :param data: Binary data to decode from
+    :type data: bytes
+    :param index: Where the string starts
+    :type index: int
+    :return: The string and the index following it
+    :rtype: tuple
+    """
+    encoded, index = unpack_block_from(data, index)
+    return encoded.decode('utf-16-be').rstrip(u'\x00'), index
@@ -29,18 +29,51 @@ import random
 def negotiate_address():
     """Generates a random HiQnet address.
 
-    The address is automatically checked on the network.
+    The address is not checked on the network,
+    use :class:`hiqnet.negotiation.AddressNegotiator` once the network is up.
     """
     requested_address = random.randrange(1, 65534)
-    # connection = Connection()
-    # message = Command(source=FullyQualifiedAddress(device_address=0),
-    #                          destination=FullyQualifiedAddress.broadcast_address())
-    # message.request_address(self, requested_address)
-    # connection.sendto('<broadcast>')
-    # FIXME: look for address_used reply messages and renegotiate if found
     return requested_address
 
 
+# Attribute IDs
+ATTRIBUTE_CLASS_NAME = 0
+ATTRIBUTE_NAME_STRING = 1
+ATTRIBUTE_FLAGS = 2
+ATTRIBUTE_SERIAL_NUMBER = 3
+ATTRIBUTE_SOFTWARE_VERSION = 4
+
+DEVICE_MANAGER_ATTRIBUTES = [
+    ATTRIBUTE_CLASS_NAME,
+    ATTRIBUTE_NAME_STRING,
+    ATTRIBUTE_FLAGS,
+    ATTRIBUTE_SERIAL_NUMBER,
+    ATTRIBUTE_SOFTWARE_VERSION,
+]
+VIRTUAL_DEVICE_ATTRIBUTES = [
+    ATTRIBUTE_CLASS_NAME,
+    ATTRIBUTE_NAME_STRING,
+]
+OBJECT_ATTRIBUTES = VIRTUAL_DEVICE_ATTRIBUTES
+
+# Parameter attribute IDs
+PARAMETER_ATTRIBUTE_DATA_TYPE = 0
+PARAMETER_ATTRIBUTE_NAME_STRING = 1
+PARAMETER_ATTRIBUTE_MINIMUM_VALUE = 2
+PARAMETER_ATTRIBUTE_MAXIMUM_VALUE = 3
+PARAMETER_ATTRIBUTE_CONTROL_LAW = 4
+PARAMETER_ATTRIBUTE_FLAGS = 5
+
+PARAMETER_ATTRIBUTES = [
+    PARAMETER_ATTRIBUTE_DATA_TYPE,
+    PARAMETER_ATTRIBUTE_NAME_STRING,
+    PARAMETER_ATTRIBUTE_MINIMUM_VALUE,
+    PARAMETER_ATTRIBUTE_MAXIMUM_VALUE,
+    PARAMETER_ATTRIBUTE_CONTROL_LAW,
+    PARAMETER_ATTRIBUTE_FLAGS,
+]
+
+
 class Attribute(object):
     """Member variables of the HiQnet architecture.
 
@@ -76,6 +109,30 @@ class Object(object):
     May contain other objects or parameters.
     """
     _address = None  # 24 bits
+    class_name = None
+    name_string = None
+    objects = None
+    parameters = None
+    attributes = None
+
+    def __init__(self, address):
+        """Build an object.
+
+        :param address: Object address
+        :type address: int
+        """
+        self._address = address
+        self.objects = {}
+        self.parameters = {}
+        self.attributes = {}
+
+    @property
+    def address(self):
+        """Get the object address.
+
+        :rtype: int
+        """
+        return self._address
 
 
 class Parameter(Object):
@@ -90,6 +147,28 @@ class Parameter(Object):
     maximum_value = None  # Depends on data_type
     control_law = None
     flags = ParameterFlags()
+    value = None  # Instance+Dynamic, last known value
+
+    # noinspection PyMissingConstructor
+    def __init__(self, index, data_type=None):
+        """Build a parameter.
+
+        :param index: Parameter ID
+        :type index: int
+        :param data_type: Parameter data type
+        :type data_type: int
+        """
+        self._index = index
+        self.data_type = data_type
+        self.attributes = {}
+
+    @property
+    def index(self):
+        """Get the parameter ID.
+
+        :rtype: int
+        """
+        return self._index
 
 
 class VirtualDevice(object):
@@ -98,12 +177,35 @@ class VirtualDevice(object):
     This is the basic container object type.
     """
     _address = None  # 8 bits
+    class_id = None
     class_name = Attribute('Static')
     name_string = Attribute('Instance+Dynamic')
     objects = None
     parameters = None
     attributes = None
 
+    def __init__(self, address, class_id=None):
+        """Build a virtual device.
+
+        :param address: Virtual device address
+        :type address: int
+        :param class_id: Virtual device class ID
+        :type class_id: int
+        """
+        self._address = address
+        self.class_id = class_id
+        self.objects = {}
+        self.parameters = {}
+        self.attributes = {}
+
+    @property
+    def address(self):
+        """Get the virtual device address.
+
+        :rtype: int
+        """
+        return self._address
+
 
 class DeviceManager(VirtualDevice):
     """Describes a HiQnet device manager.
@@ -131,6 +233,9 @@ class DeviceManager(VirtualDevice):
         :type serial_number:
         :type software_version: str
         """
+        self.objects = {}
+        self.parameters = {}
+        self.attributes = {}
         if not class_name:
             class_name = name_string
         self.class_name = class_name
@@ -150,18 +255,23 @@ class Device(object):
     manager = None
     virtual_devices = None
 
-    def __init__(self, name, hiqnet_address=negotiate_address(), network_info=IPNetworkInfo.autodetect()):
+    def __init__(self, name, hiqnet_address=None, network_info=None):
         """Build a device.
 
         :param name: Name of the device
         :type name: str
-        :param hiqnet_address: Address of the device
+        :param hiqnet_address: Address of the device. Random if not provided.
         :type hiqnet_address: int
-        :param network_info: Device's network informations
+        :param network_info: Device's network informations. Autodetected if not provided.
         :type network_info: NetworkInfo
         """
         self.manager = DeviceManager(name)
+        self.virtual_devices = {self.manager.address: self.manager}
+        if hiqnet_address is None:
+            hiqnet_address = negotiate_address()
         self.hiqnet_address = hiqnet_address
+        if network_info is None:
+            network_info = IPNetworkInfo.autodetect()
         self.network_info = network_info
 
     @property
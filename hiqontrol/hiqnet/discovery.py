@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""HiQnet discovered devices registry.
+
+Devices are learned from the DISCOINFO commands they send and indexed by HiQnet address,
+serial number and IP address. Entries are updated in place.
+
+A device we haven't heard from during a multiple of its own keep alive period is removed.
+All expiries share a single heap and a single timer, whatever the number of devices:
+each device has one heap entry which is pushed back when the device was heard of since.
+
+Listeners are told about added, changed and removed devices.
+
+The discovery scheduler broadcasts DISCOINFO queries often at startup and when devices come and go,
+then backs off exponentially up to a ceiling so idle networks aren't flooded by clients.
+Queries from other devices are answered with a pre-encoded DISCOINFO information,
+only the destination and sequence number are patched for each reply.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import heapq
+import itertools
+import random
+import struct
+
+from networkinfo import IPNetworkInfo
+from protocol import Command, FullyQualifiedAddress, DEFAULT_KEEPALIVE
+
+DEFAULT_TTL_FACTOR = 3
+"""Missed keep alive periods before a device is removed"""
+
+DEFAULT_FAST_INTERVAL = 1.0  # s
+DEFAULT_MAX_INTERVAL = 60.0  # s
+DEFAULT_BACKOFF_FACTOR = 2
+DEFAULT_JITTER = 0.1
+"""Random part of the intervals, so clients started together don't broadcast together"""
+
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+
+
+class DiscoveredDevice(object):
+    """A remote device."""
+    device_address = None
+    serial_number = None
+    """:type: bytes"""
+    ip_address = None
+    cost = None
+    max_message_size = None
+    keepalive = DEFAULT_KEEPALIVE
+    """Keep alive period in ms"""
+    network_info = None
+    """:type: hiqnet.networkinfo.NetworkInfo"""
+    last_seen = None
+    expires = None
+
+    def __init__(self, device_address):
+        """Build a discovered device.
+
+        :param device_address: HiQnet address
+        :type device_address: int
+        """
+        self.device_address = device_address
+
+    @property
+    def name(self):
+        """Printable name.
+
+        :rtype: str
+        """
+        return self.serial_number.rstrip(b'\x00').decode('ascii', 'replace') or str(self.device_address)
+
+
+class DiscoveryRegistry(object):
+    """Discovered devices."""
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    ttl_factor = DEFAULT_TTL_FACTOR
+    devices = None
+    """:type: dict of DiscoveredDevice by HiQnet address"""
+    by_serial = None
+    """:type: dict of DiscoveredDevice by serial number"""
+    by_ip = None
+    """:type: dict of DiscoveredDevice by IPv4 address"""
+    _listeners = None
+    _heap = None
+    _order = None
+    _timer = None
+
+    def __init__(self, ttl_factor=DEFAULT_TTL_FACTOR, clock=None):
+        """Build a registry.
+
+        :param ttl_factor: Missed keep alive periods before a device is removed
+        :type ttl_factor: int
+        :param clock: Scheduler. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self.ttl_factor = ttl_factor
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.devices = {}
+        self.by_serial = {}
+        self.by_ip = {}
+        self._listeners = []
+        self._heap = []
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(list(self.devices.values()))
+
+    def __contains__(self, device_address):
+        return device_address in self.devices
+
+    def get(self, device_address):
+        """Get a device by HiQnet address.
+
+        :param device_address: HiQnet address
+        :type device_address: int
+        :rtype: DiscoveredDevice
+        """
+        return self.devices.get(device_address)
+
+    def add_listener(self, callback):
+        """Be told about devices changes.
+
+        :param callback: Called with the event (ADDED, CHANGED or REMOVED) and the device
+        :type callback: callable
+        """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        """Stop being told about devices changes.
+
+        :param callback: A registered callback
+        :type callback: callable
+        """
+        self._listeners.remove(callback)
+
+    def _notify(self, event, device):
+        for callback in self._listeners:
+            callback(event, device)
+
+    def handle_command(self, command, ip_address=None):
+        """Learn from DISCOINFO commands.
+
+        Both queries and informations carry the sender information.
+
+        :param command: A received command
+        :type command: hiqnet.protocol.Command
+        :param ip_address: Sender IPv4 address
+        :type ip_address: str
+        :return: Whether the command was a DISCOINFO
+        :rtype: bool
+        """
+        if command.message.name != 'DISCOINFO' or command.discovery is None:
+            return False
+        self.update(command.discovery, ip_address)
+        return True
+
+    def update(self, info, ip_address=None):
+        """Add or update a device.
+
+        :param info: Decoded DISCOINFO
+        :type info: hiqnet.protocol.DiscoveryInfo
+        :param ip_address: Sender IPv4 address, used when the info has no IP network information
+        :type ip_address: str
+        :rtype: DiscoveredDevice
+        """
+        if isinstance(info.network_info, IPNetworkInfo):
+            ip_address = info.network_info.ip_address
+        keepalive = info.keepalive or DEFAULT_KEEPALIVE
+        device = self.devices.get(info.device_address)
+        if device is None:
+            device = self.by_serial.get(info.serial_number)
+            if device is not None:
+                # The device negotiated a new address
+                del self.devices[device.device_address]
+                device.device_address = info.device_address
+                self.devices[device.device_address] = device
+                event = CHANGED
+            else:
+                device = self.devices[info.device_address] = DiscoveredDevice(info.device_address)
+                event = ADDED
+        else:
+            event = None
+        if event is None and (device.serial_number != info.serial_number
+                              or device.ip_address != ip_address
+                              or device.cost != info.cost
+                              or device.max_message_size != info.max_message_size
+                              or device.keepalive != keepalive):
+            event = CHANGED
+        self._index(self.by_serial, device, device.serial_number, info.serial_number)
+        self._index(self.by_ip, device, device.ip_address, ip_address)
+        device.serial_number = info.serial_number
+        device.ip_address = ip_address
+        device.cost = info.cost
+        device.max_message_size = info.max_message_size
+        device.keepalive = keepalive
+        device.network_info = info.network_info
+        device.last_seen = self.clock.seconds()
+        expires = device.last_seen + device.keepalive * self.ttl_factor / 1000.0
+        if device.expires is None:
+            device.expires = expires
+            self._push(device)
+        else:
+            # The heap entry is pushed back when it comes up
+            device.expires = expires
+        if event is not None:
+            self._notify(event, device)
+        return device
+
+    @staticmethod
+    def _index(index, device, old, new):
+        if old != new and index.get(old) is device:
+            del index[old]
+        if new is not None:
+            index[new] = device
+
+    def remove(self, device_address):
+        """Forget a device.
+
+        :param device_address: HiQnet address
+        :type device_address: int
+        """
+        device = self.devices.pop(device_address, None)
+        if device is None:
+            return
+        if self.by_serial.get(device.serial_number) is device:
+            del self.by_serial[device.serial_number]
+        if self.by_ip.get(device.ip_address) is device:
+            del self.by_ip[device.ip_address]
+        device.expires = None
+        self._notify(REMOVED, device)
+
+    def _push(self, device):
+        heapq.heappush(self._heap, (device.expires, next(self._order), device))
+        if self._heap[0][2] is device:
+            self._schedule()
+
+    def _schedule(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if self._heap:
+            delay = max(self._heap[0][0] - self.clock.seconds(), 0)
+            self._timer = self.clock.callLater(delay, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        now = self.clock.seconds()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, _, device = heapq.heappop(heap)
+            if device.expires is None or self.devices.get(device.device_address) is not device:
+                # Removed
+                continue
+            if device.expires > now:
+                heapq.heappush(heap, (device.expires, next(self._order), device))
+                continue
+            self.remove(device.device_address)
+        self._schedule()
+
+
+class DiscoveryScheduler(object):
+    """Broadcasts discovery queries with an exponential backoff and answers queries."""
+    device = None
+    """The local device"""
+    connection = None
+    """:type: hiqnet.service.ip.Connection"""
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    fast_interval = DEFAULT_FAST_INTERVAL
+    max_interval = DEFAULT_MAX_INTERVAL
+    factor = DEFAULT_BACKOFF_FACTOR
+    jitter = DEFAULT_JITTER
+    interval = DEFAULT_FAST_INTERVAL
+    """Current time between broadcasts in seconds"""
+    broadcasts = 0
+    replies = 0
+    _query = None
+    _info = None
+    _timer = None
+
+    def __init__(self, device, connection, registry=None, fast_interval=DEFAULT_FAST_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL, factor=DEFAULT_BACKOFF_FACTOR, jitter=DEFAULT_JITTER,
+                 clock=None):
+        """Build a discovery scheduler.
+
+        :param device: The local device
+        :type device: hiqnet.device.Device
+        :param connection: Where to send commands
+        :type connection: hiqnet.service.ip.Connection
+        :param registry: Topology changes from this registry bring back fast broadcasts
+        :type registry: DiscoveryRegistry
+        :param fast_interval: Time between broadcasts at startup and after a change in seconds
+        :type fast_interval: float
+        :param max_interval: Backoff ceiling in seconds
+        :type max_interval: float
+        :param factor: Interval growth after each broadcast
+        :type factor: float
+        :param jitter: Random part of the intervals
+        :type jitter: float
+        :param clock: Scheduler. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self.device = device
+        self.connection = connection
+        self.fast_interval = fast_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        if registry is not None:
+            registry.add_listener(self.topology_changed)
+
+    def start(self):
+        """Broadcast now and keep on broadcasting."""
+        self.interval = self.fast_interval
+        self._reschedule(0)
+
+    def stop(self):
+        """Stop broadcasting."""
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def invalidate(self):
+        """Forget the pre-encoded commands, after the local device information changed."""
+        self._query = None
+        self._info = None
+
+    # noinspection PyUnusedLocal
+    def topology_changed(self, event, device):
+        """Go back to fast broadcasts.
+
+        :param event: ADDED, CHANGED or REMOVED
+        :type event: str
+        :param device: The discovered device
+        :type device: DiscoveredDevice
+        """
+        if event == CHANGED or self._timer is None or self.interval <= self.fast_interval:
+            return
+        self.interval = self.fast_interval
+        if self._timer.getTime() - self.clock.seconds() > self.fast_interval:
+            self._reschedule(self.fast_interval)
+
+    def _reschedule(self, delay):
+        self.stop()
+        self._timer = self.clock.callLater(delay, self._broadcast)
+
+    def _broadcast(self):
+        self._timer = None
+        if self._query is None:
+            self._query = self._encode('Q')
+        self._send(self._query, FullyQualifiedAddress.broadcast_address(), '<broadcast>')
+        self.broadcasts += 1
+        delay = self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+        self.interval = min(self.interval * self.factor, self.max_interval)
+        self._timer = self.clock.callLater(delay, self._broadcast)
+
+    def _encode(self, disco_type):
+        command = Command(source=self.device.address, destination=FullyQualifiedAddress.broadcast_address(),
+                          sequence_number=0)
+        command.disco_info(self.device, disco_type)
+        return bytearray(bytes(command))
+
+    def _send(self, template, destination, ip_address):
+        template[12:18] = bytes(destination)
+        sequence_number = Command.sequence_numbers.next(self.device.address, destination)
+        template[23:25] = struct.pack('!H', sequence_number)
+        self.connection.write(bytes(template), ip_address)
+
+    def handle_command(self, command, ip_address=None):
+        """Answer discovery queries.
+
+        :param command: A received command
+        :type command: hiqnet.protocol.Command
+        :param ip_address: Sender IPv4 address
+        :type ip_address: str
+        :return: Whether the command was our own broadcast coming back and should be ignored
+        :rtype: bool
+        """
+        if command.message.name != 'DISCOINFO':
+            return False
+        if command.source_address.device_address == self.device.hiqnet_address:
+            return True
+        if command.flags.info:
+            return False
+        if self._info is None:
+            self._info = self._encode('I')
+        self._send(self._info, command.source_address, ip_address or '<broadcast>')
+        self.replies += 1
+        return False
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""HiQnet address negotiation.
+
+A candidate address is requested by broadcasting a REQADDR command.
+The device already using it, if any, answers with an ADDRUSED command.
+Without an answer during the listening window, the candidate is ours.
+On conflict, a new candidate is tried, up to `max_attempts` times.
+
+Candidates are picked among the addresses not seen in discovery nor reported used,
+so known conflicts are avoided up front.
+The worst case negotiation time is `max_attempts` times the listening window.
+
+Once negotiated, REQADDR commands for our address are answered with ADDRUSED.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import random
+
+from twisted.internet import defer
+
+from protocol import Command, FullyQualifiedAddress
+
+MIN_ADDRESS = 1
+MAX_ADDRESS = 65534
+NEGOTIATION_ADDRESS = 0
+"""Source address used while negotiating"""
+
+DEFAULT_WINDOW = 0.5  # s
+DEFAULT_MAX_ATTEMPTS = 8
+
+
+class AddressConflict(Exception):
+    """No free address found."""
+
+
+class AddressNegotiator(object):
+    """Negotiates the local device HiQnet address."""
+    device = None
+    """The local device"""
+    connection = None
+    """:type: hiqnet.service.ip.Connection"""
+    registry = None
+    """:type: hiqnet.discovery.DiscoveryRegistry"""
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    window = DEFAULT_WINDOW
+    max_attempts = DEFAULT_MAX_ATTEMPTS
+    used = None
+    """Addresses reported used"""
+    candidate = None
+    attempts = 0
+    conflicts = 0
+    started = None
+    finished = None
+    _timer = None
+    _deferred = None
+
+    def __init__(self, device, connection, registry=None, window=DEFAULT_WINDOW,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, clock=None):
+        """Build a negotiator.
+
+        :param device: The local device, its address is set once negotiated
+        :type device: hiqnet.device.Device
+        :param connection: Where to send commands
+        :type connection: hiqnet.service.ip.Connection
+        :param registry: Discovered devices, whose addresses are avoided
+        :type registry: hiqnet.discovery.DiscoveryRegistry
+        :param window: Time to listen for ADDRUSED replies in seconds
+        :type window: float
+        :param max_attempts: Candidates tried before giving up
+        :type max_attempts: int
+        :param clock: Scheduler. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self.device = device
+        self.connection = connection
+        self.registry = registry
+        self.window = window
+        self.max_attempts = max_attempts
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.used = set()
+
+    @property
+    def worst_case(self):
+        """Longest possible negotiation time in seconds.
+
+        :rtype: float
+        """
+        return self.window * self.max_attempts
+
+    @property
+    def elapsed(self):
+        """Negotiation duration in seconds.
+
+        :rtype: float
+        """
+        if self.started is None:
+            return 0.0
+        end = self.finished if self.finished is not None else self.clock.seconds()
+        return end - self.started
+
+    @property
+    def negotiating(self):
+        """:rtype: bool"""
+        return self._deferred is not None
+
+    def known(self, address):
+        """Tell whether an address is known to be used by another device.
+
+        :param address: HiQnet address
+        :type address: int
+        :rtype: bool
+        """
+        return address in self.used or (self.registry is not None and address in self.registry)
+
+    def pick(self):
+        """Pick a random candidate among the addresses not known to be used.
+
+        :rtype: int
+        """
+        if len(self.used) + (len(self.registry) if self.registry is not None else 0) >= MAX_ADDRESS:
+            raise AddressConflict("No free HiQnet address")
+        while True:
+            address = random.randint(MIN_ADDRESS, MAX_ADDRESS)
+            if not self.known(address):
+                return address
+
+    def negotiate(self, preferred=None):
+        """Negotiate an address.
+
+        :param preferred: Address to try first, such as a previously negotiated one
+        :type preferred: int
+        :return: Fires with the address, fails with AddressConflict
+        :rtype: defer.Deferred
+        """
+        if self._deferred is not None:
+            raise RuntimeError("Already negotiating")
+        self.attempts = 0
+        self.conflicts = 0
+        self.started = self.clock.seconds()
+        self.finished = None
+        self._deferred = defer.Deferred()
+        if preferred is not None and MIN_ADDRESS <= preferred <= MAX_ADDRESS and not self.known(preferred):
+            self._request(preferred)
+        else:
+            self._retry()
+        return self._deferred
+
+    def _request(self, address):
+        self.candidate = address
+        self.attempts += 1
+        command = Command(source=FullyQualifiedAddress(device_address=NEGOTIATION_ADDRESS),
+                          destination=FullyQualifiedAddress.broadcast_address())
+        command.request_address(address)
+        self.connection.sendto(command)
+        self._timer = self.clock.callLater(self.window, self._accept)
+
+    def _retry(self):
+        if self.attempts >= self.max_attempts:
+            self._finish()
+            self._deferred, d = None, self._deferred
+            d.errback(AddressConflict("No free HiQnet address after %d attempts" % self.attempts))
+            return
+        try:
+            address = self.pick()
+        except AddressConflict:
+            self._finish()
+            self._deferred, d = None, self._deferred
+            d.errback()
+            return
+        self._request(address)
+
+    def _accept(self):
+        self._timer = None
+        self._finish()
+        self.device.hiqnet_address = self.candidate
+        self._deferred, d = None, self._deferred
+        d.callback(self.candidate)
+
+    def _finish(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        self.finished = self.clock.seconds()
+
+    def handle_command(self, command, ip_address=None):
+        """Watch for conflicts and defend our address.
+
+        :param command: A received command
+        :type command: hiqnet.protocol.Command
+        :param ip_address: Sender IPv4 address
+        :type ip_address: str
+        :return: Whether the command was an address negotiation command
+        :rtype: bool
+        """
+        name = command.message.name
+        if name == 'ADDRUSED':
+            address = command.source_address.device_address
+            if self._deferred is not None or address != self.device.hiqnet_address:
+                # Not our own reply coming back
+                self.used.add(address)
+            if self._deferred is not None and address == self.candidate:
+                self.conflicts += 1
+                if self._timer is not None and self._timer.active():
+                    self._timer.cancel()
+                self._timer = None
+                self._retry()
+            return True
+        if name == 'REQADDR':
+            if self._deferred is None and command.requested_address == self.device.hiqnet_address:
+                reply = Command(source=self.device.address, destination=FullyQualifiedAddress.broadcast_address())
+                reply.address_used()
+                self.connection.sendto(reply)
+            return True
+        return False
@@ -5,8 +5,14 @@ from __future__ import print_function
 
 __author__ = 'Raphaël Doursenaud'
 
+import socket
+import struct
+
 import netifaces
 
+_autodetected = {}
+"""Autodetected network informations by interface, None being the default interface"""
+
 
 class NetworkInfo(object):
     """Network informations."""
@@ -96,21 +102,76 @@ class IPNetworkInfo(NetworkInfo):
         self.ip_address = ip_address
         self.subnet_mask = subnet_mask
 
+    @property
+    def broadcast_address(self):
+        """Directed broadcast address of the subnet.
+
+        :rtype: str
+        """
+        ip = struct.unpack('!L', socket.inet_aton(self.ip_address))[0]
+        mask = struct.unpack('!L', socket.inet_aton(self.subnet_mask))[0]
+        return socket.inet_ntoa(struct.pack('!L', ip | ~mask & 0xffffffff))
+
     @classmethod
-    def autodetect(cls):
-        """Get infos from the interface.
+    def autodetect(cls, interface=None, refresh=False):
+        """Get infos from an interface.
 
-        We assume that interface to the default gateway is the one we want
-        and fallback to the second interface since the first is usually "lo".
+        Detection only happens on first use, results are cached by interface.
 
+        :param interface: Interface name. Defaults to the one to the default gateway.
+        :type interface: str
+        :param refresh: Detect again, after a network change
+        :type refresh: bool
         :type cls: NetworkInfo
         :rtype: NetworkInfo
         """
+        if not refresh and interface in _autodetected:
+            return _autodetected[interface]
+        if interface is None:
+            info = cls.detect(cls.default_interface())
+        else:
+            info = cls.detect(interface)
+        _autodetected[interface] = info
+        return info
+
+    @staticmethod
+    def default_interface():
+        """Get the interface to use by default.
+
+        We assume that interface to the default gateway is the one we want
+        and fallback to the second interface since the first is usually "lo".
+
+        :rtype: str
+        """
         try:
-            iface = netifaces.gateways().get('default').get(netifaces.AF_INET)[1]
+            return netifaces.gateways().get('default').get(netifaces.AF_INET)[1]
         except TypeError:
             # Fallback to the second interface
-            iface = netifaces.interfaces().pop(1)
+            return netifaces.interfaces().pop(1)
+
+    @staticmethod
+    def interfaces():
+        """Get the interfaces with an IPv4 address, loopback excluded.
+
+        :rtype: list of str
+        """
+        names = []
+        for iface in netifaces.interfaces():
+            for addrs in netifaces.ifaddresses(iface).get(netifaces.AF_INET, []):
+                if addrs.get('addr') and not addrs['addr'].startswith('127.'):
+                    names.append(iface)
+                    break
+        return names
+
+    @classmethod
+    def detect(cls, iface):
+        """Get infos from an interface, without caching.
+
+        :param iface: Interface name
+        :type iface: str
+        :type cls: NetworkInfo
+        :rtype: NetworkInfo
+        """
         addrs = netifaces.ifaddresses(iface)
         mac_addrs = addrs.get(netifaces.AF_LINK)
         try:
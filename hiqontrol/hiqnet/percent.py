@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""HiQnet percentage values.
+
+PARMSETPCT and PARMSUBPCT carry parameter values as a percentage of their range
+rather than in the parameter's native unit and data type.
+The percentage is a signed 1.15 fixed point number: 0x0000 is 0% and 0x7fff is 100%.
+
+User interface widgets work in a normalised 0..1 range that maps directly to percentages.
+For bulk operations, conversions between percentages and native units are done
+on whole arrays at once using precomputed per parameter offsets and scales.
+"""
+
+__author__ = 'Raphaël Doursenaud'
+
+import array
+import struct
+
+PERCENT_SCALE = 0x7fff
+
+
+def encode(fraction):
+    """Encode a normalised value as a 1.15 fixed point percentage.
+
+    :param fraction: Normalised value between -1 and 1
+    :type fraction: float
+    :rtype: int
+    """
+    value = int(round(fraction * PERCENT_SCALE))
+    if value > PERCENT_SCALE:
+        return PERCENT_SCALE
+    if value < -PERCENT_SCALE - 1:
+        return -PERCENT_SCALE - 1
+    return value
+
+
+def decode(value):
+    """Decode a 1.15 fixed point percentage.
+
+    :param value: Fixed point percentage
+    :type value: int
+    :rtype: float
+    """
+    return value / float(PERCENT_SCALE)
+
+
+def pack_parameters(parameter_ids, fractions):
+    """Encode parameters percentages in a single pass.
+
+    :param parameter_ids: Parameter IDs
+    :type parameter_ids: list of int
+    :param fractions: Normalised values, in the same order
+    :type fractions: list of float
+    :return: Number of parameters followed by the parameter ID and percentage pairs
+    :rtype: bytes
+    """
+    count = len(parameter_ids)
+    if len(fractions) != count:
+        raise ValueError("Parameter IDs and values count mismatch")
+    interleaved = [None] * (count * 2)
+    interleaved[0::2] = parameter_ids
+    interleaved[1::2] = [encode(fraction) for fraction in fractions]
+    return struct.pack('!H' + 'Hh' * count, count, *interleaved)
+
+
+def unpack_parameters(payload):
+    """Decode parameters percentages.
+
+    :param payload: Number of parameters followed by the parameter ID and percentage pairs
+    :type payload: bytes
+    :return: Parameter IDs and normalised values pairs
+    :rtype: list of tuple
+    """
+    count = struct.unpack_from('!H', payload)[0]
+    values = struct.unpack_from('!' + 'Hh' * count, payload, 2)
+    return list(zip(values[0::2], [decode(value) for value in values[1::2]]))
+
+
+def to_percent(values, minimum, maximum):
+    """Normalise native values sharing the same range.
+
+    :param values: Native values
+    :type values: sequence of numbers
+    :param minimum: Range minimum
+    :param maximum: Range maximum
+    :return: Normalised values. 0 for an empty range.
+    :rtype: array.array
+    """
+    if maximum == minimum:
+        return array.array('d', [0.0] * len(values))
+    scale = 1.0 / (maximum - minimum)
+    return array.array('d', [(value - minimum) * scale for value in values])
+
+
+def to_native(fractions, minimum, maximum):
+    """Denormalise values sharing the same range.
+
+    :param fractions: Normalised values
+    :type fractions: sequence of float
+    :param minimum: Range minimum
+    :param maximum: Range maximum
+    :return: Native values
+    :rtype: array.array
+    """
+    span = float(maximum - minimum)
+    return array.array('d', [minimum + fraction * span for fraction in fractions])
+
+
+class PercentConverter(object):
+    """Converts parameters values between native units and percentages.
+
+    Ranges are kept in arrays aligned with the parameter store slots.
+    Parameters without a known range have a null span and convert to 0.
+    """
+    store = None
+    """:type: hiqnet.store.ParameterStore"""
+    minimums = None
+    """:type: array.array of doubles"""
+    spans = None
+    """:type: array.array of doubles"""
+
+    def __init__(self, store):
+        """Build a converter.
+
+        :param store: The parameter store whose slots the ranges are aligned to
+        :type store: hiqnet.store.ParameterStore
+        """
+        self.store = store
+        self.minimums = array.array('d')
+        self.spans = array.array('d')
+
+    def _grow(self):
+        missing = len(self.store) - len(self.minimums)
+        if missing > 0:
+            self.minimums.extend([0.0] * missing)
+            self.spans.extend([0.0] * missing)
+
+    def set_range(self, key, minimum, maximum):
+        """Set a parameter range.
+
+        :param key: Parameter key
+        :type key: int
+        :param minimum: Native minimum value
+        :param maximum: Native maximum value
+        """
+        slot = self.store.slot(key)
+        self._grow()
+        self.minimums[slot] = minimum
+        self.spans[slot] = maximum - minimum
+
+    def to_percent(self, slots=None):
+        """Get normalised values from the store.
+
+        :param slots: Slots to convert. Every slot if None.
+        :type slots: list of int
+        :return: Normalised values
+        :rtype: array.array
+        """
+        self._grow()
+        values = self.store.values
+        minimums = self.minimums
+        spans = self.spans
+        if slots is None:
+            return array.array('d', [(value - minimum) / span if span else 0.0
+                                     for value, minimum, span in zip(values, minimums, spans)])
+        return array.array('d', [(values[slot] - minimums[slot]) / spans[slot] if spans[slot] else 0.0
+                                 for slot in slots])
+
+    def to_native(self, fractions, slots=None):
+        """Denormalise values.
+
+        :param fractions: Normalised values
+        :type fractions: sequence of float
+        :param slots: Slots the values belong to, in the same order. Every slot if None.
+        :type slots: list of int
+        :return: Native values
+        :rtype: array.array
+        """
+        self._grow()
+        if slots is None:
+            return array.array('d', [minimum + fraction * span
+                                     for fraction, minimum, span in zip(fractions, self.minimums, self.spans)])
+        minimums = self.minimums
+        spans = self.spans
+        return array.array('d', [minimums[slot] + fraction * spans[slot] for fraction, slot in zip(fractions, slots)])
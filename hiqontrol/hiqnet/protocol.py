@@ -5,11 +5,13 @@ from __future__ import print_function
 
 __author__ = 'Raphaël Doursenaud'
 
-import itertools
 import os
 import socket
 import binascii
 
+import datatypes
+import percent
+import sequence
 from flags import *
 from networkinfo import *
 
@@ -19,6 +21,8 @@ PROTOCOL_MAX_VERSION = 3
 
 MIN_HEADER_LEN = 25  # bytes
 
+PORT = 3804  # IANA declared as IQnet. Go figure.
+
 DEFAULT_HOP_COUNTER = 5
 
 DEFAULT_FLAG_MASK = b'\x01\xff'
@@ -27,6 +31,25 @@ SUPPORTED_FLAG_MASK = DEFAULT_FLAG_MASK
 
 DEFAULT_KEEPALIVE = 10000  # ms
 
+DEFAULT_SENSOR_RATE = 100  # ms
+
+SUBSCRIPTION_TYPE_ALL = 0
+SUBSCRIPTION_TYPE_NON_SENSOR = 1
+SUBSCRIPTION_TYPE_SENSOR = 2
+
+# Store and recall actions
+ACTION_PARAMETERS = 0
+ACTION_SUBSCRIPTIONS = 1
+ACTION_SCENE = 2
+ACTION_SNAPSHOT = 3
+ACTION_PRESET = 4
+ACTION_VENUE = 5
+
+SCOPE_ALL = 0
+
+PARAMETER_ATTRIBUTES_FLAG = 0x8000
+"""Set in the GETATTR attributes count when the query is about a parameter"""
+
 
 class Message(object):
     """HiQnet messages handling."""
@@ -186,6 +209,20 @@ class FullyQualifiedAddress(object):
             '.' + "%d.%d.%d" % struct.unpack('!BBB', self.object_address)
 
 
+class DiscoveryInfo(object):
+    """Device information carried by DISCOINFO commands."""
+    device_address = None
+    cost = None
+    serial_number = None
+    """:type: bytes"""
+    max_message_size = None
+    """In bytes"""
+    keepalive = None
+    """Keep alive period in ms"""
+    network_info = None
+    """:type: NetworkInfo"""
+
+
 class Command(object):
     """HiQnet command."""
     # Placeholder, will be filled later
@@ -268,7 +305,7 @@ class Command(object):
 
     :type: int
     """
-    new_sequence_number = itertools.count()
+    sequence_numbers = sequence.SequenceNumbers()
     sequence_number = 0  # 2 bytes
     """
     The Sequence number is used to uniquely identify each HiQnet command leaving a
@@ -291,21 +328,102 @@ class Command(object):
 
     payload = b''  # Placeholder, filled later, depends on the message
 
-    def __init__(self, source=None, destination=None, command=None):
+    parameters = None
+    """
+    Decoded parameters from MULTPARMSET commands and MULTPARMGET replies.
+
+    :type: list of (parameter ID, data type, value) tuples
+    """
+
+    percentages = None
+    """
+    Decoded parameters from PARMSETPCT commands.
+
+    :type: list of (parameter ID, normalised value) tuples
+    """
+
+    attributes = None
+    """
+    Decoded attributes from GETATTR replies.
+
+    :type: list of (attribute ID, data type, value) tuples
+    """
+
+    virtual_devices = None
+    """
+    Decoded virtual devices from GETVDLIST replies.
+
+    :type: list of (virtual device address, class ID) tuples
+    """
+
+    hello_session_number = None
+    """
+    Decoded session number from HELLO commands.
+
+    :type: int
+    """
+    flag_mask = None
+    """
+    Decoded supported flags from HELLO commands.
+
+    :type: int
+    """
+
+    requested_address = None
+    """
+    Decoded address from REQADDR commands.
+
+    :type: int
+    """
+
+    requested_ids = None
+    """
+    Decoded parameter or attribute IDs from MULTPARMGET and GETATTR queries.
+
+    :type: list of int
+    """
+
+    attributes_parameter_id = None
+    """
+    Decoded parameter ID from GETATTR queries about a parameter.
+
+    :type: int
+    """
+
+    raw = None
+    """
+    The binary command, when decoded.
+
+    :type: bytes
+    """
+
+    discovery = None
+    """
+    Decoded device information from DISCOINFO commands.
+
+    :type: DiscoveryInfo
+    """
+
+    def __init__(self, source=None, destination=None, command=None, sequence_number=None):
         """Initiate an HiQnet command from source to destination.
 
         :param source: Source of the command
         :type source: FullyQualifiedAddress
         :param destination: destination of the command
         :type destination: FullyQualifiedAddress
+        :param sequence_number: Reuse a sequence number instead of taking the next one from source to destination
+        :type sequence_number: int
         :return:
         """
+        self.flags = DeviceFlags()
         if command:
             self.decode(command=command)
         else:
             self.source_address = source
             self.destination_address = destination  # TODO: use broadcast if not provided
-            self.sequence_number = next(self.new_sequence_number)
+            if sequence_number is None:
+                sequence_number = self.sequence_numbers.next(source, destination)
+            self.sequence_number = sequence_number
 
     def decode(self, command):
         """Decodes a binary command.
@@ -315,6 +433,7 @@ class Command(object):
         print("Real command length: ", len(command))
         if len(command) < MIN_HEADER_LEN:
             raise BufferError("Command too short")
+        self.raw = command
         self.version = struct.unpack('!B', command[0])[0]
         self.headerlen = struct.unpack('!B', command[1])[0]
         if len(command) < self.headerlen:
@@ -335,9 +454,7 @@ class Command(object):
             if self.flags.error:
                 self.error_code = struct.unpack('!B', command[index])[0]
                 index += 1
-                self.error_string = struct.unpack('s', command[index])[0]  # FIXME: detect string end
-                index += len(self.error_string)
-                raise NotImplementedError
+                self.error_string, index = datatypes.unpack_string_from(command, index)
             if self.flags.multipart:
                 self.start_seq_no = struct.unpack('!B', command[index])[0]
                 index += 1
@@ -351,8 +468,88 @@ class Command(object):
         self.payload = command[self.headerlen:self.commandlen]
 
         # TODO: decode payload by message type
-        if self.message.name == 'DISCOINFO':
+        if self.flags.error or self.flags.ack:
+            # Error replies and acknowledgements have no payload to decode
+            pass
+        elif self.message.name == 'DISCOINFO':
             self.decode_discoinfo()
+        elif self.message.name == 'MULTPARMSET' or (self.message.name == 'MULTPARMGET' and self.flags.info):
+            self.decode_multparmset()
+        elif self.message.name == 'PARMSETPCT':
+            self.percentages = percent.unpack_parameters(self.payload)
+        elif self.message.name == 'GETATTR' and self.flags.info:
+            self.attributes = self._decode_values()
+        elif self.message.name == 'GETVDLIST' and self.flags.info:
+            self.decode_getvdlist()
+        elif self.message.name == 'HELLO':
+            self.hello_session_number, self.flag_mask = struct.unpack_from('!HH', self.payload)
+        elif self.message.name == 'REQADDR':
+            self.requested_address = struct.unpack_from('!H', self.payload)[0]
+        elif self.message.name in ('MULTPARMGET', 'GETATTR'):
+            # Queries
+            count = struct.unpack_from('!H', self.payload)[0]
+            index = 2
+            if self.message.name == 'GETATTR' and count & PARAMETER_ATTRIBUTES_FLAG:
+                # About a parameter of the object
+                count &= ~PARAMETER_ATTRIBUTES_FLAG
+                self.attributes_parameter_id = struct.unpack_from('!H', self.payload, index)[0]
+                index += 2
+            self.requested_ids = list(struct.unpack_from('!' + 'H' * count, self.payload, index))
+
+    def _decode_values(self):
+        """Decode a list of identified and typed values.
+
+        - Number of values (UWORD)
+        - For each value:
+            - ID (UWORD)
+            - Data type (UBYTE)
+            - Value (depends on the data type)
+
+        :rtype: list of (ID, data type, value) tuples
+        """
+        values = []
+        count = struct.unpack_from('!H', self.payload)[0]
+        index = 2
+        while count:
+            identifier, data_type = struct.unpack_from('!HB', self.payload, index)
+            index += 3
+            value, index = datatypes.unpack_from(data_type, self.payload, index)
+            values.append((identifier, data_type, value))
+            count -= 1
+        return values
+
+    def decode_getvdlist(self):
+        """Decode a Get VD List reply payload.
+
+        Payload:
+        - Workgroup path (STRING)
+        - Number of virtual devices (UWORD)
+        - For each virtual device:
+            - Virtual device address (UBYTE)
+            - Class ID (UWORD)
+        """
+        self.virtual_devices = []
+        workgroup, index = datatypes.unpack_string_from(self.payload)
+        count = struct.unpack_from('!H', self.payload, index)[0]
+        index += 2
+        while count:
+            self.virtual_devices.append(struct.unpack_from('!BH', self.payload, index))
+            index += 3
+            count -= 1
+
+    def decode_multparmset(self):
+        """Decode multiple parameters set command payload.
+
+        Also used by MULTPARMGET replies and subscriptions notifications.
+
+        Payload:
+        - Number of parameters (UWORD)
+        - For each parameter:
+            - Parameter ID (UWORD)
+            - Data type (UBYTE)
+            - Value (depends on the data type)
+        """
+        self.parameters = self._decode_values()
 
     def decode_discoinfo(self):
         """Decode discovery information command payload.
@@ -372,80 +569,31 @@ class Command(object):
         else:
             print("DiscoInfo(Q)")
 
-        index = 0
-
-        size = 2
-        print("Device address: ", end='')
-        print(struct.unpack('!H', self.payload[index:index + size])[0])
-        index += size
-
-        print("Cost: ", end='')
-        print(struct.unpack('!B', self.payload[index])[0])
-        index += 1
-
-        # TODO: extract this algo as the "BLOCK" type
-        size = 2
-        data_len = struct.unpack('!H', self.payload[index:index + size])[0]
-        index += size
-        size = data_len
-        print("Serial number: ", end='')
-        serial_number = ''
-        while size:
-            serial_number += struct.unpack('!s', self.payload[index])[0]
-            index += 1
-            size -= 1
-        print(serial_number)
-
-        size = 4
-        print("Max message size: ", end='')
-        print(struct.unpack('!L', self.payload[index:index + size])[0])
-        index += size
-
-        size = 2
-        print("Keep alive period: ", end='')
-        print(struct.unpack('!H', self.payload[index:index + size])[0])
-        index += size
-
-        print("NetworkID: ", end='')
-        network_id = struct.unpack('!B', self.payload[index])[0]
-        print(network_id)
-        index += 1
-
-        print("NetworkInfo: ", end='')
+        info = DiscoveryInfo()
+        info.device_address, info.cost = struct.unpack_from('!HB', self.payload)
+        info.serial_number, index = datatypes.unpack_block_from(self.payload, 3)
+        info.max_message_size, info.keepalive, network_id = struct.unpack_from('!LHB', self.payload, index)
+        index += 7
+
         if network_id == NetworkInfo.NET_ID_TCP_IP:
             # TCP/IP
-            size = 6
-            mac_address = "%02x:%02x:%02x:%02x:%02x:%02x" % struct.unpack("!BBBBBB", self.payload[index:index + size])
-            index += size
-
-            dhcp = bool(struct.unpack("B", self.payload[index])[0])
-            index += 1
-
-            size = 4
-            ip_address = "%d.%d.%d.%d" % struct.unpack('!BBBB', self.payload[index:index + size])
-            index += size
-
-            size = 4
-            subnet_mask = "%d.%d.%d.%d" % struct.unpack('!BBBB', self.payload[index:index + size])
-            index += size
-
-            size = 4
-            gateway_address = "%d.%d.%d.%d" % struct.unpack('!BBBB', self.payload[index:index + size])
-            index += size
-
-            network_info = IPNetworkInfo(mac_address=mac_address, dhcp=dhcp,
-                                         ip_address=ip_address, subnet_mask=subnet_mask,
-                                         gateway_address=gateway_address)
-
-            print(vars(network_info))  # DEBUG
+            mac = struct.unpack_from('!6B', self.payload, index)
+            dhcp, = struct.unpack_from('!B', self.payload, index + 6)
+            ip_address, subnet_mask, gateway_address = struct.unpack_from('!4s4s4s', self.payload, index + 7)
+            info.network_info = IPNetworkInfo(mac_address="%02x:%02x:%02x:%02x:%02x:%02x" % mac,
+                                              dhcp=bool(dhcp),
+                                              ip_address=socket.inet_ntoa(ip_address),
+                                              subnet_mask=socket.inet_ntoa(subnet_mask),
+                                              gateway_address=socket.inet_ntoa(gateway_address))
 
         elif network_id == NetworkInfo.NET_ID_RS232:
-            network_info = RS232NetworkInfo
             raise NotImplementedError
 
         else:
             raise NotImplementedError
 
+        self.discovery = info
+
     @property
     def version(self):
         return self._version
@@ -530,7 +678,7 @@ class Command(object):
     def request_address(self, req_addr):
         """Build a Request Address command.
 
-        :param req_addr:
+        :param req_addr: The requested HiQnet address
         :type req_addr: int
         """
         self.message = Message(name='REQADDR')
@@ -540,50 +688,276 @@ class Command(object):
         """Build an Address Used command."""
         self.message = Message(name='ADDRUSED')
 
-    def hello(self):
+    def hello(self, session_number=None):
         """Build an hello command.
 
         Starts a session.
 
+        :param session_number: Our session number. Random if not provided.
+        :type session_number: int
         :return: The session number
         :rtype: int
         """
         self.message = Message(name='HELLO')
-        session_number = os.urandom(2)
+        if session_number is None:
+            session_number = struct.unpack('!H', os.urandom(2))[0]
         flag_mask = SUPPORTED_FLAG_MASK
-        self.payload = session_number + flag_mask
+        self.payload = struct.pack('!H', session_number) + flag_mask
         return session_number
 
-    def get_attributes(self):
-        """Build a Get Attributes command."""
+    def goodbye(self, device_address):
+        """Build a Goodbye command.
+
+        Ends a session.
+
+        :param device_address: The leaving device address
+        :type device_address: int
+        """
+        self.message = Message(name='GOODBYE')
+        self.payload = struct.pack('!H', device_address)
+
+    def multi_param_subscribe(self, subscriptions, subscriber, sensor_rate=DEFAULT_SENSOR_RATE,
+                              subscription_type=SUBSCRIPTION_TYPE_ALL):
+        """Build a Multiple Parameter Subscribe command.
+
+        The destination is the publisher object.
+
+        :param subscriptions: Publisher and subscriber parameter IDs pairs
+        :type subscriptions: list of tuple
+        :param subscriber: The subscriber object address
+        :type subscriber: FullyQualifiedAddress
+        :param sensor_rate: Minimum time between sensor parameters updates in ms
+        :type sensor_rate: int
+        :param subscription_type: Which kind of parameters to be notified about
+        :type subscription_type: int
+        """
+        self.message = Message(name='MULTPARMSUB')
+        self.payload = self._subscriptions_payload(subscriptions, subscriber, sensor_rate, subscription_type)
+
+    def multi_param_unsubscribe(self, subscriptions, subscriber):
+        """Build a Multiple Parameter Unsubscribe command.
+
+        The destination is the publisher object.
+
+        :param subscriptions: Publisher and subscriber parameter IDs pairs
+        :type subscriptions: list of tuple
+        :param subscriber: The subscriber object address
+        :type subscriber: FullyQualifiedAddress
+        """
+        self.message = Message(name='MULTPARMUNSUB')
+        self.payload = bytes(subscriber) + struct.pack('!H', len(subscriptions))
+        for publisher_parameter_id, subscriber_parameter_id in subscriptions:
+            self.payload += struct.pack('!HH', publisher_parameter_id, subscriber_parameter_id)
+
+    def param_set_percent(self, parameter_ids, fractions):
+        """Build a Parameter Set Percent command.
+
+        The destination is the parameters object.
+
+        :param parameter_ids: Parameter IDs
+        :type parameter_ids: list of int
+        :param fractions: Normalised values between 0 and 1, in the same order
+        :type fractions: list of float
+        """
+        self.message = Message(name='PARMSETPCT')
+        self.payload = percent.pack_parameters(parameter_ids, fractions)
+
+    def param_subscribe_percent(self, subscriptions, subscriber, sensor_rate=DEFAULT_SENSOR_RATE,
+                                subscription_type=SUBSCRIPTION_TYPE_ALL):
+        """Build a Parameter Subscribe Percent command.
+
+        Same as :py:func:`multi_param_subscribe` but notifications are PARMSETPCT commands.
+
+        :param subscriptions: Publisher and subscriber parameter IDs pairs
+        :type subscriptions: list of tuple
+        :param subscriber: The subscriber object address
+        :type subscriber: FullyQualifiedAddress
+        :param sensor_rate: Minimum time between sensor parameters updates in ms
+        :type sensor_rate: int
+        :param subscription_type: Which kind of parameters to be notified about
+        :type subscription_type: int
+        """
+        self.message = Message(name='PARMSUBPCT')
+        self.payload = self._subscriptions_payload(subscriptions, subscriber, sensor_rate, subscription_type)
+
+    def param_subscribe_all(self, subscriber, sensor_rate=DEFAULT_SENSOR_RATE,
+                            subscription_type=SUBSCRIPTION_TYPE_ALL):
+        """Build a Parameter Subscribe All command.
+
+        Subscribes to every parameter of the destination virtual device.
+
+        :param subscriber: The subscriber address
+        :type subscriber: FullyQualifiedAddress
+        :param sensor_rate: Minimum time between sensor parameters updates in ms
+        :type sensor_rate: int
+        :param subscription_type: Which kind of parameters to be notified about
+        :type subscription_type: int
+        """
+        self.message = Message(name='PARMSUBALL')
+        self.payload = bytes(subscriber) + struct.pack('!BH', subscription_type, sensor_rate)
+
+    def param_unsubscribe_all(self, subscriber, subscription_type=SUBSCRIPTION_TYPE_ALL):
+        """Build a Parameter Unsubscribe All command.
+
+        :param subscriber: The subscriber address
+        :type subscriber: FullyQualifiedAddress
+        :param subscription_type: Which kind of parameters to stop being notified about
+        :type subscription_type: int
+        """
+        self.message = Message(name='PARMUNSUBALL')
+        self.payload = bytes(subscriber) + struct.pack('!B', subscription_type)
+
+    @staticmethod
+    def _subscriptions_payload(subscriptions, subscriber, sensor_rate, subscription_type):
+        """Build a subscriptions list payload.
+
+        - Number of subscriptions (UWORD)
+        - For each subscription:
+            - Publisher parameter ID (UWORD)
+            - Subscription type (UBYTE)
+            - Subscriber address (6 bytes)
+            - Subscriber parameter ID (UWORD)
+            - Reserved (UBYTE)
+            - Reserved (UWORD)
+            - Sensor rate (UWORD)
+        """
+        payload = struct.pack('!H', len(subscriptions))
+        subscriber = bytes(subscriber)
+        for publisher_parameter_id, subscriber_parameter_id in subscriptions:
+            payload += struct.pack('!HB', publisher_parameter_id, subscription_type) + subscriber \
+                + struct.pack('!HBHH', subscriber_parameter_id, 0, 0, sensor_rate)
+        return payload
+
+    def get_attributes(self, attribute_ids):
+        """Build a Get Attributes command.
+
+        The destination is the virtual device or object to get the attributes from.
+
+        :param attribute_ids: Attribute IDs
+        :type attribute_ids: list of int
+        """
+        self.message = Message(name='GETATTR')
+        self.payload = struct.pack('!H' + 'H' * len(attribute_ids), len(attribute_ids), *attribute_ids)
+
+    def get_parameter_attributes(self, parameter_id, attribute_ids):
+        """Build a Get Attributes command about a parameter.
+
+        The destination is the parameter object.
+        The attributes count has PARAMETER_ATTRIBUTES_FLAG set and is followed by the parameter ID.
+
+        :param parameter_id: Parameter ID
+        :type parameter_id: int
+        :param attribute_ids: Attribute IDs
+        :type attribute_ids: list of int
+        """
         self.message = Message(name='GETATTR')
-        raise NotImplementedError
+        self.payload = struct.pack('!HH' + 'H' * len(attribute_ids),
+                                   len(attribute_ids) | PARAMETER_ATTRIBUTES_FLAG, parameter_id, *attribute_ids)
 
-    def get_vd_list(self, workgroup=''):
+    def get_vd_list(self, workgroup=u''):
         """Build a Get VD List command.
 
         :param workgroup: The workgroup to get the VD list from.
-        :type workgroup: str
+        :type workgroup: unicode
         """
         self.message = Message(name='GETVDLIST')
-        self.payload = workgroup
-        # raise NotImplementedError
+        self.payload = datatypes.pack_string(workgroup)
+
+    def multi_param_get(self, parameter_ids):
+        """Build a Multiple Parameter Get command.
+
+        The destination is the parameters object.
+
+        :param parameter_ids: Parameter IDs
+        :type parameter_ids: list of int
+        """
+        self.message = Message(name='MULTPARMGET')
+        self.payload = struct.pack('!H' + 'H' * len(parameter_ids), len(parameter_ids), *parameter_ids)
+
+    def multi_param_set(self, parameters):
+        """Build a Multiple Parameter Set command.
 
-    def store(self):
+        The destination is the parameters object.
+
+        :param parameters: Parameter ID, data type and value
+        :type parameters: list of tuple
+        """
+        self.message = Message(name='MULTPARMSET')
+        self.payload = self._values_payload(parameters)
+
+    def multi_param_get_reply(self, parameters):
+        """Build a Multiple Parameter Get reply.
+
+        The source is the parameters object.
+
+        :param parameters: Parameter ID, data type and value
+        :type parameters: list of tuple
+        """
+        self.message = Message(name='MULTPARMGET')
+        self.flags.info = 1
+        self.payload = self._values_payload(parameters)
+
+    def get_attributes_reply(self, attributes):
+        """Build a Get Attributes reply.
+
+        The source is the virtual device or object the attributes are from.
+
+        :param attributes: Attribute ID, data type and value
+        :type attributes: list of tuple
+        """
+        self.message = Message(name='GETATTR')
+        self.flags.info = 1
+        self.payload = self._values_payload(attributes)
+
+    @staticmethod
+    def _values_payload(values):
+        """Build an identified and typed values list payload.
+
+        - Number of values (UWORD)
+        - For each value:
+            - ID (UWORD)
+            - Data type (UBYTE)
+            - Value (depends on the data type)
+        """
+        return struct.pack('!H', len(values)) + b''.join(
+            [struct.pack('!HB', identifier, data_type) + datatypes.pack(data_type, value)
+             for identifier, data_type, value in values])
+
+    def store(self, number, action=ACTION_PRESET, workgroup=u'', scope=SCOPE_ALL):
         """Build a Store command.
 
         Stores current state to a preset.
+
+        :param number: Where to store
+        :type number: int
+        :param action: What to store
+        :type action: int
+        :param workgroup: The workgroup to store
+        :type workgroup: unicode
+        :param scope: Storage scope
+        :type scope: int
         """
         self.message = Message(name='STORE')
-        raise NotImplementedError
+        self.payload = struct.pack('!BH', action, number) + datatypes.pack_string(workgroup) \
+            + struct.pack('!B', scope)
 
-    def recall(self):
+    def recall(self, number, action=ACTION_PRESET, workgroup=u'', scope=SCOPE_ALL):
         """Build a Recall command.
 
         Recalls a preset.
+
+        :param number: What to recall
+        :type number: int
+        :param action: What kind of storage to recall
+        :type action: int
+        :param workgroup: The workgroup to recall
+        :type workgroup: unicode
+        :param scope: Recall scope
+        :type scope: int
         """
         self.message = Message(name='RECALL')
-        raise NotImplementedError
+        self.payload = struct.pack('!BH', action, number) + datatypes.pack_string(workgroup) \
+            + struct.pack('!B', scope)
 
     def locate(self, time, serial_number):
         """Builds a Locate command.
@@ -621,6 +995,7 @@ class Command(object):
 
     def _build_optional_headers(self):
         """Builds the optional command headers."""
+        self.optional_headers = b''
         # Optional error header
         if self.flags.error:
             error_code = b'\x02'
@@ -635,9 +1010,7 @@ class Command(object):
             raise NotImplementedError
         # Optional session number header
         if self.flags.session:
-            session_number = b'\x00\x00'  # 2 bytes
-            self.optional_headers += session_number
-            raise NotImplementedError
+            self.optional_headers += struct.pack('!H', self.session_number)
 
     def _compute_headerlen(self):
         """Computes the header length."""
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""HiQnet read-cache proxy.
+
+Control surfaces talk to the proxy as if it were the console.
+The proxy keeps a mirror of the console parameters, backed by subscriptions,
+and answers MULTPARMGET and GETATTR queries from it.
+Everything else, such as sets, is forwarded to the console and the replies forwarded back.
+
+- The mirror grows with the queries: the parameters of a query that can't be answered locally
+  are subscribed to while the query is forwarded.
+  Their values come from the forwarded reply then from the notifications.
+- Attributes are cached from the forwarded GETATTR replies. They seldom change.
+  Queries about the attributes of a parameter are forwarded, their replies aren't cached.
+- Local replies come from the queried object address.
+- Forwarded commands keep their sequence number, so the acknowledgements and the replies
+  still match the commands they answer on both sides.
+  Only the local replies are numbered by the proxy.
+- With a reliable sender, the sets are forwarded to the console until it acknowledges them.
+  The acknowledgement is only forwarded back to the client that asked for it.
+  The client retransmissions of a set being delivered are dropped.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+from twisted.python import log
+
+from protocol import Command
+from sequence import SequenceNumbers
+from store import address_key
+
+BROADCAST_DEVICE = 0xffff
+
+SETS = frozenset(['MULTPARMSET', 'MULTOBJPARMSET', 'PARMSETPCT'])
+"""Forwarded until acknowledged, with a reliable sender"""
+
+
+class ReadCacheProxy(object):
+    """Answers the queries from a mirror of the console."""
+    device = None
+    """The local device"""
+    connection = None
+    """:type: hiqnet.service.ip.Connection"""
+    console_ip = None
+    console_address = None
+    """Console HiQnet device address"""
+    subscriptions = None
+    """:type: hiqnet.subscription.SubscriptionManager"""
+    attributes = None
+    """Cached attributes values by address key, by attribute ID"""
+    clients = None
+    """Clients IPv4 addresses by HiQnet device address"""
+    parameter_queries = None
+    """Forwarded queries about parameters attributes waiting for their reply, by address key"""
+    reliable = None
+    """:type: hiqnet.service.reliable.ReliableSender"""
+    acknowledgements = None
+    """Whether the client asked for an acknowledgement, by client device address and sequence number
+    of the sets being delivered"""
+    sequence_numbers = None
+    """Numbers the local replies, :type: hiqnet.sequence.SequenceNumbers"""
+    served = 0
+    """Queries answered locally"""
+    misses = 0
+    """Queries forwarded for lack of mirrored values"""
+    forwarded_up = 0
+    forwarded_down = 0
+
+    def __init__(self, device, connection, console_ip, console_address, subscriptions, reliable=None):
+        """Build a proxy.
+
+        :param device: The local device, subscribing to the console
+        :type device: hiqnet.device.Device
+        :param connection: Where to send commands
+        :type connection: hiqnet.service.ip.Connection
+        :param console_ip: Console IPv4 address
+        :type console_ip: str
+        :param console_address: Console HiQnet device address
+        :type console_address: int
+        :param subscriptions: Subscriptions to the console, their store is the mirror
+        :type subscriptions: hiqnet.subscription.SubscriptionManager
+        :param reliable: Delivers the sets to the console until acknowledged. Forwarded once by default.
+        :type reliable: hiqnet.service.reliable.ReliableSender
+        """
+        self.device = device
+        self.connection = connection
+        self.console_ip = console_ip
+        self.console_address = console_address
+        self.subscriptions = subscriptions
+        self.attributes = {}
+        self.clients = {}
+        self.parameter_queries = {}
+        self.reliable = reliable
+        self.acknowledgements = {}
+        self.sequence_numbers = SequenceNumbers()
+
+    def handle_command(self, command, ip_address=None):
+        """Answer or forward the commands between the clients and the console.
+
+        :param command: A received command
+        :type command: hiqnet.protocol.Command
+        :param ip_address: Sender IPv4 address
+        :type ip_address: str
+        :return: Whether the command was handled by the proxy
+        :rtype: bool
+        """
+        destination = command.destination_address.device_address
+        if ip_address == self.console_ip:
+            if destination in (self.device.hiqnet_address, BROADCAST_DEVICE):
+                return False
+            client_ip = self.clients.get(destination)
+            if client_ip is None:
+                return False
+            if command.flags.ack:
+                wanted = self.acknowledgements.pop((destination, command.sequence_number), None)
+                if wanted is not None:
+                    # Of a set we delivered
+                    self.reliable.handle_command(command, ip_address)
+                    if not wanted:
+                        return True
+            self._snoop(command)
+            self.forwarded_down += 1
+            self._forward(command, client_ip)
+            return True
+        if destination != self.console_address:
+            return False
+        self.clients[command.source_address.device_address] = ip_address
+        if not command.flags.info and not command.flags.error and self._serve(command, ip_address):
+            self.served += 1
+            return True
+        if command.attributes_parameter_id is not None:
+            key = address_key(command.destination_address)
+            self.parameter_queries[key] = self.parameter_queries.get(key, 0) + 1
+        if self.reliable is not None and command.message.name in SETS and not command.flags.ack:
+            key = (command.source_address.device_address, command.sequence_number)
+            if key in self.acknowledgements:
+                # Already being delivered
+                return True
+            self.acknowledgements[key] = bool(command.flags.reqack)
+            self.forwarded_up += 1
+            d = self.reliable.send(command, self.console_ip, self._hop(command))
+            d.addErrback(self._undelivered, key)
+            return True
+        self.forwarded_up += 1
+        self._forward(command, self.console_ip)
+        return True
+
+    def _undelivered(self, failure, key):
+        self.acknowledgements.pop(key, None)
+        log.err(failure, "Set from device %d not acknowledged by the console" % key[0])
+
+    def _serve(self, command, ip_address):
+        """Answer a query from the mirror.
+
+        :return: Whether the query was answered
+        :rtype: bool
+        """
+        name = command.message.name
+        ids = command.requested_ids
+        if not ids or name not in ('MULTPARMGET', 'GETATTR') or command.attributes_parameter_id is not None:
+            return False
+        address = command.destination_address
+        if name == 'GETATTR':
+            cached = self.attributes.get(address_key(address))
+            if cached is None or not all(attribute_id in cached for attribute_id in ids):
+                self.misses += 1
+                return False
+            reply = self._reply(command)
+            reply.get_attributes_reply([(attribute_id,) + cached[attribute_id] for attribute_id in ids])
+        else:
+            values = self._mirrored(address, ids)
+            if values is None:
+                self.misses += 1
+                self.subscriptions.subscribe(address, ids, self.console_ip)
+                return False
+            reply = self._reply(command)
+            reply.multi_param_get_reply(values)
+        self.connection.sendto(reply, ip_address)
+        return True
+
+    def _mirrored(self, address, parameter_ids):
+        """Get fresh parameters values from the mirror.
+
+        :return: Parameter ID, data type and value or None if one of them isn't mirrored
+        :rtype: list of tuple
+        """
+        store = self.subscriptions.store
+        base = address_key(address) << 16
+        values = []
+        for parameter_id in parameter_ids:
+            key = base | parameter_id
+            if key not in store or not self.subscriptions.is_subscribed(address, parameter_id):
+                return None
+            values.append((parameter_id, store.data_types[store.slot(key)], store.get(key)))
+        return values
+
+    def _reply(self, command):
+        source = command.destination_address
+        destination = command.source_address
+        return Command(source=source, destination=destination,
+                       sequence_number=self.sequence_numbers.next(source, destination))
+
+    def _snoop(self, command):
+        """Learn from the replies going to the clients."""
+        if not command.flags.info or command.flags.error:
+            return
+        name = command.message.name
+        if name == 'GETATTR' and command.attributes:
+            key = address_key(command.source_address)
+            waiting = self.parameter_queries.get(key)
+            if waiting:
+                # About a parameter, not the object
+                if waiting == 1:
+                    del self.parameter_queries[key]
+                else:
+                    self.parameter_queries[key] = waiting - 1
+                return
+            cached = self.attributes.setdefault(key, {})
+            for attribute_id, data_type, value in command.attributes:
+                cached[attribute_id] = (data_type, value)
+        elif name == 'MULTPARMGET' and command.parameters:
+            update = self.subscriptions.store.update
+            base = address_key(command.source_address) << 16
+            for parameter_id, data_type, value in command.parameters:
+                update(base | parameter_id, data_type, value)
+
+    @staticmethod
+    def _hop(command):
+        """Encode a received command to forward it.
+
+        :param command: A received command
+        :type command: hiqnet.protocol.Command
+        :return: The command as received, but for its hop count
+        :rtype: bytes
+        """
+        data = bytearray(command.raw)
+        if data[22]:
+            # We are a hop
+            data[22] -= 1
+        return bytes(data)
+
+    def _forward(self, command, ip_address):
+        """Forward a received command as is, but for its hop count.
+
+        :param command: A received command
+        :type command: hiqnet.protocol.Command
+        :param ip_address: Destination IPv4 address
+        :type ip_address: str
+        """
+        self.connection.write(self._hop(command), ip_address)
+
+    def stats(self):
+        """Counters.
+
+        :rtype: dict
+        """
+        return {
+            'served': self.served,
+            'misses': self.misses,
+            'forwarded_up': self.forwarded_up,
+            'forwarded_down': self.forwarded_down,
+            'clients': len(self.clients),
+            'mirrored': len(self.subscriptions.store),
+        }
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""HiQnet sequence numbers.
+
+Sequence numbers are 16 bits wide and roll over at the top of their range.
+They are counted separately for each source and destination device pair.
+
+On receive, the sequence numbers of each peer are checked to count missing commands,
+duplicates and commands arriving out of order, without a packet capture.
+Comparisons are done modulo 2^16 so roll overs are not mistaken for gaps.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+SEQUENCE_MODULO = 0x10000
+HALF_RANGE = 0x8000
+
+REORDER_WINDOW = 64
+"""Number of recent sequence numbers remembered per peer to tell late commands from duplicates"""
+
+IN_ORDER = 0
+DUPLICATE = 1
+REORDERED = 2
+RESTARTED = 3
+"""The peer sequence numbers jumped back further than the window, most likely a reboot"""
+
+
+def _pair(source, destination):
+    return (source.device_address if source is not None else None,
+            destination.device_address if destination is not None else None)
+
+
+class SequenceNumbers(object):
+    """Sequence number generators by source and destination device."""
+    _next = None
+
+    def __init__(self):
+        self._next = {}
+
+    def next(self, source, destination):
+        """Get the next sequence number from source to destination.
+
+        :param source: Source address
+        :type source: hiqnet.protocol.FullyQualifiedAddress
+        :param destination: Destination address
+        :type destination: hiqnet.protocol.FullyQualifiedAddress
+        :rtype: int
+        """
+        pair = _pair(source, destination)
+        number = self._next.get(pair, 0)
+        self._next[pair] = (number + 1) % SEQUENCE_MODULO
+        return number
+
+    def reset(self):
+        """Start over from 0, like after a power up."""
+        self._next.clear()
+
+
+class PeerSequence(object):
+    """Received sequence numbers statistics for a source and destination pair."""
+    highest = None
+    """Highest sequence number received"""
+    received = 0
+    missing = 0
+    """Commands skipped by the sequence numbers and not received since"""
+    duplicates = 0
+    reordered = 0
+    restarts = 0
+    _window = 0
+    """Bit n set when highest - n was received"""
+    _span = 0
+    """Sequence numbers from the first one received to highest"""
+
+    def track(self, number):
+        """Account for a received sequence number.
+
+        :param number: Received sequence number
+        :type number: int
+        :return: IN_ORDER, DUPLICATE, REORDERED or RESTARTED
+        :rtype: int
+        """
+        self.received += 1
+        if self.highest is None:
+            self.highest = number
+            self._window = 1
+            self._span = 0
+            return IN_ORDER
+        ahead = (number - self.highest) % SEQUENCE_MODULO
+        if ahead == 0:
+            self.duplicates += 1
+            return DUPLICATE
+        if ahead < HALF_RANGE:
+            self.missing += ahead - 1
+            self._window = ((self._window << ahead) | 1) & ((1 << REORDER_WINDOW) - 1)
+            self.highest = number
+            self._span = min(self._span + ahead, REORDER_WINDOW)
+            return IN_ORDER
+        behind = SEQUENCE_MODULO - ahead
+        if behind >= REORDER_WINDOW:
+            self.restarts += 1
+            self.highest = number
+            self._window = 1
+            self._span = 0
+            return RESTARTED
+        bit = 1 << behind
+        if self._window & bit:
+            self.duplicates += 1
+            return DUPLICATE
+        self._window |= bit
+        if behind < self._span and self.missing > 0:
+            # Counted as missing when skipped, older ones were never expected
+            self.missing -= 1
+        self.reordered += 1
+        return REORDERED
+
+
+class SequenceTracker(object):
+    """Received sequence numbers statistics by peer."""
+    peers = None
+    """:type: dict of PeerSequence by (source device address, destination device address)"""
+
+    def __init__(self):
+        self.peers = {}
+
+    def track(self, command):
+        """Account for a received command.
+
+        Acknowledgements carry the sequence number of the acknowledged command and are ignored.
+
+        :param command: A received command
+        :type command: hiqnet.protocol.Command
+        :return: IN_ORDER, DUPLICATE, REORDERED, RESTARTED or None when ignored
+        :rtype: int
+        """
+        if command.flags.ack:
+            return None
+        pair = _pair(command.source_address, command.destination_address)
+        peer = self.peers.get(pair)
+        if peer is None:
+            peer = self.peers[pair] = PeerSequence()
+        return peer.track(command.sequence_number)
+
+    def stats(self):
+        """Get a summary of the received sequence numbers statistics.
+
+        :return: Statistics by source device address, all destinations combined
+        :rtype: dict
+        """
+        summary = {}
+        for (source, _), peer in self.peers.items():
+            entry = summary.setdefault(source, {
+                'received': 0, 'missing': 0, 'duplicates': 0, 'reordered': 0, 'restarts': 0})
+            entry['received'] += peer.received
+            entry['missing'] += peer.missing
+            entry['duplicates'] += peer.duplicates
+            entry['reordered'] += peer.reordered
+            entry['restarts'] += peer.restarts
+        return summary
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
-"""HiQnet services."""
+"""HiQnet services.
+
+Only :mod:`hiqnet.service.ip` is imported with the package.
+Import the other services explicitly where they are used, such as ``import hiqnet.service.pool``.
+"""
 
 __author__ = 'Raphaël Doursenaud'
 
-__all__ = ['ip']
+__all__ = ['duplicates', 'inbound', 'instruments', 'interfaces', 'ip', 'outbound', 'pending', 'pipeline', 'pool',
+           'reliable', 'shards']
 
 import ip
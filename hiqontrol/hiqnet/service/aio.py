@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""HiQnet IP communication over asyncio.
+
+Same API as :mod:`hiqnet.service.ip` without a Twisted reactor, for headless tools.
+
+- UDP uses an asyncio datagram endpoint, TCP uses asyncio stream transports
+  with the same command framing as the Twisted protocol.
+- :class:`Clock` lets the timers based services (sessions, pending requests, discovery…) run on the loop.
+
+Like the rest of the library, this is Python 2 code: it runs on trollius, the asyncio backport,
+an optional dependency. Twisted must still be installed since :mod:`hiqnet` imports every service,
+but none of it is used here.
+Not imported by :mod:`hiqnet.service`, import :mod:`hiqnet.service.aio` explicitly.
+
+Unlike :mod:`hiqnet.service.pool`, the TCP connections pool is minimal:
+connections are never closed for being idle and failed connections are not retried.
+Commands buffered while connecting are abandoned when the connection fails, and counted.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import logging
+import socket
+import struct
+
+try:
+    import trollius as asyncio
+except ImportError:
+    raise ImportError("The asyncio backend needs trollius: pip install trollius")
+
+from ..protocol import Command, MIN_HEADER_LEN, PORT
+from .duplicates import RecentBroadcasts
+
+logger = logging.getLogger(__name__)
+
+
+class DelayedCall(object):
+    """Twisted like handle of a call scheduled on an asyncio loop."""
+    clock = None
+    time = None
+    _handle = None
+    _called = False
+    _cancelled = False
+
+    def __init__(self, clock, delay, f, args, kwargs):
+        self.clock = clock
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self._schedule(delay)
+
+    def _schedule(self, delay):
+        self.time = self.clock.seconds() + delay
+        self._handle = self.clock.loop.call_at(self.time, self._call)
+
+    def _call(self):
+        self._called = True
+        self.f(*self.args, **self.kwargs)
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self._called or self._cancelled)
+
+    def cancel(self):
+        self._cancelled = True
+        self._handle.cancel()
+
+    def reset(self, delay):
+        self._handle.cancel()
+        self._schedule(delay)
+
+
+class Clock(object):
+    """Twisted IReactorTime on top of an asyncio loop."""
+    loop = None
+
+    def __init__(self, loop=None):
+        """Build a clock.
+
+        :param loop: Defaults to the current event loop
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, f, *args, **kwargs):
+        return DelayedCall(self, delay, f, args, kwargs)
+
+
+class Connection(object):
+    """Handles HiQnet IP connection.
+
+    .. warning:: Other connection types such as RS232, RS485 or USB are not handled yet.
+    """
+    udp_transport = None
+    tcp_transport = None
+    tcp_pool = None
+    """:type: TCPConnectionPool"""
+
+    def __init__(self, udp_transport, tcp_transport=None, tcp_pool=None):
+        """Initiate a HiQnet IP connection over UDP and TCP.
+
+        :param udp_transport: asyncio datagram transport
+        :type udp_transport: asyncio.DatagramTransport
+        :param tcp_transport: asyncio stream transport
+        :type tcp_transport: asyncio.Transport
+        :param tcp_pool: Outbound TCP connections, used for guaranteed commands
+        :type tcp_pool: TCPConnectionPool
+        """
+        self.udp_transport = udp_transport
+        self.tcp_transport = tcp_transport
+        self.tcp_pool = tcp_pool
+
+    def sendto(self, command, destination='<broadcast>'):
+        """Send command to the destination.
+
+        :param command: Message to send
+        :type command: Command
+        :param destination: Destination IPv4 address or '<broadcast>'
+        :type destination: str
+        """
+        if command.flags.guaranteed:
+            # Send TCP message if the Guaranteed flag is set
+            if destination == '<broadcast>':
+                raise ValueError("Guaranteed commands can't be broadcasted")
+            self.tcp_pool.write(bytes(command), destination)
+        else:
+            self.udp_transport.sendto(bytes(command), (destination, PORT))
+
+    def write(self, data, destination='<broadcast>'):
+        """Send an already encoded command over UDP.
+
+        :param data: Binary command
+        :type data: bytes
+        :param destination: Destination IPv4 address or '<broadcast>'
+        :type destination: str
+        """
+        self.udp_transport.sendto(data, (destination, PORT))
+
+
+class TCPProtocol(asyncio.Protocol):
+    """HiQnet asyncio TCP protocol.
+
+    TCP is a stream: commands are split using the command length from their header.
+    """
+
+    name = "HiQnetTCP"
+    app = None
+    transport = None
+    _buffer = b''
+
+    def __init__(self, app):
+        self.app = app
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.app.tcp_transport = transport
+
+    def data_received(self, data):
+        """Called when data is received.
+
+        :param data: Received binary data
+        :type data: bytes
+        """
+        self._buffer += data
+        while len(self._buffer) >= MIN_HEADER_LEN:
+            length = struct.unpack_from('!L', self._buffer, 2)[0]
+            if length < MIN_HEADER_LEN:
+                # Garbage, we can't find the next command boundary
+                self._buffer = b''
+                self.transport.close()
+                break
+            if len(self._buffer) < length:
+                break
+            command, self._buffer = self._buffer[:length], self._buffer[length:]
+            self.command_received(command)
+
+    def command_received(self, data):
+        """Called when a complete command is received.
+
+        :param data: Received binary command
+        :type data: bytes
+        """
+        command = Command(command=data)
+        peer = self.transport.get_extra_info('peername')
+        self.app.handle_message(command, peer[0] if peer else None, self.name)
+
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    """HiQnet asyncio UDP protocol."""
+
+    name = "HiQnetUDP"
+    recent = None
+    """:type: hiqnet.service.duplicates.RecentBroadcasts"""
+
+    def __init__(self, app, recent=None, clock=None):
+        """Build the protocol.
+
+        :param app: Receives the commands through its handle_message method
+        :param recent: Broadcast duplicates filter
+        :type recent: hiqnet.service.duplicates.RecentBroadcasts
+        :param clock: Clock of the loop, for the default duplicates filter
+        :type clock: Clock
+        """
+        self.app = app
+        if recent is None:
+            recent = RecentBroadcasts(clock=clock if clock is not None else Clock())
+        self.recent = recent
+
+    def connection_made(self, transport):
+        # Some messages needs to be broadcasted
+        transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.app.udp_transport = transport
+
+    def datagram_received(self, data, addr):
+        """Called when data is received.
+
+        :param data: Received binary data
+        :type data: bytes
+        :param addr: IPv4 address and port of the sender
+        :type addr: tuple
+        """
+        if self.recent.drop(data):
+            return
+        command = Command(command=data)
+        self.app.handle_message(command, addr[0], self.name)
+
+
+class PooledConnection(object):
+    """Client connection to a remote device."""
+    host = None
+    pool = None
+    """:type: TCPConnectionPool"""
+    protocol = None
+    """:type: TCPProtocol"""
+    connecting = False
+    connects = 0
+    failures = 0
+    writes = 0
+    bytes_sent = 0
+    _buffer = None
+
+    def __init__(self, pool, host):
+        self.pool = pool
+        self.host = host
+        self._buffer = []
+
+    def write(self, data):
+        """Write or buffer data.
+
+        :param data: Binary command
+        :type data: bytes
+        """
+        self.writes += 1
+        self.bytes_sent += len(data)
+        if self.protocol is not None:
+            self.protocol.transport.write(data)
+            return
+        self._buffer.append(data)
+        if not self.connecting:
+            self.connecting = True
+            task = asyncio.ensure_future(self.pool.loop.create_connection(
+                lambda: _ClientProtocol(self.pool.app, self), self.host, self.pool.port), loop=self.pool.loop)
+            task.add_done_callback(self._connect_done)
+
+    def _connect_done(self, task):
+        self.connecting = False
+        if task.cancelled() or task.exception() is not None:
+            # No retry: buffered commands are lost, like datagrams would be
+            logger.warning("Connecting to %s failed, %d commands abandoned", self.host, len(self._buffer))
+            self.failures += 1
+            self.pool.abandoned += len(self._buffer)
+            self._buffer = []
+            self.pool.discard(self)
+
+    def connected(self, protocol):
+        self.protocol = protocol
+        self.connects += 1
+        if self._buffer:
+            protocol.transport.writelines(self._buffer)
+            self._buffer = []
+
+    def disconnected(self, protocol):
+        if self.protocol is protocol:
+            self.protocol = None
+            self.pool.discard(self)
+
+    def close(self):
+        """Close the connection and drop buffered commands."""
+        self._buffer = []
+        if self.protocol is not None:
+            self.protocol.transport.close()
+
+
+class _ClientProtocol(TCPProtocol):
+    name = "HiQnetTCPClient"
+
+    def __init__(self, app, peer):
+        TCPProtocol.__init__(self, app)
+        self.peer = peer
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer.connected(self)
+
+    def connection_lost(self, exc):
+        self.peer.disconnected(self)
+
+
+class TCPConnectionPool(object):
+    """Outbound TCP connections by remote host."""
+    app = None
+    """Receives the replies through its handle_message method"""
+    loop = None
+    port = PORT
+    connections = None
+    """:type: dict of PooledConnection by host"""
+    abandoned = 0
+    """Buffered commands abandoned because the connection failed"""
+
+    def __init__(self, app, port=PORT, loop=None):
+        """Build a pool.
+
+        :param app: Receives the replies through its handle_message method
+        :param port: Remote TCP port
+        :type port: int
+        :param loop: Defaults to the current event loop
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self.app = app
+        self.port = port
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.connections = {}
+
+    def write(self, data, host):
+        """Send data to a host, connecting if needed.
+
+        :param data: Binary command
+        :type data: bytes
+        :param host: Remote IPv4 address
+        :type host: str
+        """
+        connection = self.connections.get(host)
+        if connection is None:
+            connection = self.connections[host] = PooledConnection(self, host)
+        connection.write(data)
+
+    def discard(self, connection):
+        if self.connections.get(connection.host) is connection:
+            del self.connections[connection.host]
+
+    def close(self):
+        """Close every connection."""
+        for connection in list(self.connections.values()):
+            connection.close()
+        self.connections = {}
+
+
+def listen(app, port=PORT, interface='0.0.0.0', loop=None):
+    """Start listening to HiQnet over UDP and TCP.
+
+    :param app: Receives the commands through its handle_message method
+    :param port: UDP and TCP port
+    :type port: int
+    :param interface: Local IPv4 address to bind
+    :type interface: str
+    :param loop: Defaults to the current event loop
+    :type loop: asyncio.AbstractEventLoop
+    :return: The UDP transport and the TCP server
+    :rtype: tuple
+    """
+    loop = loop if loop is not None else asyncio.get_event_loop()
+    clock = Clock(loop)
+    udp_transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: UDPProtocol(app, clock=clock), local_addr=(interface, port)))
+    server = loop.run_until_complete(loop.create_server(lambda: TCPProtocol(app), interface, port))
+    return udp_transport, server
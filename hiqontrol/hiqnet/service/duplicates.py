@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""HiQnet broadcast duplicates suppression.
+
+On multi interfaces or bridged networks, the same broadcast command may reach us more than once.
+Recently received broadcasts are remembered by (source address, message ID, sequence number),
+read straight from the header so duplicates are dropped before decoding the payload.
+
+- The cache holds a fixed number of entries, the oldest ones are evicted first.
+  Memory stays bounded under broadcast storms.
+- Entries expire after `max_age` so a rebooted device reusing sequence numbers is heard again.
+- Broadcasts whose hop count is exhausted are dropped.
+
+Unicast commands are not filtered: retransmissions of unacknowledged commands
+and direct replies with no hop left must get through.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import collections
+import struct
+
+from ..protocol import MIN_HEADER_LEN
+
+DEFAULT_SIZE = 1024
+DEFAULT_MAX_AGE = 2.0  # s
+BROADCAST_DEVICE = b'\xff\xff'
+
+
+class RecentBroadcasts(object):
+    """Fixed size cache of recently received broadcast commands."""
+    size = DEFAULT_SIZE
+    max_age = DEFAULT_MAX_AGE
+    """Time in seconds during which a repeated command is a duplicate"""
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    duplicates = 0
+    """Dropped duplicates"""
+    expired = 0
+    """Dropped broadcasts with no hop left"""
+    evicted = 0
+    """Entries forgotten before their expiry to make room"""
+    _entries = None
+
+    def __init__(self, size=DEFAULT_SIZE, max_age=DEFAULT_MAX_AGE, clock=None):
+        """Build a cache.
+
+        :param size: Maximum number of remembered commands
+        :type size: int
+        :param max_age: Time in seconds during which a repeated command is a duplicate
+        :type max_age: float
+        :param clock: Time source. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self.size = size
+        self.max_age = max_age
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def drop(self, data):
+        """Tell whether a received command should be dropped.
+
+        :param data: Received binary command
+        :type data: bytes
+        :rtype: bool
+        """
+        if len(data) < MIN_HEADER_LEN:
+            # Let the decoder complain
+            return False
+        if data[12:14] != BROADCAST_DEVICE:
+            return False
+        if not struct.unpack_from('!B', data, 22)[0]:
+            self.expired += 1
+            return True
+        # Source address, message ID and sequence number
+        key = data[6:12] + data[18:20] + data[23:25]
+        now = self.clock.seconds()
+        entries = self._entries
+        # Entries are in arrival order, expire from the oldest
+        while entries:
+            oldest = next(iter(entries))
+            if now - entries[oldest] <= self.max_age:
+                break
+            del entries[oldest]
+        if key in entries:
+            self.duplicates += 1
+            return True
+        if len(entries) >= self.size:
+            entries.popitem(last=False)
+            self.evicted += 1
+        entries[key] = now
+        return False
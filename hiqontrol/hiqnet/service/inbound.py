@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""Bounded inbound queues.
+
+Incoming messages are queued by class as received, before decoding,
+each class with its own capacity and overflow policy:
+
++------------+-------------------------------------------+----------+-------------+
+| Class      | Messages                                  | Capacity | Policy      |
++============+===========================================+==========+=============+
+| control    | Replies and everything else               | 1024     | drop-oldest |
++------------+-------------------------------------------+----------+-------------+
+| discovery  | DISCOINFO, REQADDR, ADDRUSED              | 256      | drop-newest |
++------------+-------------------------------------------+----------+-------------+
+| parameters | MULTPARMSET, PARMSETPCT notifications     | 4096     | coalesce    |
++------------+-------------------------------------------+----------+-------------+
+| meters     | Soundcraft VU meters                      | 64       | coalesce    |
++------------+-------------------------------------------+----------+-------------+
+
+Policies:
+
+- drop-oldest: a full queue drops its oldest message to make room
+- drop-newest: a full queue refuses the new message
+- coalesce: a message replaces the queued one with the same key, in place.
+  A full queue drops its oldest message for a new key.
+  Parameters notifications are keyed by source and parameter IDs, meters by sender.
+
+Messages are classified from their message ID and keyed from their payload without decoding them,
+so a storm costs a few slicing operations per message and no more than the queues capacity in memory.
+
+Messages are popped by class priority, in the table order, so a meters flood or a broadcast storm
+can't delay control replies.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import collections
+import struct
+
+from .. import datatypes
+from ..protocol import Message
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce'
+
+CONTROL = 'control'
+DISCOVERY = 'discovery'
+PARAMETERS = 'parameters'
+METERS = 'meters'
+
+DISCOVERY_MESSAGES = frozenset(['DISCOINFO', 'REQADDR', 'ADDRUSED'])
+PARAMETERS_MESSAGES = frozenset(['MULTPARMSET', 'PARMSETPCT'])
+
+_CLASSES = {}
+for _name in DISCOVERY_MESSAGES:
+    _CLASSES[Message.MESSAGES[_name]] = DISCOVERY
+for _name in PARAMETERS_MESSAGES:
+    _CLASSES[Message.MESSAGES[_name]] = PARAMETERS
+del _name
+_PARMSETPCT = Message.MESSAGES['PARMSETPCT']
+_UBYTE = struct.Struct('!B')
+_UWORD = struct.Struct('!H')
+
+
+def classify(data):
+    """Find the class of a binary command.
+
+    :param data: Binary command
+    :type data: bytes
+    :rtype: str
+    """
+    return _CLASSES.get(bytes(data[18:20]), CONTROL)
+
+
+def parameters_key(item):
+    """Coalescing key of a binary parameters notification.
+
+    :param item: Binary command, host and protocol name
+    :type item: tuple
+    :return: Source address, message ID and parameter IDs. None when the notification can't be coalesced.
+    """
+    data = item[0]
+    try:
+        index = _UBYTE.unpack_from(data, 1)[0]
+        count = _UWORD.unpack_from(data, index)[0]
+        index += _UWORD.size
+        if data[18:20] == _PARMSETPCT:
+            parameter_ids = struct.unpack_from('!' + 'H2x' * count, data, index)
+        else:
+            parameter_ids = []
+            for _ in range(count):
+                parameter_ids.append(_UWORD.unpack_from(data, index)[0])
+                data_type = _UBYTE.unpack_from(data, index + 2)[0]
+                index += 3
+                if data_type in datatypes.STRUCTS:
+                    index += datatypes.STRUCTS[data_type].size
+                elif data_type in (datatypes.STRING, datatypes.BLOCK):
+                    index += _UWORD.size + _UWORD.unpack_from(data, index)[0]
+                else:
+                    return None
+    except struct.error:
+        # Truncated, let the decoder complain
+        return None
+    return bytes(data[6:12]), bytes(data[18:20]), tuple(parameter_ids)
+
+
+def meters_key(item):
+    """Coalescing key of a VU meters message.
+
+    :param item: Message, host and protocol name
+    :type item: tuple
+    """
+    return item[1]
+
+
+class BoundedQueue(object):
+    """A queue with a capacity and an overflow policy."""
+    name = None
+    capacity = None
+    policy = DROP_OLDEST
+    key = None
+    """Coalescing key function, called with the queued item"""
+    pushed = 0
+    dropped = 0
+    coalesced = 0
+    high_water = 0
+    _items = None
+
+    def __init__(self, name, capacity, policy=DROP_OLDEST, key=None):
+        """Build a queue.
+
+        :param name: Class name
+        :type name: str
+        :param capacity: Maximum number of queued items
+        :type capacity: int
+        :param policy: DROP_OLDEST, DROP_NEWEST or COALESCE
+        :type policy: str
+        :param key: Coalescing key function, required by COALESCE.
+                    Items whose key is None are never coalesced.
+        :type key: callable
+        """
+        if policy not in (DROP_OLDEST, DROP_NEWEST, COALESCE):
+            raise ValueError("Unknown policy: " + str(policy))
+        if policy == COALESCE and key is None:
+            raise ValueError("Coalescing requires a key")
+        self.name = name
+        self.capacity = capacity
+        self.policy = policy
+        self.key = key
+        if policy == COALESCE:
+            self._items = collections.OrderedDict()
+        else:
+            self._items = collections.deque()
+
+    def __len__(self):
+        return len(self._items)
+
+    def push(self, item):
+        """Queue an item.
+
+        :return: Whether the item was queued
+        :rtype: bool
+        """
+        self.pushed += 1
+        items = self._items
+        if self.policy == COALESCE:
+            key = self.key(item)
+            if key is None:
+                # Unique key
+                key = object()
+            elif key in items:
+                items[key] = item
+                self.coalesced += 1
+                return True
+            if len(items) >= self.capacity:
+                items.popitem(last=False)
+                self.dropped += 1
+            items[key] = item
+        else:
+            if len(items) >= self.capacity:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return False
+                items.popleft()
+            items.append(item)
+        if len(items) > self.high_water:
+            self.high_water = len(items)
+        return True
+
+    def pop(self):
+        """Remove and return the oldest item.
+
+        :raises IndexError: When empty
+        """
+        if self.policy == COALESCE:
+            try:
+                return self._items.popitem(last=False)[1]
+            except KeyError:
+                raise IndexError("pop from an empty queue")
+        return self._items.popleft()
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self):
+        """Queue counters.
+
+        :rtype: dict
+        """
+        return {
+            'depth': len(self._items),
+            'high_water': self.high_water,
+            'capacity': self.capacity,
+            'policy': self.policy,
+            'pushed': self.pushed,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+        }
+
+
+def default_queues():
+    """Build the default queues, by priority.
+
+    :rtype: list of BoundedQueue
+    """
+    return [
+        BoundedQueue(CONTROL, 1024, DROP_OLDEST),
+        BoundedQueue(DISCOVERY, 256, DROP_NEWEST),
+        BoundedQueue(PARAMETERS, 4096, COALESCE, parameters_key),
+        BoundedQueue(METERS, 64, COALESCE, meters_key),
+    ]
+
+
+class InboundQueues(object):
+    """Incoming messages queued by class."""
+    queues = None
+    """:type: list of BoundedQueue by priority"""
+    _by_class = None
+
+    def __init__(self, queues=None):
+        """Build the queues.
+
+        :param queues: Queues by priority, one for each class. Defaults to default_queues().
+        :type queues: list of BoundedQueue
+        """
+        if queues is None:
+            queues = default_queues()
+        self.queues = queues
+        self._by_class = dict((queue.name, queue) for queue in queues)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def __getitem__(self, name):
+        return self._by_class[name]
+
+    def push(self, message, host, protocol_name, message_class=None):
+        """Queue a message in its class queue.
+
+        :param message: Binary HiQnet command, or Soundcraft VU meters
+        :type message: bytes
+        :param host: Sender IPv4 address
+        :type host: str
+        :param protocol_name: Protocol that received
+        :type protocol_name: str
+        :param message_class: Class of the message. Classified from the command message ID by default.
+        :type message_class: str
+        :return: Whether the message was queued
+        :rtype: bool
+        """
+        if message_class is None:
+            message_class = classify(message)
+        return self._by_class[message_class].push((message, host, protocol_name))
+
+    def pop(self):
+        """Remove and return the next message by priority.
+
+        :return: Message, host, protocol name and class
+        :rtype: tuple
+        :raises IndexError: When all the queues are empty
+        """
+        for queue in self.queues:
+            if queue:
+                return queue.pop() + (queue.name,)
+        raise IndexError("pop from empty queues")
+
+    def clear(self):
+        for queue in self.queues:
+            queue.clear()
+
+    def stats(self):
+        """Counters.
+
+        :return: Queue counters by class
+        :rtype: dict
+        """
+        return dict((queue.name, queue.stats()) for queue in self.queues)
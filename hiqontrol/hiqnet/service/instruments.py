@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""Hot path instrumentation.
+
+Tells whether latency comes from the network, the reactor or the UI:
+
+- reactor lag: how late a timer fires, sampled every `lag_interval`
+- stages timings, as histograms:
+
+  - receive: from a datagram or a command read to its hand off, debugging output included
+  - decode: binary to :class:`hiqnet.protocol.Command`
+  - dispatch: the app handling a message
+  - store: notifications applied to the parameters store
+  - ui: the UI update for a message
+  - send: encoding and writing a command
+
+- received and sent messages counters by message type
+- gauges, such as queue depths, sampled when taking a snapshot
+
+Histograms have power of two microseconds buckets, so recording is a few integer operations.
+The decode stage is recorded from the decoding thread; counts may be off by a few under contention.
+
+:meth:`Instruments.snapshot` returns everything as a dict.
+:meth:`Instruments.start` samples the lag and dumps the snapshot as JSON to a local file every `dump_interval`.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import json
+import os
+import time
+
+from timeit import default_timer
+
+RECEIVE = 'receive'
+DECODE = 'decode'
+DISPATCH = 'dispatch'
+STORE = 'store'
+UI = 'ui'
+SEND = 'send'
+LOOP_LAG = 'loop_lag'
+
+STAGES = (RECEIVE, DECODE, DISPATCH, STORE, UI, SEND, LOOP_LAG)
+
+BUCKETS = 32
+"""Up to 2^31 µs, about 36 minutes"""
+DEFAULT_LAG_INTERVAL = 0.1  # s
+DEFAULT_DUMP_INTERVAL = 10.0  # s
+
+
+class Histogram(object):
+    """Durations distribution, in power of two microseconds buckets."""
+    buckets = None
+    """Bucket n counts durations from 2^(n-1) to 2^n µs"""
+    count = 0
+    total = 0.0
+    maximum = 0.0
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+
+    def record(self, duration):
+        """Add a duration.
+
+        :param duration: Seconds
+        :type duration: float
+        """
+        self.buckets[min(int(duration * 1000000).bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.maximum:
+            self.maximum = duration
+
+    def percentile(self, fraction):
+        """Estimate a percentile.
+
+        :param fraction: 0.5 for the median
+        :type fraction: float
+        :return: Upper bound of the bucket holding it, in seconds
+        :rtype: float
+        """
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << index) / 1000000.0, self.maximum)
+        return self.maximum
+
+    def reset(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def summary(self):
+        """Durations in seconds.
+
+        :rtype: dict
+        """
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.maximum,
+            'buckets_us': dict((1 << index, count) for index, count in enumerate(self.buckets) if count),
+        }
+
+
+class Instruments(object):
+    """Timings, counters and gauges of the hot path."""
+    histograms = None
+    """:type: dict of Histogram by stage"""
+    received = None
+    """Received messages by type"""
+    sent = None
+    """Sent messages by type"""
+    gauges = None
+    """Callables by name, returning a number"""
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    lag_interval = DEFAULT_LAG_INTERVAL
+    dump_interval = DEFAULT_DUMP_INTERVAL
+    path = None
+    """Dump file"""
+    started = None
+    dumps = 0
+    _lag_timer = None
+    _lag_expected = None
+    _dump_timer = None
+
+    timer = staticmethod(default_timer)
+    """Current time in seconds, for durations"""
+
+    def __init__(self, clock=None):
+        """Build the instruments.
+
+        :param clock: Scheduler. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.histograms = dict((stage, Histogram()) for stage in STAGES)
+        self.received = {}
+        self.sent = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def record(self, stage, duration):
+        """Add a stage duration.
+
+        :param stage: A stage, such as DECODE
+        :type stage: str
+        :param duration: Seconds
+        :type duration: float
+        """
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.record(duration)
+
+    def lap(self, stage, since):
+        """Record a stage that started at since.
+
+        :param stage: A stage, such as DECODE
+        :type stage: str
+        :param since: The stage start, from timer()
+        :type since: float
+        :return: Now, the start of the next stage
+        :rtype: float
+        """
+        now = default_timer()
+        self.record(stage, now - since)
+        return now
+
+    def count_received(self, message_type):
+        """Count a received message.
+
+        :param message_type: Message name, such as 'MULTPARMSET'
+        :type message_type: str
+        """
+        self.received[message_type] = self.received.get(message_type, 0) + 1
+
+    def count_sent(self, message_type):
+        """Count a sent message.
+
+        :param message_type: Message name, such as 'MULTPARMSET'
+        :type message_type: str
+        """
+        self.sent[message_type] = self.sent.get(message_type, 0) + 1
+
+    def add_gauge(self, name, gauge):
+        """Sample a value in the snapshots, such as a queue depth.
+
+        :param name: Gauge name
+        :type name: str
+        :param gauge: Returns the current value
+        :type gauge: callable
+        """
+        self.gauges[name] = gauge
+
+    def remove_gauge(self, name):
+        self.gauges.pop(name, None)
+
+    def start(self, path=None, lag_interval=DEFAULT_LAG_INTERVAL, dump_interval=DEFAULT_DUMP_INTERVAL):
+        """Start sampling the reactor lag and dumping the snapshots.
+
+        :param path: JSON dump file. No dump by default.
+        :type path: str
+        :param lag_interval: Time between lag samples in seconds
+        :type lag_interval: float
+        :param dump_interval: Time between dumps in seconds
+        :type dump_interval: float
+        """
+        self.stop()
+        self.path = path
+        self.lag_interval = lag_interval
+        self.dump_interval = dump_interval
+        self._schedule_lag()
+        if path is not None:
+            self._dump_timer = self.clock.callLater(dump_interval, self._dump)
+
+    def stop(self):
+        """Stop sampling and dumping."""
+        for timer in (self._lag_timer, self._dump_timer):
+            if timer is not None and timer.active():
+                timer.cancel()
+        self._lag_timer = None
+        self._dump_timer = None
+
+    def _schedule_lag(self):
+        self._lag_expected = default_timer() + self.lag_interval
+        self._lag_timer = self.clock.callLater(self.lag_interval, self._sample_lag)
+
+    def _sample_lag(self):
+        self.record(LOOP_LAG, max(default_timer() - self._lag_expected, 0.0))
+        self._schedule_lag()
+
+    def _dump(self):
+        self._dump_timer = self.clock.callLater(self.dump_interval, self._dump)
+        try:
+            self.dump(self.path)
+        except (IOError, OSError) as error:
+            print("Instruments dump to %s failed: %s" % (self.path, error))
+
+    def dump(self, path):
+        """Write a snapshot as JSON, replacing the file at once.
+
+        :param path: Dump file
+        :type path: str
+        """
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as dump:
+            json.dump(self.snapshot(), dump, indent=2, sort_keys=True)
+        os.rename(temporary, path)
+        self.dumps += 1
+
+    def snapshot(self):
+        """Everything measured so far.
+
+        :rtype: dict
+        """
+        gauges = {}
+        for name, gauge in list(self.gauges.items()):
+            try:
+                gauges[name] = gauge()
+            except Exception as error:
+                gauges[name] = repr(error)
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'stages': dict((stage, histogram.summary()) for stage, histogram in list(self.histograms.items())),
+            'received': dict(self.received),
+            'sent': dict(self.sent),
+            'gauges': gauges,
+        }
+
+    def reset(self):
+        """Start measuring over. Gauges are kept."""
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.received = {}
+        self.sent = {}
+        self.started = time.time()
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""HiQnet over several network interfaces.
+
+A show computer may sit on a wired console network and a Wi-Fi tablets network at the same time.
+
+- Each selected interface gets its own UDP socket, bound to its IPv4 address.
+  Broadcasts are sent on every interface to its directed broadcast address
+  since '<broadcast>' (255.255.255.255) only leaves through the default route.
+- Unicast commands leave through the interface whose subnet holds the destination,
+  looked up in a subnet table built once, longest prefix first.
+  Destinations outside of every subnet use the main socket and the system routing.
+- Traffic is counted by interface.
+
+The per interface sockets use an ephemeral port since the main socket already holds the HiQnet port
+on every address. They are mostly for sending: bound to a unicast address, they don't receive
+broadcasts on Linux. Devices answering to the HiQnet port or by broadcast reach the main socket,
+devices answering to the source port reach the interface socket. Both are handled the same,
+and received traffic is counted against the interface whose subnet holds the sender.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import collections
+import socket
+import struct
+
+from ..networkinfo import IPNetworkInfo
+from .instruments import SEND
+from .ip import Connection, PORT, UDPProtocol
+
+DEFAULT_CACHE_SIZE = 1024
+"""Routed addresses remembered"""
+
+
+def _address(ip_address):
+    """IPv4 address as an integer.
+
+    :param ip_address: Dotted IPv4 address
+    :type ip_address: str
+    :rtype: int
+    """
+    return struct.unpack('!L', socket.inet_aton(ip_address))[0]
+
+
+class Interface(object):
+    """A local network interface and its traffic."""
+    name = None
+    network_info = None
+    """:type: hiqnet.networkinfo.IPNetworkInfo"""
+    network = None
+    """Network address as an integer"""
+    netmask = None
+    """Network mask as an integer"""
+    broadcast_address = None
+    """Directed broadcast address"""
+    transport = None
+    """:type: twisted.internet.interfaces.IUDPTransport"""
+    packets_sent = 0
+    bytes_sent = 0
+    packets_received = 0
+    bytes_received = 0
+
+    def __init__(self, name, network_info):
+        """Build an interface.
+
+        :param name: Interface name
+        :type name: str
+        :param network_info: IPv4 configuration of the interface
+        :type network_info: hiqnet.networkinfo.IPNetworkInfo
+        """
+        self.name = name
+        self.network_info = network_info
+        self.netmask = _address(network_info.subnet_mask)
+        self.network = _address(network_info.ip_address) & self.netmask
+        self.broadcast_address = network_info.broadcast_address
+
+    @property
+    def ip_address(self):
+        """:rtype: str"""
+        return self.network_info.ip_address
+
+    @property
+    def prefix_length(self):
+        """:rtype: int"""
+        return bin(self.netmask).count('1')
+
+    def contains(self, address):
+        """Tell whether an address is on the interface subnet.
+
+        :param address: IPv4 address as an integer
+        :type address: int
+        :rtype: bool
+        """
+        return address & self.netmask == self.network
+
+    def write(self, data, destination):
+        """Send data through this interface.
+
+        :param data: Binary command
+        :type data: bytes
+        :param destination: Destination IPv4 address
+        :type destination: str
+        """
+        self.packets_sent += 1
+        self.bytes_sent += len(data)
+        self.transport.write(data, (destination, PORT))
+
+    def stats(self):
+        """Traffic counters.
+
+        :rtype: dict
+        """
+        return {
+            'packets_sent': self.packets_sent,
+            'bytes_sent': self.bytes_sent,
+            'packets_received': self.packets_received,
+            'bytes_received': self.bytes_received,
+        }
+
+
+class SubnetTable(object):
+    """Local interfaces by subnet."""
+    interfaces = None
+    """:type: list of Interface"""
+    _routes = None
+    """Interfaces, longest prefix first"""
+    cache_size = DEFAULT_CACHE_SIZE
+    _cache = None
+    """Routed interface by destination, oldest first"""
+
+    def __init__(self, interfaces, cache_size=DEFAULT_CACHE_SIZE):
+        """Build the table.
+
+        :param interfaces: Local interfaces
+        :type interfaces: list of Interface
+        :param cache_size: Routed addresses remembered
+        :type cache_size: int
+        """
+        self.interfaces = list(interfaces)
+        self._routes = sorted(self.interfaces, key=lambda interface: -interface.prefix_length)
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    def __iter__(self):
+        return iter(self.interfaces)
+
+    def __len__(self):
+        return len(self.interfaces)
+
+    def route(self, ip_address):
+        """Find the interface to reach an address.
+
+        :param ip_address: Destination IPv4 address
+        :type ip_address: str
+        :return: None when no local subnet holds the address
+        :rtype: Interface
+        """
+        try:
+            return self._cache[ip_address]
+        except KeyError:
+            pass
+        address = _address(ip_address)
+        found = None
+        for interface in self._routes:
+            if interface.contains(address):
+                found = interface
+                break
+        if len(self._cache) >= self.cache_size:
+            self._cache.popitem(last=False)
+        self._cache[ip_address] = found
+        return found
+
+    def received(self, ip_address, size):
+        """Count data received from an address.
+
+        :param ip_address: Sender IPv4 address
+        :type ip_address: str
+        :param size: Received bytes
+        :type size: int
+        """
+        interface = self.route(ip_address)
+        if interface is not None:
+            interface.packets_received += 1
+            interface.bytes_received += size
+
+    def stats(self):
+        """Traffic counters.
+
+        :return: Counters by interface name
+        :rtype: dict
+        """
+        return dict((interface.name, interface.stats()) for interface in self.interfaces)
+
+
+class InterfaceUDPProtocol(UDPProtocol):
+    """HiQnet Twisted UDP protocol bound to one interface."""
+
+    interface = None
+    """:type: Interface"""
+
+    def __init__(self, app, interface, interfaces, recent=None, pipeline=None, instruments=None):
+        """Build the protocol.
+
+        :param app: Receives the commands through its handle_message method
+        :param interface: The interface whose socket this is
+        :type interface: Interface
+        :param interfaces: Local interfaces, counting the received traffic
+        :type interfaces: SubnetTable
+        :param recent: Broadcast duplicates filter, best shared with the main socket
+        :type recent: hiqnet.service.duplicates.RecentBroadcasts
+        :param pipeline: Decodes the commands off the reactor
+        :type pipeline: hiqnet.service.pipeline.DecodePipeline
+        :param instruments: Times and counts the received commands
+        :type instruments: hiqnet.service.instruments.Instruments
+        """
+        UDPProtocol.__init__(self, app, recent, interfaces, pipeline, instruments)
+        self.interface = interface
+        self.name = "HiQnetUDP(%s)" % interface.name
+
+    def startProtocol(self):
+        """Called after protocol started listening."""
+        self.transport.setBroadcastAllowed(True)
+        self.interface.transport = self.transport
+
+
+class MultiConnection(Connection):
+    """Handles HiQnet IP connection over several interfaces."""
+    interfaces = None
+    """:type: SubnetTable"""
+
+    def __init__(self, interfaces, udp_transport, tcp_transport, tcp_pool=None, instruments=None):
+        """Initiate a HiQnet IP connection over UDP and TCP.
+
+        :param interfaces: Local interfaces, listening
+        :type interfaces: SubnetTable
+        :param udp_transport: Main Twisted UDP transport, for destinations outside of the local subnets
+        :type udp_transport: twisted.internet.interfaces.IUDPTransport
+        :param tcp_transport: Twisted TCP transport
+        :type tcp_transport: twisted.internet.interfaces.ITCPTransport
+        :param tcp_pool: Outbound TCP connections, used for guaranteed commands
+        :type tcp_pool: hiqnet.service.pool.TCPConnectionPool
+        :param instruments: Times and counts the sent commands
+        :type instruments: hiqnet.service.instruments.Instruments
+        """
+        super(MultiConnection, self).__init__(udp_transport, tcp_transport, tcp_pool, instruments)
+        self.interfaces = interfaces
+
+    def sendto(self, command, destination='<broadcast>', data=None):
+        """Send command to the destination.
+
+        :param command: Message to send
+        :type command: hiqnet.protocol.Command
+        :param destination: Destination IPv4 address or '<broadcast>'
+        :type destination: str
+        :param data: The command already encoded. Encoded from the command by default.
+        :type data: bytes
+        """
+        if command.flags.guaranteed:
+            super(MultiConnection, self).sendto(command, destination, data)
+            return
+        instruments = self.instruments
+        if instruments is not None:
+            started = instruments.timer()
+        if data is None:
+            # noinspection PyArgumentList
+            data = bytes(command)
+        self.write(data, destination)
+        if instruments is not None:
+            instruments.lap(SEND, started)
+            instruments.count_sent(command.message.name)
+
+    def write(self, data, destination='<broadcast>'):
+        """Send an already encoded command over UDP.
+
+        :param data: Binary command
+        :type data: bytes
+        :param destination: Destination IPv4 address or '<broadcast>'
+        :type destination: str
+        """
+        if destination == '<broadcast>':
+            if not len(self.interfaces):
+                # No interface detected, let the main socket broadcast
+                self.udp_transport.write(data, (destination, PORT))
+                return
+            for interface in self.interfaces:
+                interface.write(data, interface.broadcast_address)
+            return
+        interface = self.interfaces.route(destination)
+        if interface is None:
+            self.udp_transport.write(data, (destination, PORT))
+        else:
+            interface.write(data, destination)
+
+
+def listen(app, names=None, recent=None, pipeline=None, reactor=None, instruments=None):
+    """Bind a UDP socket on each selected interface.
+
+    :param app: Receives the commands through its handle_message method
+    :param names: Interfaces names. Defaults to every interface with an IPv4 address but loopback.
+    :type names: list of str
+    :param recent: Broadcast duplicates filter, best shared with the main socket
+    :type recent: hiqnet.service.duplicates.RecentBroadcasts
+    :param pipeline: Decodes the commands off the reactor
+    :type pipeline: hiqnet.service.pipeline.DecodePipeline
+    :param reactor: Defaults to the global reactor
+    :type reactor: twisted.internet.interfaces.IReactorUDP
+    :param instruments: Times and counts the received commands
+    :type instruments: hiqnet.service.instruments.Instruments
+    :rtype: SubnetTable
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    if names is None:
+        names = IPNetworkInfo.interfaces()
+    table = SubnetTable([Interface(name, IPNetworkInfo.autodetect(name)) for name in names])
+    for interface in table:
+        reactor.listenUDP(0, InterfaceUDPProtocol(app, interface, table, recent, pipeline, instruments),
+                          interface=interface.ip_address)
+    return table
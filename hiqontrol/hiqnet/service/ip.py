@@ -6,11 +6,13 @@ from __future__ import print_function
 __author__ = 'Raphaël Doursenaud'
 
 import binascii
-from twisted.internet import protocol
+import struct
 
-from ..protocol import Command
+from twisted.internet import protocol
 
-PORT = 3804  # IANA declared as IQnet. Go figure.
+from ..protocol import Command, MIN_HEADER_LEN, PORT
+from .duplicates import RecentBroadcasts
+from .instruments import DECODE, DISPATCH, RECEIVE, SEND
 
 
 class Connection(object):
@@ -20,43 +22,78 @@ class Connection(object):
     """
     udp_transport = None
     tcp_transport = None
+    tcp_pool = None
+    """:type: hiqnet.service.pool.TCPConnectionPool"""
+    instruments = None
+    """:type: hiqnet.service.instruments.Instruments"""
 
-    def __init__(self, udp_transport, tcp_transport):
+    def __init__(self, udp_transport, tcp_transport, tcp_pool=None, instruments=None):
         """Initiate a HiQnet IP connection over UDP and TCP.
 
         :param udp_transport: Twisted UDP transport
         :type udp_transport: twisted.internet.interfaces.IUDPTransport
         :param tcp_transport: Twisted TCP transport
         :type tcp_transport: twisted.internet.interfaces.ITCPTransport
+        :param tcp_pool: Outbound TCP connections, used for guaranteed commands
+        :type tcp_pool: hiqnet.service.pool.TCPConnectionPool
+        :param instruments: Times and counts the sent commands
+        :type instruments: hiqnet.service.instruments.Instruments
         :return:
         """
         self.udp_transport = udp_transport
         self.tcp_transport = tcp_transport
+        self.tcp_pool = tcp_pool
+        self.instruments = instruments
 
-    def sendto(self, command, destination='<broadcast>'):
+    def sendto(self, command, destination='<broadcast>', data=None):
         """Send command to the destination.
 
         :param command: Message to send
         :type command: Command
         :param destination: Destination IPv4 address or '<broadcast>'
         :type destination: str
+        :param data: The command already encoded. Encoded from the command by default.
+        :type data: bytes
         """
+        instruments = self.instruments
+        if instruments is not None:
+            started = instruments.timer()
+        if data is None:
+            # noinspection PyArgumentList
+            data = bytes(command)
         if command.flags.guaranteed:
             # Send TCP message if the Guaranteed flag is set
-            # noinspection PyArgumentList
-            self.tcp_transport.write(bytes(command), (destination, PORT))
+            if destination == '<broadcast>':
+                raise ValueError("Guaranteed commands can't be broadcasted")
+            self.tcp_pool.write(data, destination)
         else:
-            # noinspection PyArgumentList
-            self.udp_transport.write(bytes(command), (destination, PORT))
+            self.udp_transport.write(data, (destination, PORT))
+        if instruments is not None:
+            instruments.lap(SEND, started)
+            instruments.count_sent(command.message.name)
         print("=>")  # DEBUG
         print(vars(command))  # DEBUG
 
+    def write(self, data, destination='<broadcast>'):
+        """Send an already encoded command over UDP.
+
+        :param data: Binary command
+        :type data: bytes
+        :param destination: Destination IPv4 address or '<broadcast>'
+        :type destination: str
+        """
+        self.udp_transport.write(data, (destination, PORT))
+
 
 # noinspection PyClassHasNoInit
 class TCPProtocol(protocol.Protocol):
-    """HiQnet Twisted TCP protocol."""
+    """HiQnet Twisted TCP protocol.
+
+    TCP is a stream: commands are split using the command length from their header.
+    """
 
     name = "HiQnetTCP"
+    _buffer = b''
 
     # noinspection PyPep8Naming
     def startProtocol(self):
@@ -69,24 +106,86 @@ class TCPProtocol(protocol.Protocol):
         :param data: Received binary data
         :type data: bytearray
         """
+        self._buffer += data
+        while len(self._buffer) >= MIN_HEADER_LEN:
+            length = struct.unpack_from('!L', self._buffer, 2)[0]
+            if length < MIN_HEADER_LEN:
+                # Garbage, we can't find the next command boundary
+                self._buffer = b''
+                self.transport.loseConnection()
+                break
+            if len(self._buffer) < length:
+                break
+            command, self._buffer = self._buffer[:length], self._buffer[length:]
+            self.commandReceived(command)
+
+    # noinspection PyPep8Naming
+    def commandReceived(self, data):
+        """Called when a complete command is received.
+
+        :param data: Received binary command
+        :type data: bytearray
+        """
+        instruments = self.factory.instruments
+        if instruments is not None:
+            started = instruments.timer()
         # FIXME: debugging output should go into a logger
         print("<=")
         print(self.name + " data:")
         print(binascii.hexlify(data))
+        host = self.transport.getPeer().host if self.transport else None
+        if self.factory.pipeline is not None:
+            self.factory.pipeline.submit(data, host, self.name)
+            if instruments is not None:
+                instruments.lap(RECEIVE, started)
+            return
+        if instruments is not None:
+            started = instruments.lap(RECEIVE, started)
         command = Command(command=data)
+        if instruments is not None:
+            started = instruments.lap(DECODE, started)
+            instruments.count_received(command.message.name)
         print(vars(command))  # DEBUG
 
         # TODO: Process some more :)
-        self.factory.app.handle_message(command, None, self.name)
+        self.factory.app.handle_message(command, host, self.name)
+        if instruments is not None:
+            instruments.lap(DISPATCH, started)
 
 
 class UDPProtocol(protocol.DatagramProtocol):
     """HiQnet Twisted UDP protocol."""
 
     name = "HiQnetUDP"
-
-    def __init__(self, app):
+    recent = None
+    """:type: hiqnet.service.duplicates.RecentBroadcasts"""
+    interfaces = None
+    """:type: hiqnet.service.interfaces.SubnetTable"""
+    pipeline = None
+    """:type: hiqnet.service.pipeline.DecodePipeline"""
+    instruments = None
+    """:type: hiqnet.service.instruments.Instruments"""
+
+    def __init__(self, app, recent=None, interfaces=None, pipeline=None, instruments=None):
+        """Build the protocol.
+
+        :param app: Receives the commands through its handle_message method
+        :param recent: Broadcast duplicates filter
+        :type recent: hiqnet.service.duplicates.RecentBroadcasts
+        :param interfaces: Local interfaces, counting the received traffic
+        :type interfaces: hiqnet.service.interfaces.SubnetTable
+        :param pipeline: Decodes the commands off the reactor. Decoded in place by default.
+        :type pipeline: hiqnet.service.pipeline.DecodePipeline
+        :param instruments: Times and counts the received commands
+        :type instruments: hiqnet.service.instruments.Instruments
+        """
         self.app = app
+        if recent is None:
+            recent = RecentBroadcasts()
+        self.recent = recent
+        self.interfaces = interfaces
+        self.pipeline = pipeline
+        self.instruments = instruments
 
     def startProtocol(self):
         """Called after protocol started listening."""
@@ -102,6 +201,15 @@ class UDPProtocol(protocol.DatagramProtocol):
         :type addr: tuple
         """
         (host, port) = addr
+        instruments = self.instruments
+        if instruments is not None:
+            started = instruments.timer()
+
+        if self.interfaces is not None:
+            self.interfaces.received(host, len(data))
+
+        if self.recent.drop(data):
+            return
 
         # FIXME: debugging output should go into a logger
         print("<=")
@@ -111,17 +219,35 @@ class UDPProtocol(protocol.DatagramProtocol):
         print(host, end="")
         print(":", end="")
         print(port)
+        if self.pipeline is not None:
+            self.pipeline.submit(data, host, self.name)
+            if instruments is not None:
+                instruments.lap(RECEIVE, started)
+            return
+        if instruments is not None:
+            started = instruments.lap(RECEIVE, started)
         command = Command(command=data)
+        if instruments is not None:
+            started = instruments.lap(DECODE, started)
+            instruments.count_received(command.message.name)
         print(vars(command))  # DEBUG
 
         # TODO: Process some more :)
         self.app.handle_message(command, host, self.name)
+        if instruments is not None:
+            instruments.lap(DISPATCH, started)
 
 
 class Factory(protocol.Factory):
     """HiQnet Twisted Factory."""
 
     protocol = TCPProtocol
+    pipeline = None
+    """:type: hiqnet.service.pipeline.DecodePipeline"""
+    instruments = None
+    """:type: hiqnet.service.instruments.Instruments"""
 
-    def __init__(self, app):
+    def __init__(self, app, pipeline=None, instruments=None):
         self.app = app
+        self.pipeline = pipeline
+        self.instruments = instruments
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""HiQnet outbound commands scheduling.
+
+Commands are queued by destination and by priority class:
+
+0. interactive: parameters sets, locate, store, recall, sessions…
+1. subscriptions: subscribe and unsubscribe commands
+2. bulk: parameters and attributes gets, such as a full sync
+3. discovery: DISCOINFO, REQADDR, ADDRUSED
+
+The class is found from the message ID, so pre-encoded commands are classified too.
+
+Each device gets a token bucket, in bytes, so we don't overrun its input buffer.
+The bucket holds up to the max message size the device advertises in DISCOINFO and fills at `device_rate`.
+A device sends the commands of the highest priority class first.
+Interactive commands waiting longer than `interactive_deadline` are sent whatever the bucket,
+which bounds their queueing delay.
+Broadcasts are not rate limited.
+The buckets of the devices with nothing waiting are dropped once full again, every `BUCKETS_SWEEP_INTERVAL`:
+a new bucket starts full, so they are only kept for the devices that were sent to recently.
+
+Commands are encoded once, when queued, and handed down encoded to the wrapped connection.
+
+The scheduler has the same API as :class:`hiqnet.service.ip.Connection` and wraps one.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import collections
+
+from ..protocol import Message
+
+INTERACTIVE = 0
+SUBSCRIPTIONS = 1
+BULK = 2
+DISCOVERY = 3
+
+CLASS_NAMES = ('interactive', 'subscriptions', 'bulk', 'discovery')
+
+_CLASSES = {}
+for _name in ('MULTPARMSUB', 'PARMSUBPCT', 'MULTPARMUNSUB', 'PARMSUBALL', 'PARMUNSUBALL',
+              'SUBEVTLOGMSGS', 'UNSUBEVTLOGMSGS'):
+    _CLASSES[Message.MESSAGES[_name]] = SUBSCRIPTIONS
+for _name in ('MULTPARMGET', 'GETATTR', 'GETVDLIST', 'REQEVTLOG'):
+    _CLASSES[Message.MESSAGES[_name]] = BULK
+for _name in ('DISCOINFO', 'GETNETINFO', 'REQADDR', 'ADDRUSED'):
+    _CLASSES[Message.MESSAGES[_name]] = DISCOVERY
+del _name
+
+DEFAULT_DEVICE_RATE = 128 * 1024  # bytes/s
+DEFAULT_MAX_MESSAGE_SIZE = 1500  # bytes
+"""Bucket size for devices not discovered yet"""
+DEFAULT_INTERACTIVE_DEADLINE = 0.01  # s
+BUCKETS_SWEEP_INTERVAL = 10.0  # s
+
+
+def classify(data):
+    """Find the priority class of a command.
+
+    :param data: Binary command
+    :type data: bytes
+    :rtype: int
+    """
+    return _CLASSES.get(bytes(data[18:20]), INTERACTIVE)
+
+
+class TokenBucket(object):
+    """Bytes a device can take right now."""
+    capacity = None
+    rate = None
+    tokens = None
+    stamp = None
+
+    def __init__(self, capacity, rate, now):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, size, now, force=False):
+        """Take tokens.
+
+        :param size: Bytes to send
+        :type size: int
+        :param now: Current time
+        :type now: float
+        :param force: Take them even when missing. The bucket then owes them.
+        :type force: bool
+        :return: Whether the tokens were taken
+        :rtype: bool
+        """
+        self.refill(now)
+        # A command larger than the bucket is let through once the bucket is full
+        if force or self.tokens >= min(size, self.capacity):
+            self.tokens -= size
+            return True
+        return False
+
+    def wait(self, size):
+        """Time until the tokens for size are available.
+
+        :rtype: float
+        """
+        return max(0.0, (min(size, self.capacity) - self.tokens) / float(self.rate))
+
+
+class OutboundScheduler(object):
+    """Priority and rate limited outbound commands."""
+    connection = None
+    """:type: hiqnet.service.ip.Connection"""
+    registry = None
+    """:type: hiqnet.discovery.DiscoveryRegistry"""
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    device_rate = DEFAULT_DEVICE_RATE
+    interactive_deadline = DEFAULT_INTERACTIVE_DEADLINE
+    sent = None
+    """Commands sent by class"""
+    forced = 0
+    """Interactive commands sent past their deadline without tokens"""
+    delay_total = None
+    """Total queueing delay by class"""
+    delay_max = None
+    """Longest queueing delay by class"""
+    _queues = None
+    """Queues by class, by destination"""
+    _buckets = None
+    _swept = None
+    """Last time the full buckets were dropped"""
+    _timer = None
+
+    def __init__(self, connection, registry=None, device_rate=DEFAULT_DEVICE_RATE,
+                 interactive_deadline=DEFAULT_INTERACTIVE_DEADLINE, clock=None):
+        """Build a scheduler.
+
+        :param connection: Where the commands are sent
+        :type connection: hiqnet.service.ip.Connection
+        :param registry: Discovered devices, for their max message size
+        :type registry: hiqnet.discovery.DiscoveryRegistry
+        :param device_rate: Bytes per second sent to a device
+        :type device_rate: int
+        :param interactive_deadline: Longest queueing delay of interactive commands in seconds
+        :type interactive_deadline: float
+        :param clock: Scheduler. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self.connection = connection
+        self.registry = registry
+        self.device_rate = device_rate
+        self.interactive_deadline = interactive_deadline
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.sent = [0] * len(CLASS_NAMES)
+        self.delay_total = [0.0] * len(CLASS_NAMES)
+        self.delay_max = [0.0] * len(CLASS_NAMES)
+        self._queues = {}
+        self._buckets = {}
+        self._swept = self.clock.seconds()
+
+    def sendto(self, command, destination='<broadcast>', priority=None):
+        """Send command to the destination.
+
+        :param command: Message to send
+        :type command: hiqnet.protocol.Command
+        :param destination: Destination IPv4 address or '<broadcast>'
+        :type destination: str
+        :param priority: Priority class. Found from the message by default.
+        :type priority: int
+        """
+        # noinspection PyArgumentList
+        self._enqueue(command, bytes(command), destination, priority)
+
+    def write(self, data, destination='<broadcast>', priority=None):
+        """Send an already encoded command over UDP.
+
+        :param data: Binary command
+        :type data: bytes
+        :param destination: Destination IPv4 address or '<broadcast>'
+        :type destination: str
+        :param priority: Priority class. Found from the message by default.
+        :type priority: int
+        """
+        self._enqueue(None, data, destination, priority)
+
+    def depth(self, priority):
+        """Commands waiting in a class.
+
+        :rtype: int
+        """
+        return sum(len(queues[priority]) for queues in self._queues.values())
+
+    def bucket(self, destination):
+        """Get the token bucket of a device.
+
+        :param destination: IPv4 address
+        :type destination: str
+        :rtype: TokenBucket
+        """
+        bucket = self._buckets.get(destination)
+        capacity = DEFAULT_MAX_MESSAGE_SIZE
+        if self.registry is not None:
+            device = self.registry.by_ip.get(destination)
+            if device is not None and device.max_message_size:
+                capacity = device.max_message_size
+        if bucket is None:
+            bucket = self._buckets[destination] = TokenBucket(capacity, self.device_rate, self.clock.seconds())
+        else:
+            bucket.capacity = capacity
+        return bucket
+
+    def _enqueue(self, command, data, destination, priority):
+        if priority is None:
+            priority = classify(data)
+        if destination == '<broadcast>':
+            self._send(command, data, destination, priority, 0.0)
+            return
+        now = self.clock.seconds()
+        if now - self._swept >= BUCKETS_SWEEP_INTERVAL:
+            self._sweep(now)
+        queues = self._queues.get(destination)
+        if queues is None:
+            # Nothing waiting for this device, send right away when the bucket allows
+            if self.bucket(destination).take(len(data), now):
+                self._send(command, data, destination, priority, 0.0)
+                return
+            queues = self._queues[destination] = tuple(collections.deque() for _ in CLASS_NAMES)
+        queues[priority].append((command, data, now))
+        self._pump()
+
+    def _sweep(self, now):
+        """Drop the buckets of the devices with nothing waiting that are full again."""
+        self._swept = now
+        for destination, bucket in list(self._buckets.items()):
+            if destination in self._queues:
+                continue
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._buckets[destination]
+
+    def _send(self, command, data, destination, priority, delay):
+        self.sent[priority] += 1
+        self.delay_total[priority] += delay
+        if delay > self.delay_max[priority]:
+            self.delay_max[priority] = delay
+        if command is not None:
+            # Still a command, for the guaranteed ones and the instruments
+            self.connection.sendto(command, destination, data)
+        else:
+            self.connection.write(data, destination)
+
+    def _pump(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        now = self.clock.seconds()
+        wait = None
+        for destination, queues in list(self._queues.items()):
+            bucket = self.bucket(destination)
+            for priority, queue in enumerate(queues):
+                while queue:
+                    command, data, enqueued = queue[0]
+                    if not bucket.take(len(data), now):
+                        if priority != INTERACTIVE or now - enqueued < self.interactive_deadline:
+                            break
+                        bucket.take(len(data), now, force=True)
+                        self.forced += 1
+                    queue.popleft()
+                    self._send(command, data, destination, priority, now - enqueued)
+                if queue:
+                    # Lower classes wait for this device
+                    delay = bucket.wait(len(queue[0][1]))
+                    if priority == INTERACTIVE:
+                        delay = min(delay, queue[0][2] + self.interactive_deadline - now)
+                    wait = delay if wait is None else min(wait, delay)
+                    break
+            else:
+                del self._queues[destination]
+        if wait is not None:
+            self._timer = self.clock.callLater(max(wait, 0.0), self._pump)
+
+    def stats(self):
+        """Counters.
+
+        :return: Counters by class name, with the queueing delays in seconds
+        :rtype: dict
+        """
+        stats = {}
+        for priority, name in enumerate(CLASS_NAMES):
+            sent = self.sent[priority]
+            stats[name] = {
+                'depth': self.depth(priority),
+                'sent': sent,
+                'delay_mean': self.delay_total[priority] / sent if sent else 0.0,
+                'delay_max': self.delay_max[priority],
+            }
+        stats['interactive']['forced'] = self.forced
+        return stats
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""HiQnet requests and replies matching.
+
+Replies come from the address the request was sent to, carry the same message ID
+and the Information or Error flag.
+Requests waiting for a reply are queued by (address, message ID) in the order they were sent.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import collections
+
+from twisted.internet import defer
+
+from ..store import address_key
+
+DEFAULT_TIMEOUT = 1.0  # s
+
+
+class ErrorReply(Exception):
+    """The remote device replied with an error."""
+
+    def __init__(self, command):
+        """Build from the error reply.
+
+        :param command: The reply
+        :type command: hiqnet.protocol.Command
+        """
+        super(ErrorReply, self).__init__(command.error_code, command.error_string)
+        self.command = command
+
+
+class PendingRequests(object):
+    """Requests waiting for their reply."""
+    connection = None
+    """:type: hiqnet.service.ip.Connection"""
+    timeout = DEFAULT_TIMEOUT
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    _pending = None
+
+    def __init__(self, connection, timeout=DEFAULT_TIMEOUT, clock=None):
+        """Build a pending requests tracker.
+
+        :param connection: Where to send requests
+        :type connection: hiqnet.service.ip.Connection
+        :param timeout: Default time to wait for a reply in seconds
+        :type timeout: float
+        :param clock: Scheduler. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self.connection = connection
+        self.timeout = timeout
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self._pending = {}
+
+    def __len__(self):
+        return sum(len(waiting) for waiting in self._pending.values())
+
+    def request(self, command, ip_address, timeout=None):
+        """Send a command and wait for its reply.
+
+        :param command: The request
+        :type command: hiqnet.protocol.Command
+        :param ip_address: Destination IPv4 address
+        :type ip_address: str
+        :param timeout: Time to wait for a reply in seconds
+        :type timeout: float
+        :return: Fires with the reply command. Fails with ErrorReply or defer.TimeoutError.
+        :rtype: defer.Deferred
+        """
+        if timeout is None:
+            timeout = self.timeout
+        key = (address_key(command.destination_address), command.message.identifier)
+        d = defer.Deferred()
+        entry = [d, None]
+        entry[1] = self.clock.callLater(timeout, self._expire, key, entry)
+        self._pending.setdefault(key, collections.deque()).append(entry)
+        self.connection.sendto(command, ip_address)
+        return d
+
+    def _expire(self, key, entry):
+        waiting = self._pending.get(key)
+        if waiting is None:
+            return
+        waiting.remove(entry)
+        if not waiting:
+            del self._pending[key]
+        entry[0].errback(defer.TimeoutError())
+
+    def handle_command(self, command):
+        """Match a received command with a pending request.
+
+        :param command: A received command
+        :type command: hiqnet.protocol.Command
+        :return: Whether the command was a reply to a pending request
+        :rtype: bool
+        """
+        if not command.flags.info and not command.flags.error:
+            # A query or a notification, not a reply
+            return False
+        key = (address_key(command.source_address), command.message.identifier)
+        waiting = self._pending.get(key)
+        if not waiting:
+            return False
+        d, call = waiting.popleft()
+        if not waiting:
+            del self._pending[key]
+        call.cancel()
+        if command.flags.error:
+            d.errback(ErrorReply(command))
+        else:
+            d.callback(command)
+        return True
+
+    def cancel_all(self):
+        """Cancel every pending request."""
+        pending = self._pending
+        self._pending = {}
+        for waiting in pending.values():
+            for d, call in waiting:
+                call.cancel()
+                d.cancel()
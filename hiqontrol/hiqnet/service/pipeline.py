@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""HiQnet commands decoding off the reactor.
+
+The protocols hand the raw commands over to the pipeline instead of decoding them.
+They are classified from their message ID and queued right away in the bounded inbound queues,
+so a storm is bounded before any decoding work, see :mod:`hiqnet.service.inbound`.
+
+Decoding happens in a worker thread, or in a process pool for large payloads
+such as multipart parameter replies. The worker takes the queued commands by class priority,
+and stops taking them while `max_decoded` commands wait to be handled:
+the rest stay in the inbound queues, where the overflow policies apply.
+Decoded commands come back through a deque per class, whose appends and pops are atomic.
+Once per frame, the main loop hands them to the app in batches, by class priority.
+
+The batch size is bounded so that a burst is spread over several frames instead of stalling one.
+An exception raised by the app while handling a command is logged and counted,
+it doesn't reach the main loop nor stop the batch.
+
+.. note:: Commands decoded in the process pool may overtake the ones decoded in the thread.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import collections
+import threading
+
+from twisted.python import log
+
+from ..protocol import Command
+from .inbound import InboundQueues, METERS
+from .instruments import DECODE, DISPATCH
+
+DEFAULT_MAX_BATCH = 256
+"""Commands handed to the app per frame"""
+DEFAULT_MAX_DECODED = 2 * DEFAULT_MAX_BATCH
+"""Commands decoded ahead of the app"""
+DEFAULT_PROCESS_THRESHOLD = 1024
+"""Payloads from this size in bytes are decoded in the process pool"""
+
+
+def _decode(data):
+    """Decode a command, for the process pool.
+
+    :param data: Binary command
+    :type data: bytes
+    :return: None when the command can't be decoded
+    :rtype: Command
+    """
+    try:
+        return Command(command=data)
+    except Exception:
+        return None
+
+
+class DecodePipeline(object):
+    """Decodes commands in a worker thread and hands them back in batches."""
+    app = None
+    """Receives the commands through its handle_message method"""
+    max_batch = DEFAULT_MAX_BATCH
+    max_decoded = DEFAULT_MAX_DECODED
+    processes = 0
+    process_threshold = DEFAULT_PROCESS_THRESHOLD
+    submitted = 0
+    refused = 0
+    """Commands refused by a full drop-newest queue"""
+    decoded = 0
+    errors = 0
+    handled = 0
+    handler_errors = 0
+    """Commands whose handling raised an exception"""
+    batches = 0
+    largest_batch = 0
+    queues = None
+    """Commands waiting to be decoded, :type: hiqnet.service.inbound.InboundQueues"""
+    instruments = None
+    """:type: hiqnet.service.instruments.Instruments"""
+    _ready = None
+    """Guards the queues and wakes the worker up, :type: threading.Condition"""
+    _in_flight = 0
+    """Commands taken by the worker and not handled yet"""
+    _outboxes = None
+    """Decoded commands, a deque per class by priority"""
+    _stopping = False
+    _worker = None
+    """:type: threading.Thread"""
+    _pool = None
+    """:type: multiprocessing.pool.Pool"""
+
+    def __init__(self, app, max_batch=DEFAULT_MAX_BATCH, processes=0, process_threshold=DEFAULT_PROCESS_THRESHOLD,
+                 queues=None, instruments=None, max_decoded=DEFAULT_MAX_DECODED):
+        """Build a pipeline.
+
+        :param app: Receives the commands through its handle_message method
+        :param max_batch: Commands handed to the app per drain
+        :type max_batch: int
+        :param processes: Size of the process pool for large payloads. 0 decodes everything in the thread.
+        :type processes: int
+        :param process_threshold: Payloads from this size in bytes are decoded in the process pool
+        :type process_threshold: int
+        :param queues: Bounded queues by message class. Defaults to the default InboundQueues.
+        :type queues: hiqnet.service.inbound.InboundQueues
+        :param instruments: Times the decoding and the dispatching, counts the commands
+        :type instruments: hiqnet.service.instruments.Instruments
+        :param max_decoded: Commands decoded ahead of the app
+        :type max_decoded: int
+        """
+        self.app = app
+        self.max_batch = max_batch
+        self.max_decoded = max_decoded
+        self.processes = processes
+        self.process_threshold = process_threshold
+        if queues is None:
+            queues = InboundQueues()
+        self.queues = queues
+        self.instruments = instruments
+        self._ready = threading.Condition()
+        self._outboxes = collections.OrderedDict((queue.name, collections.deque()) for queue in queues.queues)
+
+    @property
+    def backlog(self):
+        """Commands waiting to be decoded or handled.
+
+        :rtype: int
+        """
+        return len(self.queues) + self._in_flight
+
+    def start(self):
+        """Start the worker thread and the process pool."""
+        if self._worker is not None:
+            return
+        if self.processes:
+            import multiprocessing
+            self._pool = multiprocessing.Pool(self.processes)
+        self._stopping = False
+        self._worker = threading.Thread(target=self._run, name="HiQnetDecode")
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self):
+        """Stop the worker thread and the process pool.
+
+        Commands not handled yet are dropped.
+        """
+        if self._worker is not None:
+            with self._ready:
+                self._stopping = True
+                self._ready.notify()
+            self._worker.join()
+            self._worker = None
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        with self._ready:
+            self.queues.clear()
+            for outbox in self._outboxes.values():
+                outbox.clear()
+            self._in_flight = 0
+
+    def _push(self, message, host, protocol_name, message_class=None):
+        self.submitted += 1
+        with self._ready:
+            if not self.queues.push(message, host, protocol_name, message_class):
+                self.refused += 1
+                return
+            self._ready.notify()
+
+    def submit(self, data, host, protocol_name):
+        """Queue a raw command for decoding.
+
+        Called from the reactor.
+
+        :param data: Binary command
+        :type data: bytes
+        :param host: Sender IPv4 address
+        :type host: str
+        :param protocol_name: Protocol that received
+        :type protocol_name: str
+        """
+        self._push(data, host, protocol_name)
+
+    def submit_decoded(self, message, host, protocol_name):
+        """Queue a message that needs no decoding, such as Soundcraft VU meters.
+
+        :param message: The message
+        :param host: Sender IPv4 address
+        :type host: str
+        :param protocol_name: Protocol that received
+        :type protocol_name: str
+        """
+        self._push(message, host, protocol_name, METERS)
+
+    def _run(self):
+        ready = self._ready
+        while True:
+            with ready:
+                while not self._stopping and (not self.queues or self._in_flight >= self.max_decoded):
+                    ready.wait()
+                if self._stopping:
+                    break
+                data, host, protocol_name, message_class = self.queues.pop()
+                self._in_flight += 1
+            if message_class == METERS:
+                self._outboxes[message_class].append((data, host, protocol_name))
+                continue
+            if self._pool is not None and len(data) >= self.process_threshold:
+                self._pool.apply_async(_decode, (data,), callback=lambda command, host=host, name=protocol_name,
+                                       message_class=message_class: self._decoded(command, host, name, message_class))
+                continue
+            instruments = self.instruments
+            if instruments is None:
+                self._decoded(_decode(data), host, protocol_name, message_class)
+                continue
+            started = instruments.timer()
+            command = _decode(data)
+            instruments.lap(DECODE, started)
+            self._decoded(command, host, protocol_name, message_class)
+
+    def _decoded(self, command, host, protocol_name, message_class):
+        if command is None:
+            self.errors += 1
+            self._release(1)
+            return
+        self.decoded += 1
+        self._outboxes[message_class].append((command, host, protocol_name))
+
+    def _release(self, count):
+        """Make room for the worker to decode more."""
+        with self._ready:
+            self._in_flight -= count
+            self._ready.notify()
+
+    def drain(self, *args):
+        """Hand the decoded commands to the app, up to max_batch of them, by class priority.
+
+        Meant to be scheduled on every frame of the main loop.
+
+        :return: Number of commands handled
+        :rtype: int
+        """
+        count = 0
+        handle_message = self.app.handle_message
+        instruments = self.instruments
+        for outbox in self._outboxes.values():
+            while count < self.max_batch:
+                try:
+                    command, host, protocol_name = outbox.popleft()
+                except IndexError:
+                    break
+                try:
+                    if instruments is None:
+                        handle_message(command, host, protocol_name)
+                    else:
+                        if isinstance(command, Command):
+                            instruments.count_received(command.message.name)
+                        started = instruments.timer()
+                        handle_message(command, host, protocol_name)
+                        instruments.lap(DISPATCH, started)
+                except Exception:
+                    self.handler_errors += 1
+                    log.err(None, "Handling a command from %s failed" % host)
+                count += 1
+        if count:
+            self._release(count)
+            self.handled += count
+            self.batches += 1
+            self.largest_batch = max(self.largest_batch, count)
+        return count
+
+    def stats(self):
+        """Pipeline counters.
+
+        :rtype: dict
+        """
+        return {
+            'submitted': self.submitted,
+            'refused': self.refused,
+            'decoded': self.decoded,
+            'errors': self.errors,
+            'handled': self.handled,
+            'handler_errors': self.handler_errors,
+            'batches': self.batches,
+            'largest_batch': self.largest_batch,
+            'backlog': self.backlog,
+            'queues': self.queues.stats(),
+        }
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""HiQnet outbound TCP connections pool.
+
+Guaranteed commands are sent over TCP. Rather than connecting for each command,
+one client connection per remote device is opened on first use and reused.
+
+- Writes are pipelined: commands are written as soon as they are sent, without waiting for replies.
+- Commands sent while connecting are buffered and flushed once connected.
+  At most `max_buffered` are kept: the oldest are dropped first.
+- Connections unused for `idle_timeout` are closed.
+- Failed or lost connections with buffered commands are retried with an exponential backoff.
+  After `max_attempts` attempts in a row, the buffered commands are abandoned.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import collections
+
+from twisted.internet import protocol
+from twisted.python import log
+
+from .ip import PORT, TCPProtocol
+
+DEFAULT_IDLE_TIMEOUT = 30.0  # s
+DEFAULT_CONNECT_TIMEOUT = 5.0  # s
+INITIAL_BACKOFF = 0.25  # s
+MAX_BACKOFF = 30.0  # s
+DEFAULT_MAX_BUFFERED = 1024
+"""Commands per connection"""
+DEFAULT_MAX_ATTEMPTS = 8
+"""Connection attempts in a row before abandoning the buffered commands"""
+
+
+# noinspection PyClassHasNoInit
+class TCPClientProtocol(TCPProtocol):
+    """HiQnet Twisted TCP client protocol."""
+
+    name = "HiQnetTCPClient"
+
+    # noinspection PyPep8Naming
+    def connectionMade(self):
+        self.factory.peer.connected(self)
+
+    # noinspection PyPep8Naming
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.factory.peer.disconnected(self)
+
+    # noinspection PyPep8Naming
+    def dataReceived(self, data):
+        self.factory.peer.touch()
+        TCPProtocol.dataReceived(self, data)
+
+
+class ClientFactory(protocol.ClientFactory):
+    """Builds the client protocol of a pooled connection."""
+    protocol = TCPClientProtocol
+    app = None
+    """Receives the replies through its handle_message method"""
+    peer = None
+    """:type: PooledConnection"""
+    pipeline = None
+    """:type: hiqnet.service.pipeline.DecodePipeline"""
+    instruments = None
+    """:type: hiqnet.service.instruments.Instruments"""
+
+    def __init__(self, peer):
+        """Build a factory.
+
+        :param peer: The connection the client protocol reports to
+        :type peer: PooledConnection
+        """
+        self.peer = peer
+        self.app = peer.pool.app
+        self.pipeline = peer.pool.pipeline
+        self.instruments = peer.pool.instruments
+
+    # noinspection PyPep8Naming
+    def clientConnectionFailed(self, connector, reason):
+        self.peer.failed(reason)
+
+
+class PooledConnection(object):
+    """Client connection to a remote device."""
+    host = None
+    pool = None
+    """:type: TCPConnectionPool"""
+    protocol = None
+    """:type: TCPClientProtocol"""
+    connecting = False
+    backoff = INITIAL_BACKOFF
+    attempts = 0
+    """Failed attempts since the last connection"""
+    connects = 0
+    failures = 0
+    writes = 0
+    bytes_sent = 0
+    _buffer = None
+    _idle_call = None
+    _retry_call = None
+
+    def __init__(self, pool, host):
+        """Build a pooled connection.
+
+        :param pool: The owning pool
+        :type pool: TCPConnectionPool
+        :param host: Remote IPv4 address
+        :type host: str
+        """
+        self.pool = pool
+        self.host = host
+        self._buffer = collections.deque()
+
+    @property
+    def buffered(self):
+        """Commands waiting for the connection.
+
+        :rtype: int
+        """
+        return len(self._buffer)
+
+    def write(self, data):
+        """Write or buffer data.
+
+        :param data: Binary command
+        :type data: bytes
+        """
+        self.writes += 1
+        self.bytes_sent += len(data)
+        if self.protocol is not None:
+            self.protocol.transport.write(data)
+            self.touch()
+            return
+        self._buffer.append(data)
+        if len(self._buffer) > self.pool.max_buffered:
+            self._buffer.popleft()
+            self.pool.dropped += 1
+        if not self.connecting and self._retry_call is None:
+            self.connect()
+
+    def connect(self):
+        """Start connecting."""
+        self._retry_call = None
+        self.connecting = True
+        self.pool.reactor.connectTCP(self.host, self.pool.port, ClientFactory(self),
+                                     timeout=self.pool.connect_timeout)
+
+    def connected(self, client):
+        self.connecting = False
+        self.protocol = client
+        self.connects += 1
+        self.attempts = 0
+        self.backoff = INITIAL_BACKOFF
+        if self._buffer:
+            client.transport.writeSequence(list(self._buffer))
+            self._buffer.clear()
+        self.touch()
+
+    def disconnected(self, client):
+        if self.protocol is not client:
+            return
+        self.protocol = None
+        self._cancel_idle()
+        if self._buffer:
+            self._retry()
+        else:
+            self.pool.discard(self)
+
+    # noinspection PyUnusedLocal
+    def failed(self, reason):
+        self.connecting = False
+        self.failures += 1
+        self._retry()
+
+    def _retry(self):
+        if self._retry_call is not None:
+            return
+        self.attempts += 1
+        if self.attempts >= self.pool.max_attempts:
+            self._give_up()
+            return
+        self._retry_call = self.pool.reactor.callLater(self.backoff, self.connect)
+        self.backoff = min(self.backoff * 2, self.pool.max_backoff)
+
+    def _give_up(self):
+        """Abandon the buffered commands and forget the connection."""
+        log.msg("Giving up connecting to %s after %d attempts, %d commands abandoned"
+                % (self.host, self.attempts, len(self._buffer)))
+        self.pool.abandoned += len(self._buffer)
+        self._buffer.clear()
+        self.attempts = 0
+        self.backoff = INITIAL_BACKOFF
+        self.pool.discard(self)
+
+    def touch(self):
+        """Postpone the idle timeout."""
+        if self._idle_call is not None and self._idle_call.active():
+            self._idle_call.reset(self.pool.idle_timeout)
+        else:
+            self._idle_call = self.pool.reactor.callLater(self.pool.idle_timeout, self._idle)
+
+    def _cancel_idle(self):
+        if self._idle_call is not None and self._idle_call.active():
+            self._idle_call.cancel()
+        self._idle_call = None
+
+    def _idle(self):
+        self._idle_call = None
+        if self.protocol is not None:
+            self.protocol.transport.loseConnection()
+
+    def close(self):
+        """Close the connection and drop buffered commands."""
+        self._buffer.clear()
+        self._cancel_idle()
+        if self._retry_call is not None and self._retry_call.active():
+            self._retry_call.cancel()
+        self._retry_call = None
+        if self.protocol is not None:
+            self.protocol.transport.loseConnection()
+
+
+class TCPConnectionPool(object):
+    """Outbound TCP connections by remote host."""
+    app = None
+    """Receives the replies through its handle_message method"""
+    pipeline = None
+    """:type: hiqnet.service.pipeline.DecodePipeline"""
+    instruments = None
+    """:type: hiqnet.service.instruments.Instruments"""
+    reactor = None
+    port = PORT
+    idle_timeout = DEFAULT_IDLE_TIMEOUT
+    connect_timeout = DEFAULT_CONNECT_TIMEOUT
+    max_backoff = MAX_BACKOFF
+    max_buffered = DEFAULT_MAX_BUFFERED
+    max_attempts = DEFAULT_MAX_ATTEMPTS
+    connections = None
+    """:type: dict of PooledConnection by host"""
+    dropped = 0
+    """Oldest buffered commands dropped to make room"""
+    abandoned = 0
+    """Buffered commands abandoned after max_attempts"""
+
+    def __init__(self, app, port=PORT, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, max_backoff=MAX_BACKOFF,
+                 max_buffered=DEFAULT_MAX_BUFFERED, max_attempts=DEFAULT_MAX_ATTEMPTS, reactor=None,
+                 pipeline=None, instruments=None):
+        """Build a pool.
+
+        :param app: Receives the replies through its handle_message method
+        :param port: Remote TCP port
+        :type port: int
+        :param idle_timeout: Time before closing an unused connection in seconds
+        :type idle_timeout: float
+        :param connect_timeout: Time to wait for a connection in seconds
+        :type connect_timeout: float
+        :param max_backoff: Maximum time between reconnection attempts in seconds
+        :type max_backoff: float
+        :param max_buffered: Commands buffered per connection while connecting
+        :type max_buffered: int
+        :param max_attempts: Connection attempts in a row before abandoning the buffered commands
+        :type max_attempts: int
+        :param reactor: Defaults to the global reactor
+        :type reactor: twisted.internet.interfaces.IReactorTCP
+        :param pipeline: Decodes the replies off the reactor. Decoded in place by default.
+        :type pipeline: hiqnet.service.pipeline.DecodePipeline
+        :param instruments: Times and counts the received replies
+        :type instruments: hiqnet.service.instruments.Instruments
+        """
+        self.app = app
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.max_buffered = max_buffered
+        self.max_attempts = max_attempts
+        self.pipeline = pipeline
+        self.instruments = instruments
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.connections = {}
+
+    def write(self, data, host):
+        """Send data to a host, connecting if needed.
+
+        :param data: Binary command
+        :type data: bytes
+        :param host: Remote IPv4 address
+        :type host: str
+        """
+        connection = self.connections.get(host)
+        if connection is None:
+            connection = self.connections[host] = PooledConnection(self, host)
+        connection.write(data)
+
+    def discard(self, connection):
+        """Forget a closed connection.
+
+        :param connection: A connection of this pool
+        :type connection: PooledConnection
+        """
+        if self.connections.get(connection.host) is connection:
+            del self.connections[connection.host]
+
+    def close(self):
+        """Close every connection."""
+        for connection in list(self.connections.values()):
+            connection.close()
+        self.connections = {}
+
+    def stats(self):
+        """Counters.
+
+        :rtype: dict
+        """
+        return {
+            'connections': len(self.connections),
+            'buffered': sum(connection.buffered for connection in self.connections.values()),
+            'dropped': self.dropped,
+            'abandoned': self.abandoned,
+        }
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""HiQnet acknowledged delivery.
+
+Commands sent with the Request Acknowledgement flag are answered by the receiver with
+the same message and sequence number and the Acknowledgement flag set.
+Unacknowledged commands are retransmitted.
+
+- In flight commands are indexed by (destination device address, source device address, sequence number)
+  since commands forwarded on behalf of several devices keep their own sequence numbers.
+- The retransmission timeout adapts to the round trip time measured for each device,
+  the same way TCP does (RFC 6298). Retransmitted commands don't update the estimate.
+- The number of commands in flight per device is capped, extra commands wait in a queue.
+- Incoming commands requesting an acknowledgement are acknowledged.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import collections
+
+from twisted.internet import defer
+
+from ..protocol import Command
+
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_MAX_RETRIES = 4
+INITIAL_RTO = 0.2  # s
+MIN_RTO = 0.02  # s
+MAX_RTO = 2.0  # s
+RTT_ALPHA = 1 / 8.0
+RTT_BETA = 1 / 4.0
+
+
+class PeerStats(object):
+    """Delivery statistics and round trip time estimate for a device."""
+    srtt = None
+    """Smoothed round trip time in seconds"""
+    rttvar = None
+    """Round trip time variation in seconds"""
+    rto = INITIAL_RTO
+    """Retransmission timeout in seconds"""
+    in_flight = 0
+    sent = 0
+    delivered = 0
+    retries = 0
+    failed = 0
+    latency_total = 0.0
+    """Sum of the delivered commands latencies, retransmissions included, in seconds"""
+    latency_max = 0.0
+    queue = None
+
+    def __init__(self):
+        self.queue = collections.deque()
+
+    @property
+    def latency_average(self):
+        """Average delivery latency in seconds.
+
+        :rtype: float
+        """
+        if not self.delivered:
+            return 0.0
+        return self.latency_total / self.delivered
+
+    def measured(self, rtt):
+        """Update the round trip time estimate.
+
+        :param rtt: Measured round trip time in seconds
+        :type rtt: float
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+
+class ReliableSender(object):
+    """Sends commands requesting acknowledgement and retransmits them until acknowledged."""
+    connection = None
+    """:type: hiqnet.service.ip.Connection"""
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    max_in_flight = DEFAULT_MAX_IN_FLIGHT
+    max_retries = DEFAULT_MAX_RETRIES
+    peers = None
+    """:type: dict of PeerStats by device address"""
+    _in_flight = None
+
+    def __init__(self, connection, max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_retries=DEFAULT_MAX_RETRIES,
+                 clock=None):
+        """Build a reliable sender.
+
+        :param connection: Where to send commands
+        :type connection: hiqnet.service.ip.Connection
+        :param max_in_flight: Maximum unacknowledged commands per device
+        :type max_in_flight: int
+        :param max_retries: Retransmissions before giving up
+        :type max_retries: int
+        :param clock: Scheduler. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        self.connection = connection
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.peers = {}
+        self._in_flight = {}
+
+    def peer(self, device_address):
+        """Get a device statistics.
+
+        :param device_address: Device HiQnet address
+        :type device_address: int
+        :rtype: PeerStats
+        """
+        stats = self.peers.get(device_address)
+        if stats is None:
+            stats = self.peers[device_address] = PeerStats()
+        return stats
+
+    def send(self, command, ip_address, data=None):
+        """Send a command until it's acknowledged.
+
+        :param command: The command to deliver
+        :type command: Command
+        :param ip_address: Destination IPv4 address
+        :type ip_address: str
+        :param data: The command already encoded, such as a forwarded one, sent as is
+                     but for the Request Acknowledgement flag. Encoded from the command by default.
+        :type data: bytes
+        :return: Fires with the delivery latency in seconds. Fails with defer.TimeoutError.
+        :rtype: defer.Deferred
+        """
+        command.flags.reqack = 1
+        if data is not None:
+            data = bytearray(data)
+            # Request Acknowledgement is the lowest flags bit
+            data[21] |= 1
+            data = bytes(data)
+        stats = self.peer(command.destination_address.device_address)
+        d = defer.Deferred()
+        # command, ip, deferred, retries, first sent, timer, encoded command
+        entry = [command, ip_address, d, 0, None, None, data]
+        if stats.in_flight < self.max_in_flight:
+            self._transmit(stats, entry)
+        else:
+            stats.queue.append(entry)
+        return d
+
+    def _transmit(self, stats, entry):
+        command = entry[0]
+        key = (command.destination_address.device_address, command.source_address.device_address,
+               command.sequence_number)
+        self._in_flight[key] = entry
+        stats.in_flight += 1
+        stats.sent += 1
+        entry[4] = self.clock.seconds()
+        entry[5] = self.clock.callLater(stats.rto, self._timeout, key)
+        self._write(entry)
+
+    def _write(self, entry):
+        if entry[6] is None:
+            self.connection.sendto(entry[0], entry[1])
+        else:
+            self.connection.write(entry[6], entry[1])
+
+    def _timeout(self, key):
+        entry = self._in_flight.get(key)
+        if entry is None:
+            return
+        stats = self.peers[key[0]]
+        if entry[3] >= self.max_retries:
+            del self._in_flight[key]
+            stats.in_flight -= 1
+            stats.failed += 1
+            entry[2].errback(defer.TimeoutError("No acknowledgement after %d retries" % entry[3]))
+            self._dequeue(stats)
+            return
+        entry[3] += 1
+        stats.retries += 1
+        # Exponential backoff, not reflected in the estimate until a new measure
+        entry[5] = self.clock.callLater(min(stats.rto * 2 ** entry[3], MAX_RTO), self._timeout, key)
+        self._write(entry)
+
+    def _dequeue(self, stats):
+        while stats.queue and stats.in_flight < self.max_in_flight:
+            self._transmit(stats, stats.queue.popleft())
+
+    def handle_command(self, command, ip_address=None):
+        """Match acknowledgements and acknowledge received commands.
+
+        :param command: A received command
+        :type command: Command
+        :param ip_address: Sender IPv4 address
+        :type ip_address: str
+        :return: Whether the command was an acknowledgement
+        :rtype: bool
+        """
+        if command.flags.reqack and ip_address is not None:
+            self.connection.sendto(acknowledgement(command), ip_address)
+        if not command.flags.ack:
+            return False
+        key = (command.source_address.device_address, command.destination_address.device_address,
+               command.sequence_number)
+        entry = self._in_flight.pop(key, None)
+        if entry is None:
+            # Duplicate or late acknowledgement
+            return True
+        entry[5].cancel()
+        stats = self.peers[key[0]]
+        stats.in_flight -= 1
+        latency = self.clock.seconds() - entry[4]
+        if not entry[3]:
+            # Karn's algorithm: retransmitted commands give ambiguous measures
+            stats.measured(latency)
+        stats.delivered += 1
+        stats.latency_total += latency
+        stats.latency_max = max(stats.latency_max, latency)
+        entry[2].callback(latency)
+        self._dequeue(stats)
+        return True
+
+    def stats(self):
+        """Get a summary of the delivery statistics.
+
+        :return: Statistics by device address
+        :rtype: dict
+        """
+        return dict((device_address, {
+            'in_flight': peer.in_flight,
+            'queued': len(peer.queue),
+            'sent': peer.sent,
+            'delivered': peer.delivered,
+            'retries': peer.retries,
+            'failed': peer.failed,
+            'latency_average': peer.latency_average,
+            'latency_max': peer.latency_max,
+            'srtt': peer.srtt,
+            'rto': peer.rto,
+        }) for device_address, peer in self.peers.items())
+
+
+def acknowledgement(command):
+    """Build the acknowledgement of a command.
+
+    :param command: A received command requesting acknowledgement
+    :type command: Command
+    :rtype: Command
+    """
+    ack = Command(source=command.destination_address, destination=command.source_address,
+                  sequence_number=command.sequence_number)
+    ack.message = command.message
+    ack.flags.ack = 1
+    return ack
@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+"""One worker process per console.
+
+A single process handling many consoles spends its time waiting on the GIL.
+The supervisor runs a worker process per console instead.
+Each worker owns the sockets, the decoding and the parameters store of its console.
+
+State comes back through shared memory, see :mod:`hiqnet.shared`, without serialization:
+
+- parameters: the worker store, published as a :class:`hiqnet.shared.SharedParameters`
+- meters: the latest meters frame as received, in a :class:`hiqnet.shared.SeqlockBlock`
+
+The blocks belong to the supervisor so they outlive a worker restart.
+
+The supervisor drives the workers through their standard input, one JSON object per line::
+
+    {"subscribe": {"vd": 3, "object": 256, "parameters": [1, 2]}}
+    {"unsubscribe": {"vd": 3, "object": 256}}
+
+Without an object, the whole virtual device is subscribed to.
+The subscriptions are replayed to a restarted worker.
+A worker exits when its standard input closes, so it doesn't outlive the supervisor.
+
+The workers send their HiQnet commands from an ephemeral port, the console answers there.
+Each worker receives the meters of its console on the meters port, which the workers share (SO_REUSEPORT)
+with their socket connected to their console so the kernel hands them the right datagrams.
+The main process must not listen to the meters port then: it polls the latest frames
+with :meth:`ShardSupervisor.poll_meters` once per frame of its main loop instead.
+
+The parameters are for library use: the application doesn't subscribe the workers
+since it doesn't display parameters yet. Read them with :meth:`ShardSupervisor.parameters`.
+
+.. warning:: Linux only.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import json
+import os
+import socket
+import struct
+import sys
+
+from twisted.internet import protocol
+from twisted.protocols import basic
+
+from ..device import Device
+from ..protocol import FullyQualifiedAddress
+from ..shared import DEFAULT_FRAME_SIZE, DEFAULT_PARAMETERS_CAPACITY, HEADER_SIZE, BlockBusy, SeqlockBlock, \
+    SharedMemory, SharedParameters
+from ..subscription import SubscriptionManager
+from .ip import Connection, UDPProtocol
+
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+"""Missing from Python 2, Linux value"""
+DEFAULT_RESTART_DELAY = 1.0  # s
+
+_BOOTSTRAP = "import sys; sys.path.insert(0, sys.argv[1]); from hiqnet.service import shards; shards.worker_main(sys.argv[2])"
+
+
+def _object_address(console_address, request):
+    """Build an address from a control request.
+
+    :param console_address: Console HiQnet device address
+    :type console_address: int
+    :param request: Holds the virtual device and the optional object address as ints
+    :type request: dict
+    :rtype: FullyQualifiedAddress
+    """
+    vd_address = struct.pack('!B', request['vd'])
+    if request.get('object') is None:
+        return FullyQualifiedAddress(device_address=console_address, vd_address=vd_address)
+    return FullyQualifiedAddress(device_address=console_address, vd_address=vd_address,
+                                 object_address=struct.pack('!L', request['object'])[1:])
+
+
+class FrameUDPProtocol(protocol.DatagramProtocol):
+    """Publishes the received frames."""
+
+    name = "SharedFrames"
+    block = None
+    """:type: hiqnet.shared.SeqlockBlock"""
+    frames = 0
+
+    def __init__(self, block):
+        """Build the protocol.
+
+        :param block: Where to publish the latest frame
+        :type block: hiqnet.shared.SeqlockBlock
+        """
+        self.block = block
+
+    def datagramReceived(self, data, addr):
+        self.frames += 1
+        self.block.publish(data[:self.block.capacity])
+
+
+class ConsoleWorker(object):
+    """The worker side: handles one console."""
+    console_ip = None
+    console_address = None
+    device = None
+    """:type: hiqnet.device.Device"""
+    parameters = None
+    """:type: hiqnet.shared.SharedParameters"""
+    meters = None
+    """:type: hiqnet.shared.SeqlockBlock"""
+    meters_port = None
+    subscriptions = None
+    """:type: hiqnet.subscription.SubscriptionManager"""
+    udp_transport = None
+    tcp_transport = None
+
+    def __init__(self, console_ip, console_address, parameters, meters=None, meters_port=None, local_address=None):
+        """Build a worker.
+
+        :param console_ip: Console IPv4 address
+        :type console_ip: str
+        :param console_address: Console HiQnet device address
+        :type console_address: int
+        :param parameters: Where to publish the parameters
+        :type parameters: hiqnet.shared.SharedParameters
+        :param meters: Where to publish the meters frames
+        :type meters: hiqnet.shared.SeqlockBlock
+        :param meters_port: UDP port receiving the meters. No meters by default.
+        :type meters_port: int
+        :param local_address: Worker HiQnet device address. Random by default.
+        :type local_address: int
+        """
+        self.console_ip = console_ip
+        self.console_address = console_address
+        self.parameters = parameters
+        self.meters = meters
+        self.meters_port = meters_port
+        self.device = Device("HiQontrol %s" % console_ip, local_address)
+
+    def listen(self, reactor):
+        """Open the sockets.
+
+        :param reactor: The worker reactor
+        :type reactor: twisted.internet.interfaces.IReactorUDP
+        """
+        reactor.listenUDP(0, UDPProtocol(self))
+        self.subscriptions = SubscriptionManager(self.device, Connection(self.udp_transport, None))
+        self.parameters.attach(self.subscriptions.store)
+        if self.meters is not None and self.meters_port:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            sock.bind(('', self.meters_port))
+            sock.connect((self.console_ip, 0))
+            sock.setblocking(False)
+            reactor.adoptDatagramPort(sock.fileno(), socket.AF_INET, FrameUDPProtocol(self.meters))
+            # The reactor has its own copy
+            sock.close()
+
+    def control(self, request):
+        """Apply a request from the supervisor.
+
+        :param request: Decoded control line
+        :type request: dict
+        """
+        if 'subscribe' in request:
+            subscription = request['subscribe']
+            address = _object_address(self.console_address, subscription)
+            if subscription.get('object') is None:
+                self.subscriptions.subscribe_all(address, self.console_ip)
+            else:
+                self.subscriptions.subscribe(address, subscription.get('parameters', []), self.console_ip)
+        elif 'unsubscribe' in request:
+            self.subscriptions.unsubscribe(_object_address(self.console_address, request['unsubscribe']))
+
+    # noinspection PyUnusedLocal
+    def handle_message(self, message, host, protocol_name):
+        """Apply the console notifications.
+
+        :param message: HiQnet message
+        :type message: hiqnet.protocol.Command
+        :param host: IPv4 host address
+        :type host: str
+        :param protocol_name: Protocol that received
+        :type protocol_name: str
+        """
+        if host == self.console_ip:
+            self.subscriptions.handle_command(message)
+
+
+class WorkerControlProtocol(basic.LineOnlyReceiver):
+    """Reads the supervisor requests on the worker standard input."""
+    delimiter = b'\n'
+
+    def __init__(self, worker, reactor):
+        self.worker = worker
+        self.reactor = reactor
+
+    def lineReceived(self, line):
+        try:
+            request = json.loads(line.decode('utf-8'))
+        except ValueError:
+            print("Invalid control line: %r" % line)
+            return
+        self.worker.control(request)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        # The supervisor is gone
+        self.worker.subscriptions.unsubscribe_all()
+        self.reactor.callLater(0.1, self.reactor.stop)
+
+
+def worker_main(config):
+    """Run a worker, in its own process.
+
+    :param config: JSON worker configuration, see :meth:`ShardSupervisor.start`
+    :type config: str
+    """
+    from twisted.internet import reactor, stdio
+    config = json.loads(config)
+    meters = None
+    if config.get('meters'):
+        meters = SeqlockBlock(SharedMemory(config['meters']))
+    worker = ConsoleWorker(config['console_ip'], config['console_address'],
+                           SharedParameters(SharedMemory(config['parameters'])), meters, config.get('meters_port'),
+                           config.get('local_address'))
+    worker.listen(reactor)
+    stdio.StandardIO(WorkerControlProtocol(worker, reactor))
+    reactor.run()
+
+
+class Shard(object):
+    """The supervisor side of a worker."""
+    console_ip = None
+    console_address = None
+    local_address = None
+    parameters_memory = None
+    """:type: hiqnet.shared.SharedMemory"""
+    meters_memory = None
+    """:type: hiqnet.shared.SharedMemory"""
+    parameters = None
+    """Reader side, :type: hiqnet.shared.SharedParameters"""
+    meters = None
+    """Reader side, :type: hiqnet.shared.SeqlockBlock"""
+    meters_seen = 0
+    """Sequence of the last meters frame polled"""
+    requests = None
+    """Control requests, replayed on restart"""
+    process = None
+    """:type: WorkerProcessProtocol"""
+    starts = 0
+    stopping = False
+
+    def __init__(self, console_ip, console_address, local_address=None):
+        self.console_ip = console_ip
+        self.console_address = console_address
+        self.local_address = local_address
+        self.requests = []
+
+    @property
+    def pid(self):
+        if self.process is None or self.process.transport is None:
+            return None
+        return self.process.transport.pid
+
+    def send(self, request):
+        """Send a control request to the worker.
+
+        :type request: dict
+        """
+        if self.process is not None and self.process.transport is not None:
+            self.process.transport.write(json.dumps(request).encode('utf-8') + b'\n')
+
+    def stats(self):
+        """:rtype: dict"""
+        return {
+            'pid': self.pid,
+            'restarts': max(self.starts - 1, 0),
+            'parameters': len(self.parameters),
+            'parameters_writes': self.parameters.block.writes,
+            'meters_frames': self.meters.writes if self.meters is not None else 0,
+        }
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    """Tells the supervisor when a worker exits."""
+
+    def __init__(self, supervisor, shard):
+        self.supervisor = supervisor
+        self.shard = shard
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self.shard, reason)
+
+
+class ShardSupervisor(object):
+    """Runs and restarts a worker process per console."""
+    meters_port = None
+    capacity = DEFAULT_PARAMETERS_CAPACITY
+    restart_delay = DEFAULT_RESTART_DELAY
+    shards = None
+    """:type: dict of Shard by console IPv4 address"""
+    reactor = None
+
+    def __init__(self, meters_port=None, capacity=DEFAULT_PARAMETERS_CAPACITY, restart_delay=DEFAULT_RESTART_DELAY,
+                 reactor=None):
+        """Build a supervisor.
+
+        :param meters_port: UDP port receiving the meters, such as soundcraft.ip.VUMETER_IP_PORT. No meters by default.
+        :type meters_port: int
+        :param capacity: Parameters per console
+        :type capacity: int
+        :param restart_delay: Time before restarting a worker that exited, in seconds
+        :type restart_delay: float
+        :param reactor: Defaults to the global reactor
+        :type reactor: twisted.internet.interfaces.IReactorProcess
+        """
+        self.meters_port = meters_port
+        self.capacity = capacity
+        self.restart_delay = restart_delay
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.shards = {}
+
+    def _name(self, console_ip, kind):
+        return 'hiqontrol-%d-%s-%s' % (os.getpid(), console_ip, kind)
+
+    def start(self, console_ip, console_address, local_address=None):
+        """Start handling a console in a worker process.
+
+        :param console_ip: Console IPv4 address
+        :type console_ip: str
+        :param console_address: Console HiQnet device address
+        :type console_address: int
+        :param local_address: Worker HiQnet device address. Random by default.
+        :type local_address: int
+        :rtype: Shard
+        """
+        shard = self.shards.get(console_ip)
+        if shard is not None:
+            return shard
+        shard = self.shards[console_ip] = Shard(console_ip, console_address, local_address)
+        shard.parameters_memory = SharedMemory(self._name(console_ip, 'parameters'), create=True,
+                                               size=SharedParameters.size(self.capacity))
+        shard.parameters = SharedParameters(shard.parameters_memory)
+        if self.meters_port:
+            shard.meters_memory = SharedMemory(self._name(console_ip, 'meters'), create=True,
+                                               size=HEADER_SIZE + DEFAULT_FRAME_SIZE)
+            shard.meters = SeqlockBlock(shard.meters_memory)
+        self._spawn(shard)
+        return shard
+
+    def _spawn(self, shard):
+        config = {
+            'console_ip': shard.console_ip,
+            'console_address': shard.console_address,
+            'local_address': shard.local_address,
+            'parameters': shard.parameters_memory.name,
+            'meters': shard.meters_memory.name if shard.meters_memory is not None else None,
+            'meters_port': self.meters_port,
+        }
+        # The directory holding the hiqnet package
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        shard.process = WorkerProcessProtocol(self, shard)
+        self.reactor.spawnProcess(shard.process, sys.executable,
+                                  [sys.executable, '-c', _BOOTSTRAP, root, json.dumps(config)],
+                                  env=os.environ, childFDs={0: 'w', 1: 1, 2: 2})
+        shard.starts += 1
+        for request in shard.requests:
+            shard.send(request)
+
+    def worker_ended(self, shard, reason):
+        """Restart a worker unless it was stopped.
+
+        :type shard: Shard
+        :type reason: twisted.python.failure.Failure
+        """
+        shard.process = None
+        if shard.stopping:
+            shard.parameters_memory.unlink()
+            if shard.meters_memory is not None:
+                shard.meters_memory.unlink()
+            return
+        print("Worker for %s exited: %s" % (shard.console_ip, reason.getErrorMessage()))
+        # Don't leave the readers spinning on a write that will never end
+        shard.parameters.block.recover()
+        if shard.meters is not None:
+            shard.meters.recover()
+        self.reactor.callLater(self.restart_delay, self._spawn, shard)
+
+    def _request(self, console_ip, request):
+        shard = self.shards[console_ip]
+        shard.requests.append(request)
+        shard.send(request)
+
+    def subscribe(self, console_ip, vd_address, object_address=None, parameter_ids=None):
+        """Subscribe a worker to its console parameters.
+
+        :param console_ip: Console IPv4 address
+        :type console_ip: str
+        :param vd_address: Virtual device address
+        :type vd_address: int
+        :param object_address: Object address. The whole virtual device by default.
+        :type object_address: int
+        :param parameter_ids: Parameter IDs of the object
+        :type parameter_ids: list of int
+        """
+        self._request(console_ip, {'subscribe': {'vd': vd_address, 'object': object_address,
+                                                 'parameters': list(parameter_ids or [])}})
+
+    def unsubscribe(self, console_ip, vd_address, object_address=None):
+        """Unsubscribe a worker from an object or a virtual device.
+
+        :param console_ip: Console IPv4 address
+        :type console_ip: str
+        :param vd_address: Virtual device address
+        :type vd_address: int
+        :param object_address: Object address. The whole virtual device by default.
+        :type object_address: int
+        """
+        self._request(console_ip, {'unsubscribe': {'vd': vd_address, 'object': object_address}})
+
+    def parameters(self, console_ip):
+        """Read a console parameters.
+
+        :param console_ip: Console IPv4 address
+        :type console_ip: str
+        :rtype: hiqnet.shared.SharedParameters
+        """
+        return self.shards[console_ip].parameters
+
+    def meters(self, console_ip):
+        """Read a console latest meters frame.
+
+        :param console_ip: Console IPv4 address
+        :type console_ip: str
+        :rtype: hiqnet.shared.SeqlockBlock
+        """
+        return self.shards[console_ip].meters
+
+    def poll_meters(self, callback):
+        """Hand the meters frames published since the last poll over.
+
+        Only the latest frame of each console is kept by its worker, the ones overwritten in between are skipped.
+
+        :param callback: Called with the frame and the console IPv4 address
+        :type callback: callable
+        :return: Number of new frames
+        :rtype: int
+        """
+        count = 0
+        for console_ip, shard in list(self.shards.items()):
+            meters = shard.meters
+            if meters is None or meters.sequence == shard.meters_seen:
+                continue
+            try:
+                sequence, frame = meters.payload()
+            except BlockBusy:
+                # Being written, next time
+                continue
+            if sequence == shard.meters_seen:
+                continue
+            shard.meters_seen = sequence
+            callback(bytes(frame), console_ip)
+            count += 1
+        return count
+
+    def stop(self, console_ip=None):
+        """Stop workers.
+
+        :param console_ip: Console IPv4 address. Every worker by default.
+        :type console_ip: str
+        """
+        for shard in ([self.shards.pop(console_ip)] if console_ip is not None else list(self.shards.values())):
+            shard.stopping = True
+            if shard.process is not None and shard.process.transport is not None:
+                # The worker exits when its standard input closes
+                shard.process.transport.closeStdin()
+            else:
+                shard.parameters_memory.unlink()
+                if shard.meters_memory is not None:
+                    shard.meters_memory.unlink()
+        if console_ip is None:
+            self.shards = {}
+
+    def stats(self):
+        """Counters by console.
+
+        :rtype: dict
+        """
+        return dict((console_ip, shard.stats()) for console_ip, shard in self.shards.items())
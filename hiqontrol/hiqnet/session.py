@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""HiQnet sessions.
+
+A session is opened with each remote device by exchanging HELLO commands.
+Both sides pick a session number and commands sent to the peer carry the peer's session number
+in their optional header.
+
+The session manager has the same API as :class:`hiqnet.service.ip.Connection` and wraps one.
+The app sends its commands through it, so they carry the session number of their destination.
+Already encoded commands are sent as is.
+
+A session is kept alive by sending a DISCOINFO(I) to the peer when nothing else was sent to it
+during the keep alive period. A peer we haven't heard from during a keep alive period is considered gone.
+
+All sessions share a single timer wheel: one periodic call whatever the number of sessions.
+Each session sits in the wheel slot of its next deadline and is only looked at when that slot comes up.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import math
+
+from twisted.internet import task
+
+from protocol import Command, FullyQualifiedAddress, DEFAULT_KEEPALIVE
+
+DEFAULT_WHEEL_SLOTS = 16
+
+
+class Session(object):
+    """A session with a remote device."""
+    device_address = None
+    ip_address = None
+    local_number = None
+    """Our session number"""
+    remote_number = None
+    """The peer session number, attached to the commands we send it"""
+    last_sent = 0.0
+    last_received = 0.0
+    established = False
+    _slot = None
+
+    def __init__(self, device_address, ip_address, local_number, now):
+        """Build a session.
+
+        :param device_address: Peer HiQnet address
+        :type device_address: int
+        :param ip_address: Peer IPv4 address
+        :type ip_address: str
+        :param local_number: Our session number
+        :type local_number: int
+        :param now: Current time in seconds
+        :type now: float
+        """
+        self.device_address = device_address
+        self.ip_address = ip_address
+        self.local_number = local_number
+        self.last_sent = now
+        self.last_received = now
+
+
+class SessionManager(object):
+    """Opens, keeps alive and closes sessions with remote devices."""
+    device = None
+    """The local device"""
+    connection = None
+    """:type: hiqnet.service.ip.Connection"""
+    requests = None
+    """:type: hiqnet.service.pending.PendingRequests"""
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    keepalive = DEFAULT_KEEPALIVE / 1000.0
+    """Keep alive period in seconds"""
+    sessions = None
+    """Sessions by peer HiQnet address"""
+    on_dead = None
+    """Called with the session of a peer that went silent"""
+    keepalives_sent = 0
+    _tick = None
+    _wheel = None
+    _position = 0
+    _loop = None
+
+    def __init__(self, device, connection, requests=None, keepalive=DEFAULT_KEEPALIVE,
+                 slots=DEFAULT_WHEEL_SLOTS, clock=None, on_dead=None):
+        """Build a session manager.
+
+        :param device: The local device
+        :type device: hiqnet.device.Device
+        :param connection: Where to send commands
+        :type connection: hiqnet.service.ip.Connection
+        :param requests: Pending requests tracker, to wait for HELLO replies.
+            May be set later when it sends through this session manager.
+        :type requests: hiqnet.service.pending.PendingRequests
+        :param keepalive: Keep alive period in ms
+        :type keepalive: int
+        :param slots: Timer wheel slots per keep alive period
+        :type slots: int
+        :param clock: Scheduler. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        :param on_dead: Called with the session of a peer that went silent
+        :type on_dead: callable
+        """
+        self.device = device
+        self.connection = connection
+        self.requests = requests
+        self.keepalive = keepalive / 1000.0
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.on_dead = on_dead
+        self.sessions = {}
+        self._tick = self.keepalive / slots
+        self._wheel = [set() for _ in range(slots)]
+
+    def start(self):
+        """Start the keep alive timer."""
+        if self._loop is None:
+            self._loop = task.LoopingCall(self._advance)
+            self._loop.clock = self.clock
+            self._loop.start(self._tick, now=False)
+
+    def stop(self):
+        """Stop the keep alive timer."""
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+
+    def open(self, device_address, ip_address):
+        """Open a session with a remote device.
+
+        :param device_address: Peer HiQnet address
+        :type device_address: int
+        :param ip_address: Peer IPv4 address
+        :type ip_address: str
+        :return: Fires with the session once the peer replied
+        :rtype: twisted.internet.defer.Deferred
+        """
+        command = Command(source=self.device.address,
+                          destination=FullyQualifiedAddress(device_address=device_address))
+        local_number = command.hello()
+        session = Session(device_address, ip_address, local_number, self.clock.seconds())
+        self.sessions[device_address] = session
+        self._schedule(session, session.last_sent + self.keepalive)
+        self.start()
+
+        def established(reply):
+            session.remote_number = reply.hello_session_number
+            session.established = True
+            return session
+
+        def failed(failure):
+            self._forget(session)
+            return failure
+
+        d = self.requests.request(command, ip_address)
+        d.addCallbacks(established, failed)
+        return d
+
+    def close(self, device_address):
+        """Close a session.
+
+        :param device_address: Peer HiQnet address
+        :type device_address: int
+        """
+        session = self.sessions.get(device_address)
+        if session is None:
+            return
+        command = Command(source=self.device.address,
+                          destination=FullyQualifiedAddress(device_address=device_address))
+        command.goodbye(self.device.hiqnet_address)
+        self.sendto(command, session.ip_address)
+        self._forget(session)
+
+    def close_all(self):
+        """Close every session."""
+        for device_address in list(self.sessions):
+            self.close(device_address)
+
+    def sendto(self, command, destination='<broadcast>'):
+        """Send a command, within a session if there is one with its destination.
+
+        :param command: The command to send
+        :type command: Command
+        :param destination: Destination IPv4 address or '<broadcast>'
+        :type destination: str
+        """
+        session = self.sessions.get(command.destination_address.device_address)
+        if session is not None:
+            if session.remote_number is not None:
+                command.flags.session = 1
+                command.session_number = session.remote_number
+            session.last_sent = self.clock.seconds()
+        self.connection.sendto(command, destination)
+
+    def write(self, data, destination='<broadcast>'):
+        """Send an already encoded command as is.
+
+        :param data: Binary command
+        :type data: bytes
+        :param destination: Destination IPv4 address or '<broadcast>'
+        :type destination: str
+        """
+        self.connection.write(data, destination)
+
+    def handle_command(self, command, ip_address=None):
+        """Keep track of the peers activity and answer session commands.
+
+        :param command: A received command
+        :type command: Command
+        :param ip_address: Sender IPv4 address
+        :type ip_address: str
+        :return: Whether the command was a session command
+        :rtype: bool
+        """
+        device_address = command.source_address.device_address
+        session = self.sessions.get(device_address)
+        if session is not None:
+            session.last_received = self.clock.seconds()
+        name = command.message.name
+        if name == 'HELLO' and not command.flags.info:
+            # A peer opens a session with us
+            if session is None:
+                session = Session(device_address, ip_address, None, self.clock.seconds())
+                self.sessions[device_address] = session
+                self._schedule(session, session.last_sent + self.keepalive)
+                self.start()
+            session.remote_number = command.hello_session_number
+            session.established = True
+            reply = Command(source=self.device.address, destination=command.source_address)
+            reply.flags.info = 1
+            session.local_number = reply.hello(session.local_number)
+            self.sendto(reply, ip_address or session.ip_address)
+            return True
+        if name == 'GOODBYE':
+            if session is not None:
+                self._forget(session)
+            return True
+        return False
+
+    def _forget(self, session):
+        if self.sessions.get(session.device_address) is session:
+            del self.sessions[session.device_address]
+        if session._slot is not None:
+            self._wheel[session._slot].discard(session)
+            session._slot = None
+
+    def _schedule(self, session, due):
+        slots = len(self._wheel)
+        ticks = int(math.ceil((due - self.clock.seconds()) / self._tick))
+        ticks = min(max(ticks, 1), slots - 1)
+        session._slot = (self._position + ticks) % slots
+        self._wheel[session._slot].add(session)
+
+    def _advance(self):
+        """Process the sessions in the next wheel slot."""
+        self._position = (self._position + 1) % len(self._wheel)
+        due = self._wheel[self._position]
+        if not due:
+            return
+        self._wheel[self._position] = set()
+        now = self.clock.seconds()
+        # Half a tick early rather than half a tick late
+        margin = self._tick / 2
+        for session in due:
+            session._slot = None
+            if now - session.last_received > self.keepalive + margin:
+                self._forget(session)
+                if self.on_dead is not None:
+                    self.on_dead(session)
+                continue
+            if now - session.last_sent >= self.keepalive - margin:
+                self._send_keepalive(session)
+            self._schedule(session, min(session.last_sent + self.keepalive,
+                                        session.last_received + self.keepalive + margin))
+
+    def _send_keepalive(self, session):
+        command = Command(source=self.device.address,
+                          destination=FullyQualifiedAddress(device_address=session.device_address))
+        command.disco_info(self.device, 'I')
+        self.sendto(command, session.ip_address)
+        self.keepalives_sent += 1
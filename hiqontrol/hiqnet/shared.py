@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""State shared between processes through memory.
+
+A :class:`SharedMemory` is a named file in ``/dev/shm`` mapped in every process using it,
+the Python 2 counterpart of ``multiprocessing.shared_memory.SharedMemory``.
+
+A :class:`SeqlockBlock` lays a seqlock out in it, for one writer and any number of readers:
+the writer makes the sequence odd, writes, then makes it even again.
+Readers never lock nor copy the whole block: they read the values they need
+and retry if the sequence was odd or changed meanwhile.
+A writer that died while writing leaves the sequence odd: readers give up after `max_retries`
+and the block owner makes it even again with :meth:`SeqlockBlock.recover`.
+
+Block layout, little endian:
+
+======  ======  ==========================================================
+Offset  Type    Field
+======  ======  ==========================================================
+0       uint32  Sequence, odd while writing, incremented by 2 per write
+4       uint32  Payload length in bytes
+8       double  Time of the last write, seconds since the epoch
+16      bytes   Payload
+======  ======  ==========================================================
+
+.. note:: Readers on another CPU rely on the stores being seen in order, as on x86.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+import datatypes
+
+SHARED_MEMORY_PATH = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+HEADER = struct.Struct('<IId')
+HEADER_SIZE = HEADER.size
+_SEQUENCE = struct.Struct('<I')
+_LENGTH = struct.Struct('<I')
+
+PARAMETER = struct.Struct('<QdB7x')
+"""Parameters block entry: key, value and data type"""
+DEFAULT_PARAMETERS_CAPACITY = 65536
+DEFAULT_FRAME_SIZE = 65507
+"""Largest UDP payload"""
+DEFAULT_MAX_RETRIES = 10000
+"""Read attempts, a few milliseconds"""
+
+
+class BlockBusy(Exception):
+    """The block is being written for too long, its writer may have died while writing."""
+
+
+class SharedMemory(object):
+    """A named shared memory block."""
+    name = None
+    size = None
+    buf = None
+    """:type: mmap.mmap"""
+    path = None
+
+    def __init__(self, name, create=False, size=0, readonly=False):
+        """Create or open a block.
+
+        :param name: Unique name of the block
+        :type name: str
+        :param create: Create the block, which must not exist
+        :type create: bool
+        :param size: Size of a created block in bytes
+        :type size: int
+        :param readonly: Map an existing block read only
+        :type readonly: bool
+        """
+        self.name = name
+        self.path = os.path.join(SHARED_MEMORY_PATH, name)
+        if create:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+            try:
+                os.ftruncate(fd, size)
+            except OSError:
+                os.close(fd)
+                os.unlink(self.path)
+                raise
+        else:
+            fd = os.open(self.path, os.O_RDONLY if readonly else os.O_RDWR)
+        try:
+            self.size = os.fstat(fd).st_size
+            self.buf = mmap.mmap(fd, self.size, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """Unmap the block from this process."""
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+
+    def unlink(self):
+        """Destroy the block once every process closed it."""
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class SeqlockBlock(object):
+    """A seqlock versioned payload in a shared memory block."""
+    memory = None
+    """:type: SharedMemory"""
+    buf = None
+    capacity = None
+    """Largest payload in bytes"""
+    retries = 0
+    """Reads started again because of a concurrent write"""
+    max_retries = DEFAULT_MAX_RETRIES
+    _writing = None
+
+    def __init__(self, memory, max_retries=DEFAULT_MAX_RETRIES):
+        """Lay a seqlock out in a block.
+
+        :param memory: The block
+        :type memory: SharedMemory
+        :param max_retries: Read attempts before giving up
+        :type max_retries: int
+        """
+        self.memory = memory
+        self.max_retries = max_retries
+        self.buf = memory.buf
+        self.capacity = memory.size - HEADER_SIZE
+
+    @property
+    def sequence(self):
+        """Even when stable, changes on every write.
+
+        :rtype: int
+        """
+        return _SEQUENCE.unpack_from(self.buf, 0)[0]
+
+    @property
+    def writes(self):
+        """Writes since the block was created.
+
+        :rtype: int
+        """
+        return self.sequence // 2
+
+    def begin(self):
+        """Start writing."""
+        self._writing = self.sequence | 1
+        _SEQUENCE.pack_into(self.buf, 0, self._writing)
+
+    def end(self, length=None):
+        """Publish what was written.
+
+        :param length: New payload length. Unchanged by default.
+        :type length: int
+        """
+        if length is not None:
+            _LENGTH.pack_into(self.buf, 4, length)
+        struct.pack_into('<d', self.buf, 8, time.time())
+        _SEQUENCE.pack_into(self.buf, 0, (self._writing + 1) & 0xffffffff)
+        self._writing = None
+
+    def publish(self, data):
+        """Replace the payload.
+
+        :param data: The new payload, at most capacity bytes
+        :type data: bytes
+        """
+        length = len(data)
+        if length > self.capacity:
+            raise ValueError("%d bytes payload doesn't fit a %d bytes block" % (length, self.capacity))
+        self.begin()
+        self.buf[HEADER_SIZE:HEADER_SIZE + length] = data
+        self.end(length)
+
+    def read(self, reader, *args):
+        """Read consistent values.
+
+        :param reader: Called with the buffer, the payload length and args. Called again on a concurrent write.
+        :type reader: callable
+        :return: The sequence and what the reader returned
+        :rtype: tuple
+        :raises BlockBusy: When no consistent read happened within max_retries attempts
+        """
+        buf = self.buf
+        for _ in range(self.max_retries):
+            before, length, stamp = HEADER.unpack_from(buf, 0)
+            if before & 1:
+                self.retries += 1
+                continue
+            result = reader(buf, length, *args)
+            if _SEQUENCE.unpack_from(buf, 0)[0] == before:
+                return before, result
+            self.retries += 1
+        raise BlockBusy("No consistent read of %s in %d attempts" % (self.memory.name, self.max_retries))
+
+    def recover(self):
+        """Make the sequence even again after the writer died while writing.
+
+        Only call it when no writer is left. The payload may be partly written.
+
+        :return: Whether the block was left being written
+        :rtype: bool
+        """
+        sequence = self.sequence
+        if not sequence & 1:
+            return False
+        _SEQUENCE.pack_into(self.buf, 0, (sequence + 1) & 0xffffffff)
+        self._writing = None
+        return True
+
+    def payload(self):
+        """Copy the payload.
+
+        :return: The sequence and the payload
+        :rtype: tuple
+        """
+        return self.read(_payload)
+
+    def stamp(self):
+        """Time of the last write.
+
+        :rtype: float
+        """
+        return HEADER.unpack_from(self.buf, 0)[2]
+
+
+def _payload(buf, length):
+    return buf[HEADER_SIZE:HEADER_SIZE + length]
+
+
+def _count(buf, length):
+    return length // PARAMETER.size
+
+
+def _keys(buf, length, start):
+    return [PARAMETER.unpack_from(buf, HEADER_SIZE + slot * PARAMETER.size)[0]
+            for slot in range(start, length // PARAMETER.size)]
+
+
+def _entry(buf, length, slot):
+    return PARAMETER.unpack_from(buf, HEADER_SIZE + slot * PARAMETER.size)
+
+
+class SharedParameters(object):
+    """A parameters store published in a seqlock block.
+
+    Entries are the store slots: the key, the numeric value and the data type.
+    Non numeric values (STRING and BLOCK) are published as NaN.
+    """
+    block = None
+    """:type: SeqlockBlock"""
+    capacity = None
+    """Slots that fit the block"""
+    overflow = 0
+    """Updates of slots beyond the capacity"""
+    _slots = None
+    """Reader side slots by key"""
+
+    def __init__(self, memory):
+        """Publish or read parameters.
+
+        :param memory: The block
+        :type memory: SharedMemory
+        """
+        self.block = SeqlockBlock(memory)
+        self.capacity = self.block.capacity // PARAMETER.size
+        self._slots = {}
+
+    @staticmethod
+    def size(capacity=DEFAULT_PARAMETERS_CAPACITY):
+        """Block size for a number of slots.
+
+        :rtype: int
+        """
+        return HEADER_SIZE + capacity * PARAMETER.size
+
+    def attach(self, store):
+        """Publish a store, from now on.
+
+        :param store: The writer's store
+        :type store: hiqnet.store.ParameterStore
+        """
+        self.clear()
+        for key in store.keys:
+            self._publish(store, key)
+        store.add_listener(lambda key, value: self._publish(store, key))
+
+    def clear(self):
+        """Forget every entry."""
+        self.block.begin()
+        self.block.end(0)
+
+    def _publish(self, store, key):
+        slot = store.slot(key)
+        if slot >= self.capacity:
+            self.overflow += 1
+            return
+        data_type = store.data_types[slot]
+        value = store.values[slot] if datatypes.is_numeric(data_type) else float('nan')
+        block = self.block
+        length = max(_LENGTH.unpack_from(block.buf, 4)[0], (slot + 1) * PARAMETER.size)
+        block.begin()
+        PARAMETER.pack_into(block.buf, HEADER_SIZE + slot * PARAMETER.size, key, value, data_type)
+        block.end(length)
+
+    def __len__(self):
+        return self.block.read(_count)[1]
+
+    def _refresh(self):
+        """Index the slots added since the last read."""
+        count = len(self)
+        if count < len(self._slots):
+            # The writer started over
+            self._slots = {}
+        if count > len(self._slots):
+            start = len(self._slots)
+            for slot, key in enumerate(self.block.read(_keys, start)[1], start):
+                self._slots[key] = slot
+
+    def keys(self):
+        """Published parameter keys.
+
+        :rtype: list of int
+        """
+        self._refresh()
+        return list(self._slots)
+
+    def entry(self, key):
+        """Get a parameter.
+
+        :param key: Parameter key
+        :type key: int
+        :return: Key, value and data type or None if the parameter isn't published
+        :rtype: tuple
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            self._refresh()
+            slot = self._slots.get(key)
+            if slot is None:
+                return None
+        entry = self.block.read(_entry, slot)[1]
+        if entry[0] != key:
+            # The writer started over, the slots moved
+            self._slots = {}
+            return self.entry(key)
+        return entry
+
+    def get(self, key, default=None):
+        """Get a parameter value.
+
+        :param key: Parameter key
+        :type key: int
+        :param default: Returned if the parameter is unknown
+        """
+        entry = self.entry(key)
+        if entry is None:
+            return default
+        return entry[1]
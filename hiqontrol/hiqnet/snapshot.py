@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Client side snapshots of the parameters state.
+
+A snapshot is an immutable copy of the parameter store arrays.
+Two snapshots are compared block by block: identical blocks are skipped with a single array comparison
+and only differing blocks are scanned for the changed slots.
+
+Recalling a snapshot sends one MULTPARMSET per object with only the parameters that differ
+from the current state.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import array
+import time
+
+from protocol import Command
+from store import key_address
+
+DIFF_BLOCK_SIZE = 256
+"""Number of slots compared at once"""
+
+
+class Snapshot(object):
+    """Immutable copy of a parameter store state."""
+    name = None
+    timestamp = None
+    values = None
+    """:type: array.array of doubles"""
+    data_types = None
+    """:type: array.array of unsigned bytes"""
+    blobs = None
+    keys = None
+
+    def __init__(self, store, name=None):
+        """Capture a store state.
+
+        :param store: The store to capture
+        :type store: hiqnet.store.ParameterStore
+        :param name: A name for the snapshot
+        :type name: str
+        """
+        self.name = name
+        self.timestamp = time.time()
+        self.values = array.array('d', store.values)
+        self.data_types = array.array('B', store.data_types)
+        self.blobs = dict(store.blobs)
+        self.keys = tuple(store.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__:
+            raise AttributeError("Snapshots are immutable")
+        super(Snapshot, self).__setattr__(name, value)
+
+    def value(self, slot):
+        """Get a slot value.
+
+        :param slot: Slot
+        :type slot: int
+        """
+        if slot in self.blobs:
+            return self.blobs[slot]
+        return self.values[slot]
+
+
+def diff(old, new):
+    """Find the slots whose value differ.
+
+    Store slots are never reused, so slots are comparable between snapshots of the same store.
+    Slots allocated after the old snapshot are reported as changed.
+
+    :param old: Reference state
+    :type old: Snapshot or hiqnet.store.ParameterStore
+    :param new: Compared state
+    :type new: Snapshot or hiqnet.store.ParameterStore
+    :return: Changed slots in ascending order
+    :rtype: list of int
+    """
+    changed = []
+    common = min(len(old.keys), len(new.keys))
+    old_values = old.values
+    new_values = new.values
+    old_types = old.data_types
+    new_types = new.data_types
+    for start in range(0, common, DIFF_BLOCK_SIZE):
+        end = min(start + DIFF_BLOCK_SIZE, common)
+        if old_values[start:end] == new_values[start:end] and old_types[start:end] == new_types[start:end]:
+            continue
+        for slot in range(start, end):
+            if old_values[slot] != new_values[slot] or old_types[slot] != new_types[slot]:
+                changed.append(slot)
+    if old.blobs != new.blobs:
+        for slot in set(old.blobs) | set(new.blobs):
+            if slot < common and old.blobs.get(slot) != new.blobs.get(slot):
+                changed.append(slot)
+        changed = sorted(set(changed))
+    changed.extend(range(common, len(new.keys)))
+    return changed
+
+
+def recall_commands(source, target, current):
+    """Build the commands bringing the current state to a snapshot.
+
+    :param source: Local device address
+    :type source: hiqnet.protocol.FullyQualifiedAddress
+    :param target: State to recall
+    :type target: Snapshot
+    :param current: Current state
+    :type current: Snapshot or hiqnet.store.ParameterStore
+    :return: One MULTPARMSET command per object with changed parameters
+    :rtype: list of hiqnet.protocol.Command
+    """
+    by_object = {}
+    for slot in diff(current, target):
+        key = target.keys[slot]
+        by_object.setdefault(key >> 16, []).append(
+            (key & 0xffff, target.data_types[slot], target.value(slot)))
+    commands = []
+    for address, parameters in sorted(by_object.items()):
+        command = Command(source=source, destination=key_address(address << 16))
+        command.multi_param_set(parameters)
+        commands.append(command)
+    return commands
+
+
+def recall(connection, ip_address, source, target, current):
+    """Bring the current state to a snapshot.
+
+    :param connection: Where to send the commands
+    :type connection: hiqnet.service.ip.Connection
+    :param ip_address: Remote device IPv4 address
+    :type ip_address: str
+    :param source: Local device address
+    :type source: hiqnet.protocol.FullyQualifiedAddress
+    :param target: State to recall
+    :type target: Snapshot
+    :param current: Current state
+    :type current: Snapshot or hiqnet.store.ParameterStore
+    :return: Number of commands sent
+    :rtype: int
+    """
+    commands = recall_commands(source, target, current)
+    for command in commands:
+        connection.sendto(command, ip_address)
+    return len(commands)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""Local HiQnet parameters store.
+
+Mirrors remote parameters values.
+
+Each parameter is identified by a key made from its object fully qualified address and its parameter ID.
+The key is used once to get a slot. The slot indexes flat arrays holding the values and data types.
+Non numeric values (STRING and BLOCK) are kept aside.
+"""
+
+__author__ = 'Raphaël Doursenaud'
+
+import array
+import struct
+
+import datatypes
+from protocol import FullyQualifiedAddress
+
+_ADDRESS_PREFIX = b'\x00\x00'
+
+
+def parameter_key(address, parameter_id):
+    """Build a parameter key.
+
+    :param address: The parameter's object address
+    :type address: FullyQualifiedAddress
+    :param parameter_id: The parameter ID
+    :type parameter_id: int
+    :return: 16 bits device, 8 bits VD, 24 bits object and 16 bits parameter ID packed in an int
+    :rtype: int
+    """
+    return struct.unpack('!Q', _ADDRESS_PREFIX + bytes(address))[0] << 16 | parameter_id
+
+
+def address_key(address):
+    """Build the key shared by all the parameters of an address.
+
+    :param address: A fully qualified address
+    :type address: FullyQualifiedAddress
+    :rtype: int
+    """
+    return parameter_key(address, 0) >> 16
+
+
+def split_key(key):
+    """Split a parameter key.
+
+    :param key: A parameter key
+    :type key: int
+    :return: Device address, VD address, object address and parameter ID
+    :rtype: tuple
+    """
+    return key >> 48, (key >> 40) & 0xff, (key >> 16) & 0xffffff, key & 0xffff
+
+
+def key_address(key):
+    """Get the object address of a parameter key.
+
+    :param key: A parameter key
+    :type key: int
+    :rtype: FullyQualifiedAddress
+    """
+    address = struct.pack('!Q', key)
+    return FullyQualifiedAddress(devicevdobject=address[0:6])
+
+
+class ParameterStore(object):
+    """Array backed parameters values."""
+    values = None
+    """:type: array.array of doubles"""
+    data_types = None
+    """:type: array.array of unsigned bytes"""
+    blobs = None
+    """Non numeric values by slot"""
+    keys = None
+    """Parameter key by slot"""
+    _slots = None
+    _listeners = None
+    _global_listeners = None
+
+    def __init__(self):
+        self.values = array.array('d')
+        self.data_types = array.array('B')
+        self.blobs = {}
+        self.keys = []
+        self._slots = {}
+        self._listeners = []
+        self._global_listeners = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def slot(self, key, data_type=datatypes.LONG):
+        """Get a parameter slot, allocating it if needed.
+
+        :param key: Parameter key
+        :type key: int
+        :param data_type: Data type to use when allocating
+        :type data_type: int
+        :rtype: int
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = len(self.keys)
+            self._slots[key] = slot
+            self.keys.append(key)
+            self.values.append(0.0)
+            self.data_types.append(data_type)
+            self._listeners.append(None)
+        return slot
+
+    def get(self, key, default=None):
+        """Get a parameter value.
+
+        :param key: Parameter key
+        :type key: int
+        :param default: Returned if the parameter is unknown
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            return default
+        if slot in self.blobs:
+            return self.blobs[slot]
+        return self.values[slot]
+
+    def update(self, key, data_type, value):
+        """Set a parameter value and notify the listeners if it changed.
+
+        :param key: Parameter key
+        :type key: int
+        :param data_type: Value data type
+        :type data_type: int
+        :param value: The new value
+        :return: Whether the value changed
+        :rtype: bool
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self.slot(key, data_type)
+        elif self.data_types[slot] == data_type:
+            if datatypes.is_numeric(data_type):
+                if self.values[slot] == value:
+                    return False
+            elif self.blobs.get(slot) == value:
+                return False
+        self.data_types[slot] = data_type
+        if datatypes.is_numeric(data_type):
+            self.values[slot] = value
+            self.blobs.pop(slot, None)
+        else:
+            self.blobs[slot] = value
+        listeners = self._listeners[slot]
+        if listeners:
+            for listener in listeners:
+                listener(key, value)
+        for listener in self._global_listeners:
+            listener(key, value)
+        return True
+
+    def add_listener(self, callback, key=None):
+        """Get notified of values changes.
+
+        :param callback: Called with the parameter key and value
+        :type callback: callable
+        :param key: Parameter key to listen to. All parameters if None.
+        :type key: int
+        """
+        if key is None:
+            self._global_listeners.append(callback)
+            return
+        slot = self.slot(key)
+        if self._listeners[slot] is None:
+            self._listeners[slot] = []
+        self._listeners[slot].append(callback)
+
+    def remove_listener(self, callback, key=None):
+        """Stop notifying a listener.
+
+        :param callback: A previously added callback
+        :type callback: callable
+        :param key: Parameter key the callback listens to. All parameters if None.
+        :type key: int
+        """
+        if key is None:
+            self._global_listeners.remove(callback)
+            return
+        slot = self._slots[key]
+        self._listeners[slot].remove(callback)
+        if not self._listeners[slot]:
+            self._listeners[slot] = None
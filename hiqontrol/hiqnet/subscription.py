@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""HiQnet parameters subscriptions.
+
+Rather than polling parameters, we ask the remote device to notify us about their changes.
+Notifications are MULTPARMSET commands sent to the subscriber address.
+They are applied to the local parameters store which notifies its listeners.
+
+Percentage subscriptions are notified with PARMSETPCT commands.
+Their normalised values are kept in a separate store.
+
+With a reliable sender, the subscriptions are retransmitted until the publisher acknowledges them,
+a lost one would leave its parameters silently stale.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+from twisted.python import log
+
+import datatypes
+from protocol import Command, FullyQualifiedAddress, DEFAULT_SENSOR_RATE, SUBSCRIPTION_TYPE_ALL
+from store import ParameterStore, address_key
+
+
+class Subscription(object):
+    """An active subscription."""
+    publisher = None
+    """:type: FullyQualifiedAddress"""
+    parameter_ids = None
+    """Subscribed parameter IDs or None for a whole virtual device subscription"""
+    ip_address = None
+    """:type: str"""
+    sensor_rate = DEFAULT_SENSOR_RATE
+    subscription_type = SUBSCRIPTION_TYPE_ALL
+    percent = False
+    """Whether values are notified as percentages"""
+
+    def __init__(self, publisher, parameter_ids, ip_address,
+                 sensor_rate=DEFAULT_SENSOR_RATE, subscription_type=SUBSCRIPTION_TYPE_ALL, percent=False):
+        """Describe a subscription.
+
+        :param publisher: Publisher object or virtual device address
+        :type publisher: FullyQualifiedAddress
+        :param parameter_ids: Parameter IDs or None for the whole virtual device
+        :type parameter_ids: set
+        :param ip_address: Publisher device IPv4 address
+        :type ip_address: str
+        :param sensor_rate: Minimum time between sensor parameters updates in ms
+        :type sensor_rate: int
+        :param subscription_type: Which kind of parameters are subscribed to
+        :type subscription_type: int
+        :param percent: Whether values are notified as percentages
+        :type percent: bool
+        """
+        self.publisher = publisher
+        self.parameter_ids = parameter_ids
+        self.ip_address = ip_address
+        self.sensor_rate = sensor_rate
+        self.subscription_type = subscription_type
+        self.percent = percent
+
+    @property
+    def whole_vd(self):
+        """Whether the subscription covers all the virtual device parameters.
+
+        :rtype: bool
+        """
+        return self.parameter_ids is None
+
+
+class SubscriptionManager(object):
+    """Keeps track of the active subscriptions and applies their notifications."""
+    device = None
+    """The local device, the subscriber"""
+    connection = None
+    """:type: hiqnet.service.ip.Connection"""
+    store = None
+    """:type: ParameterStore"""
+    subscriptions = None
+    """Active subscriptions by publisher address key"""
+    percent_store = None
+    """
+    Normalised values from percentage subscriptions
+
+    :type: ParameterStore
+    """
+    percent_subscriptions = None
+    """Active percentage subscriptions by publisher address key"""
+    reliable = None
+    """:type: hiqnet.service.reliable.ReliableSender"""
+
+    def __init__(self, device, connection, store=None, percent_store=None, reliable=None):
+        """Build a subscription manager.
+
+        :param device: The local device
+        :type device: hiqnet.device.Device
+        :param connection: Connection to send subscriptions commands through
+        :type connection: hiqnet.service.ip.Connection
+        :param store: Where to apply the notifications
+        :type store: ParameterStore
+        :param percent_store: Where to apply the percentage notifications
+        :type percent_store: ParameterStore
+        :param reliable: Delivers the subscriptions until acknowledged. Sent once through the connection by default.
+        :type reliable: hiqnet.service.reliable.ReliableSender
+        """
+        self.device = device
+        self.connection = connection
+        if store is None:
+            store = ParameterStore()
+        self.store = store
+        if percent_store is None:
+            percent_store = ParameterStore()
+        self.percent_store = percent_store
+        self.subscriptions = {}
+        self.percent_subscriptions = {}
+        self.reliable = reliable
+
+    def _command(self, destination):
+        return Command(source=self.device.address, destination=destination)
+
+    def _subscribe(self, message, ip_address):
+        if self.reliable is None:
+            self.connection.sendto(message, ip_address)
+            return
+        d = self.reliable.send(message, ip_address)
+        d.addErrback(log.err, "Subscription to %s not acknowledged" % ip_address)
+
+    def subscribe(self, publisher, parameter_ids, ip_address, sensor_rate=DEFAULT_SENSOR_RATE,
+                  subscription_type=SUBSCRIPTION_TYPE_ALL, percent=False):
+        """Subscribe to some parameters of an object.
+
+        :param publisher: Publisher object address
+        :type publisher: FullyQualifiedAddress
+        :param parameter_ids: Parameter IDs
+        :type parameter_ids: list of int
+        :param ip_address: Publisher device IPv4 address
+        :type ip_address: str
+        :param sensor_rate: Minimum time between sensor parameters updates in ms
+        :type sensor_rate: int
+        :param subscription_type: Which kind of parameters to subscribe to
+        :type subscription_type: int
+        :param percent: Get notified with normalised values (PARMSUBPCT)
+        :type percent: bool
+        :rtype: Subscription
+        """
+        subscriptions = self.percent_subscriptions if percent else self.subscriptions
+        key = address_key(publisher)
+        subscription = subscriptions.get(key)
+        if subscription is not None and subscription.whole_vd:
+            return subscription
+        if subscription is None:
+            subscription = Subscription(publisher, set(), ip_address, sensor_rate, subscription_type, percent)
+        new_ids = [parameter_id for parameter_id in parameter_ids if parameter_id not in subscription.parameter_ids]
+        if new_ids:
+            message = self._command(publisher)
+            pairs = [(parameter_id, parameter_id) for parameter_id in new_ids]
+            if percent:
+                message.param_subscribe_percent(pairs, self.device.address, sensor_rate, subscription_type)
+            else:
+                message.multi_param_subscribe(pairs, self.device.address, sensor_rate, subscription_type)
+            self._subscribe(message, ip_address)
+            subscription.parameter_ids.update(new_ids)
+        subscriptions[key] = subscription
+        return subscription
+
+    def subscribe_all(self, virtual_device, ip_address, sensor_rate=DEFAULT_SENSOR_RATE,
+                      subscription_type=SUBSCRIPTION_TYPE_ALL):
+        """Subscribe to all the parameters of a virtual device.
+
+        :param virtual_device: Publisher virtual device address
+        :type virtual_device: FullyQualifiedAddress
+        :param ip_address: Publisher device IPv4 address
+        :type ip_address: str
+        :param sensor_rate: Minimum time between sensor parameters updates in ms
+        :type sensor_rate: int
+        :param subscription_type: Which kind of parameters to subscribe to
+        :type subscription_type: int
+        :rtype: Subscription
+        """
+        message = self._command(virtual_device)
+        message.param_subscribe_all(self.device.address, sensor_rate, subscription_type)
+        self._subscribe(message, ip_address)
+        subscription = Subscription(virtual_device, None, ip_address, sensor_rate, subscription_type)
+        self.subscriptions[address_key(virtual_device)] = subscription
+        return subscription
+
+    def unsubscribe(self, publisher, parameter_ids=None, percent=False):
+        """Unsubscribe from some or all parameters of a publisher.
+
+        :param publisher: Publisher object or virtual device address
+        :type publisher: FullyQualifiedAddress
+        :param parameter_ids: Parameter IDs. All subscribed parameters if None.
+        :type parameter_ids: list of int
+        :param percent: Whether this is a percentage subscription
+        :type percent: bool
+        """
+        subscriptions = self.percent_subscriptions if percent else self.subscriptions
+        key = address_key(publisher)
+        subscription = subscriptions.get(key)
+        if subscription is None:
+            return
+        message = self._command(subscription.publisher)
+        if subscription.whole_vd:
+            message.param_unsubscribe_all(self.device.address, subscription.subscription_type)
+            del subscriptions[key]
+        else:
+            if parameter_ids is None:
+                parameter_ids = list(subscription.parameter_ids)
+            else:
+                parameter_ids = [parameter_id for parameter_id in parameter_ids
+                                 if parameter_id in subscription.parameter_ids]
+            if not parameter_ids:
+                return
+            message.multi_param_unsubscribe([(parameter_id, parameter_id) for parameter_id in parameter_ids],
+                                            self.device.address)
+            subscription.parameter_ids.difference_update(parameter_ids)
+            if not subscription.parameter_ids:
+                del subscriptions[key]
+        self.connection.sendto(message, subscription.ip_address)
+
+    def unsubscribe_all(self):
+        """Cancel every active subscription."""
+        for subscription in list(self.subscriptions.values()) + list(self.percent_subscriptions.values()):
+            self.unsubscribe(subscription.publisher, percent=subscription.percent)
+
+    def is_subscribed(self, address, parameter_id=None):
+        """Tell if notifications are expected for an address.
+
+        :param address: Object or virtual device address
+        :type address: FullyQualifiedAddress
+        :param parameter_id: Parameter ID
+        :type parameter_id: int
+        :rtype: bool
+        """
+        subscription = self.subscriptions.get(address_key(address))
+        if subscription is None:
+            subscription = self.subscriptions.get(address_key(
+                FullyQualifiedAddress(device_address=address.device_address, vd_address=address.vd_address)))
+            return subscription is not None and subscription.whole_vd
+        return subscription.whole_vd or parameter_id is None or parameter_id in subscription.parameter_ids
+
+    def handle_command(self, command):
+        """Apply a notification to the store.
+
+        :param command: A received command
+        :type command: Command
+        :return: Whether the command was a parameters notification
+        :rtype: bool
+        """
+        name = command.message.name
+        if name == 'MULTPARMSET' and command.parameters is not None:
+            update = self.store.update
+            base = address_key(command.source_address) << 16
+            for parameter_id, data_type, value in command.parameters:
+                update(base | parameter_id, data_type, value)
+            return True
+        if name == 'PARMSETPCT' and command.percentages is not None:
+            update = self.percent_store.update
+            base = address_key(command.source_address) << 16
+            for parameter_id, fraction in command.percentages:
+                update(base | parameter_id, datatypes.FLOAT64, fraction)
+            return True
+        return False
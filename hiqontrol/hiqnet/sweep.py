@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""HiQnet unicast discovery sweep.
+
+Broadcasts don't cross routers. To find devices on other subnets, every address of the given
+CIDR ranges is probed with a unicast DISCOINFO query or GETATTR request.
+
+- At most `window` probes are in flight, a new one is sent as soon as a host answers or times out.
+- All probes share the same timeout so they time out in the order they were sent:
+  a single timer follows the oldest probe.
+- DISCOINFO replies reach the discovery registry like any other.
+  GETATTR replies are merged into the registry by the sweep.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import collections
+import socket
+import struct
+
+from twisted.internet import defer
+
+from device import ATTRIBUTE_SERIAL_NUMBER
+from protocol import Command, DiscoveryInfo, FullyQualifiedAddress
+
+DEFAULT_WINDOW = 128
+DEFAULT_TIMEOUT = 0.5  # s
+
+PROBE_DISCOINFO = 'DISCOINFO'
+PROBE_GETATTR = 'GETATTR'
+
+
+def hosts(cidr):
+    """List the host addresses of a CIDR range.
+
+    Network and broadcast addresses are skipped, except for /31 and /32 ranges.
+
+    :param cidr: Range such as '192.168.1.0/24'
+    :type cidr: str
+    :rtype: generator of str
+    """
+    network, _, prefix = cidr.partition('/')
+    prefix = int(prefix) if prefix else 32
+    if not 0 <= prefix <= 32:
+        raise ValueError("Invalid prefix length: %s" % cidr)
+    mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+    first = struct.unpack('!L', socket.inet_aton(network))[0] & mask
+    last = first | (~mask & 0xffffffff)
+    if prefix < 31:
+        first += 1
+        last -= 1
+    for address in range(first, last + 1):
+        yield socket.inet_ntoa(struct.pack('!L', address))
+
+
+class Sweep(object):
+    """Probes every address of CIDR ranges."""
+    device = None
+    """The local device"""
+    connection = None
+    """:type: hiqnet.service.ip.Connection"""
+    registry = None
+    """:type: hiqnet.discovery.DiscoveryRegistry"""
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    window = DEFAULT_WINDOW
+    timeout = DEFAULT_TIMEOUT
+    probe = PROBE_DISCOINFO
+    sent = 0
+    answered = 0
+    timeouts = 0
+    started = None
+    finished = None
+    _hosts = None
+    _found = None
+    _in_flight = None
+    """Probed hosts and their deadline, oldest first"""
+    _template = None
+    _timer = None
+    _deferred = None
+
+    def __init__(self, device, connection, registry, window=DEFAULT_WINDOW, timeout=DEFAULT_TIMEOUT,
+                 probe=PROBE_DISCOINFO, clock=None):
+        """Build a sweep.
+
+        :param device: The local device
+        :type device: hiqnet.device.Device
+        :param connection: Where to send the probes
+        :type connection: hiqnet.service.ip.Connection
+        :param registry: Where the found devices go
+        :type registry: hiqnet.discovery.DiscoveryRegistry
+        :param window: Maximum probes in flight
+        :type window: int
+        :param timeout: Time to wait for each host in seconds
+        :type timeout: float
+        :param probe: PROBE_DISCOINFO or PROBE_GETATTR
+        :type probe: str
+        :param clock: Scheduler. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        if probe not in (PROBE_DISCOINFO, PROBE_GETATTR):
+            raise ValueError("Unknown probe: %s" % probe)
+        self.device = device
+        self.connection = connection
+        self.registry = registry
+        self.window = window
+        self.timeout = timeout
+        self.probe = probe
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self._in_flight = collections.OrderedDict()
+
+    @property
+    def elapsed(self):
+        """Sweep duration in seconds.
+
+        :rtype: float
+        """
+        if self.started is None:
+            return 0.0
+        end = self.finished if self.finished is not None else self.clock.seconds()
+        return end - self.started
+
+    def sweep(self, ranges):
+        """Probe every host of the ranges.
+
+        :param ranges: CIDR ranges
+        :type ranges: list of str
+        :return: Fires with the IPv4 addresses of the hosts that answered
+        :rtype: defer.Deferred
+        """
+        if self._deferred is not None:
+            raise RuntimeError("A sweep is already running")
+        self._hosts = (host for cidr in ranges for host in hosts(cidr))
+        self._found = []
+        self._template = self._encode()
+        self.started = self.clock.seconds()
+        self.finished = None
+        self._deferred = defer.Deferred()
+        self._fill()
+        return self._deferred
+
+    def _encode(self):
+        command = Command(source=self.device.address, destination=FullyQualifiedAddress.broadcast_address(),
+                          sequence_number=0)
+        if self.probe == PROBE_DISCOINFO:
+            command.disco_info(self.device, 'Q')
+        else:
+            command.get_attributes([ATTRIBUTE_SERIAL_NUMBER])
+        return bytearray(bytes(command))
+
+    def _fill(self):
+        template = self._template
+        destination = FullyQualifiedAddress.broadcast_address()
+        while len(self._in_flight) < self.window:
+            host = next(self._hosts, None)
+            if host is None:
+                break
+            template[23:25] = struct.pack('!H', Command.sequence_numbers.next(self.device.address, destination))
+            self._in_flight[host] = self.clock.seconds() + self.timeout
+            self.connection.write(bytes(template), host)
+            self.sent += 1
+        if not self._in_flight:
+            self._done()
+        elif self._timer is None:
+            self._schedule()
+
+    def _schedule(self):
+        deadline = next(iter(self._in_flight.values()))
+        self._timer = self.clock.callLater(max(deadline - self.clock.seconds(), 0), self._expire)
+
+    def _expire(self):
+        self._timer = None
+        now = self.clock.seconds()
+        while self._in_flight:
+            host, deadline = next(iter(self._in_flight.items()))
+            if deadline > now:
+                break
+            del self._in_flight[host]
+            self.timeouts += 1
+        self._fill()
+
+    def _done(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        self.finished = self.clock.seconds()
+        d, self._deferred = self._deferred, None
+        d.callback(self._found)
+
+    def stop(self):
+        """Give up the remaining hosts. The sweep fires with the hosts found so far."""
+        if self._deferred is None:
+            return
+        self._hosts = iter(())
+        self._in_flight.clear()
+        self._done()
+
+    def handle_command(self, command, ip_address=None):
+        """Match probe replies.
+
+        :param command: A received command
+        :type command: hiqnet.protocol.Command
+        :param ip_address: Sender IPv4 address
+        :type ip_address: str
+        :return: Whether the command was a GETATTR probe reply
+        :rtype: bool
+        """
+        if ip_address not in self._in_flight:
+            return False
+        name = command.message.name
+        if name == PROBE_DISCOINFO and command.discovery is not None:
+            # The registry learns from the reply itself
+            getattr_reply = False
+        elif name == PROBE_GETATTR and command.flags.info and command.attributes is not None:
+            info = DiscoveryInfo()
+            info.device_address = command.source_address.device_address
+            for attribute_id, _, value in command.attributes:
+                if attribute_id == ATTRIBUTE_SERIAL_NUMBER:
+                    info.serial_number = value
+            self.registry.update(info, ip_address)
+            getattr_reply = True
+        else:
+            return False
+        del self._in_flight[ip_address]
+        self.answered += 1
+        self._found.append(ip_address)
+        self._fill()
+        return getattr_reply
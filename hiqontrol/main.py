@@ -23,11 +23,11 @@ from kivy.uix.textinput import TextInput
 from kivy.uix.listview import CompositeListItem, ListItemButton
 from kivy.support import install_twisted_reactor
 
+from twisted.python import log
+
 import hiqnet
 import soundcraft
 
-on_rtd = environ.get('READTHEDOCS') == 'True'
-
 if __name__ == '__main__':
     install_twisted_reactor()
     from twisted.internet import reactor
@@ -35,9 +35,9 @@ if __name__ == '__main__':
 # FIXME: this should not be hardcoded but autodetected
 SI_COMPACT_16_IP = '192.168.1.20'
 SI_COMPACT_16_DEVICE_ADDRESS = 1619
-SI_COMPACT_16_SERIAL = b'\x53\x69\x43\x6f\x6d\x70\x61\x63\x74\x00\x00\x00\x00\x00\x00\x00'  # SiCompact
 
 APPNAME = 'HiQontrol'
+INSTRUMENTS_DUMP = 'instruments.json'
 
 
 class ListLocateButton(ListItemButton):
@@ -95,30 +95,33 @@ class HiQNetAddressInput(TextInput):
 class Control(object):
     locate = False
     source_device = None
-    udp_transport = None
-    tcp_transport = None
+    connection = None
+    """The app's connection, through its sessions and outbound scheduler"""
+    reliable = None
+    """Delivers the commands until acknowledged, :type: hiqnet.service.reliable.ReliableSender"""
 
-    def __init__(self, source_device, udp_transport, tcp_transport):
+    def __init__(self, source_device, connection, reliable):
         self.source_device = source_device
-        self.udp_transport = udp_transport
-        self.tcp_transport = tcp_transport
+        self.connection = connection
+        self.reliable = reliable
 
     def init(self, hiqnet_dest):
-        c = hiqnet.service.ip.Connection(self.udp_transport, self.tcp_transport)
+        c = self.connection
         source_address = self.source_device.address
         destination_address = hiqnet.protocol.FullyQualifiedAddress(device_address=hiqnet_dest)
         message = hiqnet.protocol.Command(source=source_address, destination=destination_address)
         return c, message
 
     def locate_toggle(self, hiqnet_dest, ip_dest, serial_dest):
-        c, message = self.init(hiqnet_dest)
+        _, message = self.init(hiqnet_dest)
         if not self.locate:
             message.locate_on(serial_dest)
             self.locate = True
         else:
             message.locate_off(serial_dest)
             self.locate = False
-        c.sendto(message, ip_dest)
+        d = self.reliable.send(message, ip_dest)
+        d.addErrback(log.err, "Locate not acknowledged by %s" % ip_dest)
 
 
 class HiQontrol(ScreenManager):
@@ -127,42 +130,201 @@ class HiQontrol(ScreenManager):
 
 class HiQontrolApp(App):
     __version__ = '0.0.3'
-    datastore = JsonStore('settings.json')
     store_needs_update = False
-    device = None
-    try:
-        device = hiqnet.device.Device(datastore.get('device_name')['value'], datastore.get('device_address')['value'])
-    except KeyError:
-        Logger.warning(APPNAME + ': Settings not found, will use sane defaults')
-        device_name = APPNAME
-        device = hiqnet.device.Device(device_name)
-        datastore.put('device_name', value=device.name)
-        datastore.put('device_address', value=device.hiqnet_address)
-    except TypeError:
-        if on_rtd:
-            pass
+    _datastore = None
+    _device = None
     control = None
+    subscriptions = None
+    requests = None
+    sessions = None
+    reliable = None
+    sequences = None
+    discovery = None
+    discovery_scheduler = None
+    negotiator = None
+    sweep = None
     screen = None
+    interfaces = None
+    pipeline = None
+    outbound = None
+    proxy = None
+    shards = None
+    meters_export = None
+    instruments = None
     udp_transport = None
     tcp_transport = None
+    tcp_pool = None
 
     def build(self):
-        reactor.listenTCP(hiqnet.service.ip.PORT, hiqnet.service.ip.Factory(self))
-        reactor.listenUDP(hiqnet.service.ip.PORT, hiqnet.service.ip.UDPProtocol(self))
-        reactor.listenUDP(soundcraft.ip.VUMETER_IP_PORT, soundcraft.ip.VuMeterUDPPRotocol(self))
+        import hiqnet.discovery
+        import hiqnet.service.duplicates
+        import hiqnet.service.instruments
+        import hiqnet.service.interfaces
+        import hiqnet.service.pipeline
+        import hiqnet.service.pool
+        # The library logs through Twisted
+        log.PythonLoggingObserver(loggerName=Logger.name).start()
+        self.instruments = hiqnet.service.instruments.Instruments()
+        self.pipeline = hiqnet.service.pipeline.DecodePipeline(self, instruments=self.instruments)
+        reactor.listenTCP(hiqnet.service.ip.PORT, hiqnet.service.ip.Factory(self, self.pipeline, self.instruments))
+        recent = hiqnet.service.duplicates.RecentBroadcasts()
+        try:
+            names = self.datastore.get('interfaces')['value']
+        except KeyError:
+            names = None
+        self.interfaces = hiqnet.service.interfaces.listen(self, names, recent, self.pipeline,
+                                                           instruments=self.instruments)
+        reactor.listenUDP(hiqnet.service.ip.PORT,
+                          hiqnet.service.ip.UDPProtocol(self, recent, self.interfaces, self.pipeline, self.instruments))
+        try:
+            consoles = self.datastore.get('shards')['value']
+        except KeyError:
+            consoles = None
+        if consoles:
+            # One worker process per console, owning its sockets, meters included
+            import hiqnet.service.shards
+            self.shards = hiqnet.service.shards.ShardSupervisor(soundcraft.ip.VUMETER_IP_PORT)
+            for console in consoles:
+                self.shards.start(console['ip_address'], console['hiqnet_address'])
+        else:
+            reactor.listenUDP(soundcraft.ip.VUMETER_IP_PORT,
+                              soundcraft.ip.VuMeterUDPPRotocol(self, self.pipeline, self.instruments))
+        self.tcp_pool = hiqnet.service.pool.TCPConnectionPool(self, pipeline=self.pipeline,
+                                                           instruments=self.instruments)
+        self.discovery = hiqnet.discovery.DiscoveryRegistry()
         self.title = APPNAME
         self.icon = 'assets/icon.png'
         self.screen = HiQontrol(list=self.populate())
+        self.discovery.add_listener(self.discovery_changed)
         return self.screen
 
     def on_start(self):
         """Initialize device and network communications."""
-        self.control = Control(self.device, self.udp_transport, self.tcp_transport)
+        import hiqnet.negotiation
+        import hiqnet.sequence
+        import hiqnet.service.outbound
+        import hiqnet.service.pending
+        import hiqnet.service.reliable
+        import hiqnet.session
+        import hiqnet.subscription
+        import hiqnet.sweep
+        connection = hiqnet.service.interfaces.MultiConnection(self.interfaces, self.udp_transport,
+                                                              self.tcp_transport, self.tcp_pool, self.instruments)
+        self.outbound = hiqnet.service.outbound.OutboundScheduler(connection, self.discovery)
+        # Commands to a peer carry its session number
+        self.sessions = hiqnet.session.SessionManager(self.device, self.outbound)
+        connection = self.sessions
+        self.requests = hiqnet.service.pending.PendingRequests(connection)
+        self.sessions.requests = self.requests
+        self.reliable = hiqnet.service.reliable.ReliableSender(connection)
+        self.control = Control(self.device, connection, self.reliable)
+        self.subscriptions = hiqnet.subscription.SubscriptionManager(self.device, connection,
+                                                                     reliable=self.reliable)
+        self.sequences = hiqnet.sequence.SequenceTracker()
+        self.discovery_scheduler = hiqnet.discovery.DiscoveryScheduler(self.device, connection, self.discovery)
+        self.negotiator = hiqnet.negotiation.AddressNegotiator(self.device, connection, self.discovery)
+        d = self.negotiator.negotiate(preferred=self.device.hiqnet_address)
+        d.addCallbacks(self.address_negotiated, self.address_negotiation_failed)
+        self.sweep = hiqnet.sweep.Sweep(self.device, connection, self.discovery)
+        try:
+            console = self.datastore.get('proxy_console')
+        except KeyError:
+            console = None
+        if console:
+            # Proxy mode: answer the control surfaces queries from a mirror of the console
+            import hiqnet.proxy
+            self.proxy = hiqnet.proxy.ReadCacheProxy(self.device, connection, console['ip_address'],
+                                                     console['hiqnet_address'], self.subscriptions, self.reliable)
+        try:
+            export = self.datastore.get('meters_export')['value']
+        except KeyError:
+            export = None
+        if export:
+            # Meters levels for the local recording and lighting tools
+            import soundcraft.meters
+            self.meters_export = soundcraft.meters.MeterExport(
+                soundcraft.meters.DEFAULT_NAME if export is True else export)
+        # Decoded commands are handled once per frame
+        self.pipeline.start()
+        Clock.schedule_interval(self.pipeline.drain, 0)
+        if self.shards is not None:
+            # The consoles workers own the meters port, their frames go through the pipeline like received ones
+            Clock.schedule_interval(self.poll_shards_meters, 0)
+        self.instruments.add_gauge('pipeline_backlog', lambda: self.pipeline.backlog)
+        for queue in self.pipeline.queues.queues:
+            self.instruments.add_gauge('inbound_' + queue.name, lambda queue=queue: len(queue))
+        for priority, name in enumerate(hiqnet.service.outbound.CLASS_NAMES):
+            self.instruments.add_gauge('outbound_' + name, lambda priority=priority: self.outbound.depth(priority))
+        try:
+            dump = self.datastore.get('instruments_dump')['value']
+        except KeyError:
+            dump = INSTRUMENTS_DUMP
+        self.instruments.start(dump)
+
+    # noinspection PyUnusedLocal
+    def poll_shards_meters(self, *args):
+        """Queue the meters frames published by the consoles workers."""
+        name = hiqnet.service.shards.FrameUDPProtocol.name
+        self.shards.poll_meters(lambda frame, console_ip: self.pipeline.submit_decoded(frame, console_ip, name))
+
+    def address_negotiated(self, address):
+        """Keep the negotiated address and start discovering.
+
+        :param address: The negotiated HiQnet address
+        :type address: int
+        """
+        Logger.info(APPNAME + ": HiQnet address %d negotiated in %.3f s (worst case %.3f s)"
+                    % (address, self.negotiator.elapsed, self.negotiator.worst_case))
+        self.datastore.put('device_address', value=address)
+        self.discovery_scheduler.invalidate()
+        self.discovery_scheduler.start()
+
+    def address_negotiation_failed(self, failure):
+        Logger.error(APPNAME + ": HiQnet address negotiation failed: " + failure.getErrorMessage())
+
+    def on_stop(self):
+        """Stop the decoding worker, the consoles workers and the meters export."""
+        Clock.unschedule(self.pipeline.drain)
+        self.pipeline.stop()
+        self.instruments.stop()
+        if self.shards is not None:
+            self.shards.stop()
+        if self.meters_export is not None:
+            self.meters_export.close()
 
     def on_pause(self):
         """Enable pause mode."""
         return True
 
+    @property
+    def datastore(self):
+        """Settings, opened on first use."""
+        if self._datastore is None:
+            self._datastore = JsonStore('settings.json')
+        return self._datastore
+
+    @property
+    def device(self):
+        """The local device, built from the settings on first use."""
+        if self._device is None:
+            self._device = self.load_device()
+        return self._device
+
+    @device.setter
+    def device(self, device):
+        self._device = device
+
+    def load_device(self):
+        try:
+            return hiqnet.device.Device(self.datastore.get('device_name')['value'],
+                                        self.datastore.get('device_address')['value'])
+        except KeyError:
+            Logger.warning(APPNAME + ': Settings not found, will use sane defaults')
+            device = hiqnet.device.Device(APPNAME)
+            self.datastore.put('device_name', value=device.name)
+            self.datastore.put('device_address', value=device.hiqnet_address)
+            return device
+
     def store_needs_udate(self):
         self.store_needs_update = True
 
@@ -174,7 +336,7 @@ class HiQontrolApp(App):
             Logger.info(APPNAME + ": Store updated, reloading device")
             self.device = hiqnet.device.Device(self.datastore.get('device_name')['value'],
                                                self.datastore.get('device_address')['value'])
-            self.control = Control(self.device, self.udp_transport, self.tcp_transport)
+            self.control = Control(self.device, self.sessions)
             self.store_needs_update = False
 
     def get_model(self):
@@ -217,15 +379,18 @@ class HiQontrolApp(App):
     def locate_toggle(self, hiqnet_dest, ip_dest, serial_dest):
         self.control.locate_toggle(hiqnet_dest, ip_dest, serial_dest)
 
-    def populate(self):
-        # FIXME: This should be dynamically detected from the network or manually added/removed
-        item_strings = ['0', '1']
-        integers_dict = {
-            '0': {'text': 'Si Compact 16', 'ip_address': SI_COMPACT_16_IP,
-                  'hiqnet_address': SI_COMPACT_16_DEVICE_ADDRESS,
-                  'is_selected': False},
-            '1': {'text': 'Lool', 'ip_address': '192.168.1.3', 'hiqnet_address': 9999, 'is_selected': False}}
+    def sweep_ranges(self, ranges):
+        """Look for devices on other subnets.
+
+        :param ranges: CIDR ranges
+        :type ranges: list of str
+        :return: Fires with the IPv4 addresses of the hosts that answered
+        :rtype: twisted.internet.defer.Deferred
+        """
+        return self.sweep.sweep(ranges)
 
+    def populate(self):
+        """Build the consoles list, filled in as devices are discovered."""
         args_converter = \
             lambda row_index, rec: \
             {'text': rec['text'],
@@ -242,13 +407,13 @@ class HiQontrolApp(App):
                                        'size_hint_x': None,
                                        'hiqnet_address': rec['hiqnet_address'],
                                        'ip_address': rec['ip_address'],
-                                       'serial_number': SI_COMPACT_16_SERIAL}},  # FIXME
+                                       'serial_number': rec['serial_number']}},
                            {'cls': ListMixButton,
                             'kwargs': {'text': '>',  # TODO: replace by a nice icon
                                        'size_hint_x': None}}]}
 
-        dict_adapter = DictAdapter(sorted_keys=item_strings,
-                                   data=integers_dict,
+        dict_adapter = DictAdapter(sorted_keys=[],
+                                   data={},
                                    args_converter=args_converter,
                                    selection_mode='single',
                                    allow_empty_selection=False,
@@ -256,6 +421,33 @@ class HiQontrolApp(App):
 
         return dict_adapter
 
+    def discovery_changed(self, event, device):
+        """Update the consoles list in place.
+
+        :param event: hiqnet.discovery.ADDED, CHANGED or REMOVED
+        :type event: str
+        :param device: The discovered device
+        :type device: hiqnet.discovery.DiscoveredDevice
+        """
+        adapter = self.screen.list
+        key = str(device.device_address)
+        if event == hiqnet.discovery.REMOVED:
+            if key in adapter.sorted_keys:
+                adapter.sorted_keys.remove(key)
+            adapter.data.pop(key, None)
+            return
+        for old_key, rec in list(adapter.data.items()):
+            if rec['serial_number'] == device.serial_number and old_key != key:
+                # The device changed address
+                adapter.sorted_keys.remove(old_key)
+                del adapter.data[old_key]
+        adapter.data[key] = {'text': device.name, 'ip_address': device.ip_address,
+                             'hiqnet_address': device.device_address,
+                             'serial_number': device.serial_number,
+                             'is_selected': False}
+        if key not in adapter.sorted_keys:
+            adapter.sorted_keys.append(key)
+
     def handle_message(self, message, host, protocol):
         """Handle messages received from twisted servers.
 
@@ -268,7 +460,33 @@ class HiQontrolApp(App):
         :type protocol: str
         :return:
         """
-        self.screen.debug.text = protocol + '(' + str(host) + ')' + binascii.hexlify(bytes(message))
+        if isinstance(message, hiqnet.protocol.Command):
+            self.sequences.track(message)
+            if self.proxy is not None and self.proxy.handle_command(message, host):
+                pass
+            elif self.reliable.handle_command(message, host):
+                pass
+            elif self.sessions.handle_command(message, host):
+                pass
+            elif self.negotiator.handle_command(message, host):
+                pass
+            elif self.sweep.handle_command(message, host):
+                pass
+            elif self.discovery_scheduler.handle_command(message, host):
+                pass
+            elif self.discovery.handle_command(message, host):
+                pass
+            elif not self.requests.handle_command(message):
+                started = self.instruments.timer()
+                if self.subscriptions.handle_command(message):
+                    self.instruments.lap(hiqnet.service.instruments.STORE, started)
+        elif self.meters_export is not None:
+            self.meters_export.handle_message(message, host, protocol)
+        started = self.instruments.timer()
+        # As received: error replies can't be encoded again
+        data = message.raw if isinstance(message, hiqnet.protocol.Command) else message
+        self.screen.debug.text = protocol + '(' + str(host) + ')' + binascii.hexlify(data)
+        self.instruments.lap(hiqnet.service.instruments.UI, started)
 
 if __name__ == '__main__':
     HiQontrolApp().run()
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
-"""Soundcraft meters library."""
+"""Soundcraft meters library.
+
+Only :mod:`soundcraft.ip` is imported with the package.
+Import :mod:`soundcraft.meters` and :mod:`soundcraft.relay` explicitly where they are used.
+"""
 
 __author__ = 'Raphaël Doursenaud'
 
-__all__ = ['ip']
+__all__ = ['ip', 'meters', 'relay']
 
 import ip
@@ -12,16 +12,34 @@ __author__ = 'Raphaël Doursenaud'
 import binascii
 from twisted.internet import protocol
 
+from hiqnet.service.instruments import DISPATCH, RECEIVE
+
 VUMETER_IP_PORT = 3333
+METERS = 'METERS'
+"""Message type of the meters frames, for the instruments"""
 
 
 class VuMeterUDPPRotocol(protocol.DatagramProtocol):
     """Soundcraft VU Meter Twisted UDP protocol."""
 
     name = "SoundcraftUDP"
+    pipeline = None
+    """:type: hiqnet.service.pipeline.DecodePipeline"""
+    instruments = None
+    """:type: hiqnet.service.instruments.Instruments"""
+
+    def __init__(self, app, pipeline=None, instruments=None):
+        """Build the protocol.
 
-    def __init__(self, app):
+        :param app: Receives the messages through its handle_message method
+        :param pipeline: Queues the messages for the main loop. Handled in place by default.
+        :type pipeline: hiqnet.service.pipeline.DecodePipeline
+        :param instruments: Times and counts the received frames
+        :type instruments: hiqnet.service.instruments.Instruments
+        """
         self.app = app
+        self.pipeline = pipeline
+        self.instruments = instruments
 
     def datagramReceived(self, data, addr):
         """Called when data is received.
@@ -32,6 +50,10 @@ class VuMeterUDPPRotocol(protocol.DatagramProtocol):
         :type addr: tuple
         """
         (host, port) = addr
+        instruments = self.instruments
+        if instruments is not None:
+            started = instruments.timer()
+            instruments.count_received(METERS)
 
         # FIXME: debugging output should go into a logger
         print("<=")
@@ -43,4 +65,13 @@ class VuMeterUDPPRotocol(protocol.DatagramProtocol):
         print(port)
 
         # TODO: Process some more :)
+        if self.pipeline is not None:
+            self.pipeline.submit_decoded(data, host, self.name)
+            if instruments is not None:
+                instruments.lap(RECEIVE, started)
+            return
+        if instruments is not None:
+            started = instruments.lap(RECEIVE, started)
         self.app.handle_message(data, host, self.name)
+        if instruments is not None:
+            instruments.lap(DISPATCH, started)
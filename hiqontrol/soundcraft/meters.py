@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""Soundcraft VU meters levels, exported through shared memory.
+
+Frames are made of 4 bytes meters (see :doc:`meterpacketdecoding`).
+The first two bytes of a meter are two readings of the same signal, 0xff meaning no signal.
+Their scale isn't documented: the louder reading is mapped linearly to a 0.0 to 1.0 level.
+
+The levels then go through the usual meters ballistics:
+instant attack, linear release, and a peak that holds before it releases too.
+
+:class:`MeterExport` publishes them into a named shared memory block,
+so that recording or lighting tools can read them at their own rate, without network traffic nor parsing.
+The block is ``/dev/shm/hiqontrol-meters`` by default, a :class:`hiqnet.shared.SeqlockBlock`.
+
+Layout, little endian:
+
+======  ========  ===========================================================
+Offset  Type      Field
+======  ========  ===========================================================
+0       uint32    Sequence, odd while writing, see :mod:`hiqnet.shared`
+4       uint32    Payload length in bytes
+8       double    Time of the last frame, seconds since the epoch
+16      char[4]   Magic, ``HQMT``
+20      uint16    Layout version, 1
+22      uint16    Meters count in the last frame
+24      uint32    Frame counter
+28      char[4]   Console IPv4 address
+32      float32   Meter 0 level, 0.0 to 1.0
+36      float32   Meter 0 peak, 0.0 to 1.0
+40      …         Meter 1 level and peak, and so on
+======  ========  ===========================================================
+
+A reader copies what it needs, then checks that the sequence is still the same, even value.
+Otherwise a frame was written meanwhile, and it reads again.
+See ``prototypes/meter_reader.py`` for a standalone reader.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import array
+import socket
+import struct
+import sys
+
+from hiqnet.shared import HEADER_SIZE, SeqlockBlock, SharedMemory
+
+from relay import METER_SIZE
+
+DEFAULT_NAME = 'hiqontrol-meters'
+MAGIC = b'HQMT'
+LAYOUT_VERSION = 1
+MAX_METERS = 256
+EXPORT_HEADER = struct.Struct('<4sHHI4s')
+METERS_OFFSET = HEADER_SIZE + EXPORT_HEADER.size
+METER = struct.Struct('<ff')
+"""Level and peak"""
+
+NO_SIGNAL = 0xff
+
+DEFAULT_RELEASE = 1.5
+"""Full scale per second"""
+DEFAULT_PEAK_HOLD = 1.5  # s
+DEFAULT_PEAK_RELEASE = 0.5
+"""Full scale per second"""
+
+
+def decode_levels(frame):
+    """Get the levels of a frame.
+
+    :param frame: Meters frame
+    :type frame: bytes
+    :return: Levels from 0.0 to 1.0
+    :rtype: list of float
+    """
+    data = bytearray(frame)
+    return [(NO_SIGNAL - min(data[offset], data[offset + 1])) / float(NO_SIGNAL)
+            for offset in range(0, len(data) - METER_SIZE + 1, METER_SIZE)]
+
+
+class MeterBallistics(object):
+    """Smooths the meters levels over time."""
+    release = DEFAULT_RELEASE
+    peak_hold = DEFAULT_PEAK_HOLD
+    peak_release = DEFAULT_PEAK_RELEASE
+    levels = None
+    """:type: array.array of floats"""
+    peaks = None
+    """:type: array.array of floats"""
+    _peak_stamps = None
+    _stamp = None
+
+    def __init__(self, release=DEFAULT_RELEASE, peak_hold=DEFAULT_PEAK_HOLD, peak_release=DEFAULT_PEAK_RELEASE):
+        """Build ballistics.
+
+        :param release: Level fall speed in full scale per second
+        :type release: float
+        :param peak_hold: Time a peak holds before falling, in seconds
+        :type peak_hold: float
+        :param peak_release: Peak fall speed in full scale per second
+        :type peak_release: float
+        """
+        self.release = release
+        self.peak_hold = peak_hold
+        self.peak_release = peak_release
+        self.levels = array.array('f')
+        self.peaks = array.array('f')
+        self._peak_stamps = array.array('d')
+
+    def __len__(self):
+        return len(self.levels)
+
+    def process(self, levels, now):
+        """Apply new levels.
+
+        :param levels: Levels from 0.0 to 1.0
+        :type levels: list of float
+        :param now: Current time in seconds
+        :type now: float
+        """
+        count = len(levels)
+        if count != len(self.levels):
+            # The frame layout changed, start over
+            self.levels = array.array('f', [0.0] * count)
+            self.peaks = array.array('f', [0.0] * count)
+            self._peak_stamps = array.array('d', [now] * count)
+        elapsed = now - self._stamp if self._stamp is not None else 0.0
+        self._stamp = now
+        fall = elapsed * self.release
+        current_levels = self.levels
+        peaks = self.peaks
+        peak_stamps = self._peak_stamps
+        for index, level in enumerate(levels):
+            current_levels[index] = max(level, current_levels[index] - fall)
+            if level >= peaks[index]:
+                peaks[index] = level
+                peak_stamps[index] = now
+            else:
+                held = now - peak_stamps[index] - self.peak_hold
+                if held > 0:
+                    peaks[index] = max(level, peaks[index] - min(held, elapsed) * self.peak_release)
+
+
+class MeterExport(object):
+    """Publishes the meters levels into shared memory."""
+    memory = None
+    """:type: hiqnet.shared.SharedMemory"""
+    block = None
+    """:type: hiqnet.shared.SeqlockBlock"""
+    console = None
+    """Only export this console IPv4 address. Any by default."""
+    ballistics = None
+    """:type: MeterBallistics"""
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    frames = 0
+    truncated = 0
+    """Frames with more than MAX_METERS meters"""
+
+    def __init__(self, name=DEFAULT_NAME, console=None, ballistics=None, clock=None):
+        """Create the shared memory block.
+
+        :param name: Shared memory block name
+        :type name: str
+        :param console: Only export this console IPv4 address. The first one heard by default.
+        :type console: str
+        :param ballistics: Defaults to the default MeterBallistics
+        :type ballistics: MeterBallistics
+        :param clock: Time source. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
+        try:
+            self.memory = SharedMemory(name, create=True, size=METERS_OFFSET + MAX_METERS * METER.size)
+        except OSError:
+            # Left over by a crashed instance
+            SharedMemory(name).unlink()
+            self.memory = SharedMemory(name, create=True, size=METERS_OFFSET + MAX_METERS * METER.size)
+        self.block = SeqlockBlock(self.memory)
+        self.block.begin()
+        EXPORT_HEADER.pack_into(self.block.buf, HEADER_SIZE, MAGIC, LAYOUT_VERSION, 0, 0, b'\x00' * 4)
+        self.block.end(EXPORT_HEADER.size)
+        self.console = console
+        if ballistics is None:
+            ballistics = MeterBallistics()
+        self.ballistics = ballistics
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+
+    # noinspection PyUnusedLocal
+    def handle_message(self, message, host, protocol_name):
+        """Export a frame received from a console.
+
+        :param message: Meters frame
+        :type message: bytes
+        :param host: Console IPv4 address
+        :type host: str
+        :param protocol_name: Protocol that received
+        :type protocol_name: str
+        """
+        if self.console is None:
+            self.console = host
+        elif host != self.console:
+            return
+        levels = decode_levels(message)
+        if len(levels) > MAX_METERS:
+            self.truncated += 1
+            del levels[MAX_METERS:]
+        ballistics = self.ballistics
+        ballistics.process(levels, self.clock.seconds())
+        self.frames += 1
+        meters = array.array('f', [0.0]) * (2 * len(levels))
+        meters[0::2] = ballistics.levels
+        meters[1::2] = ballistics.peaks
+        if sys.byteorder != 'little':
+            meters.byteswap()
+        buf = self.block.buf
+        self.block.begin()
+        EXPORT_HEADER.pack_into(buf, HEADER_SIZE, MAGIC, LAYOUT_VERSION, len(levels), self.frames & 0xffffffff,
+                                socket.inet_aton(host))
+        buf[METERS_OFFSET:METERS_OFFSET + len(meters) * meters.itemsize] = meters.tostring()
+        self.block.end(EXPORT_HEADER.size + len(meters) * meters.itemsize)
+
+    def close(self):
+        """Remove the shared memory block."""
+        self.memory.close()
+        self.memory.unlink()
+
+    def stats(self):
+        """Counters.
+
+        :rtype: dict
+        """
+        return {
+            'console': self.console,
+            'frames': self.frames,
+            'meters': len(self.ballistics),
+            'truncated': self.truncated,
+        }
+
+
+def _read(buf, length):
+    magic, version, count, frame, console = EXPORT_HEADER.unpack_from(buf, HEADER_SIZE)
+    meters = struct.unpack_from('<%df' % (2 * count), buf, METERS_OFFSET)
+    return frame, socket.inet_ntoa(console), meters[0::2], meters[1::2]
+
+
+class MeterReader(object):
+    """Reads the exported levels from another process."""
+    memory = None
+    """:type: hiqnet.shared.SharedMemory"""
+    block = None
+    """:type: hiqnet.shared.SeqlockBlock"""
+
+    def __init__(self, name=DEFAULT_NAME):
+        """Map an exported block.
+
+        :param name: Shared memory block name
+        :type name: str
+        """
+        self.memory = SharedMemory(name, readonly=True)
+        self.block = SeqlockBlock(self.memory)
+        magic, version = EXPORT_HEADER.unpack_from(self.memory.buf, HEADER_SIZE)[0:2]
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            self.memory.close()
+            raise ValueError("Not a version %d meters block: %s" % (LAYOUT_VERSION, name))
+
+    def read(self):
+        """Get the latest levels.
+
+        :return: Frame counter, console IPv4 address, levels and peaks
+        :rtype: tuple
+        """
+        return self.block.read(_read)[1]
+
+    def close(self):
+        self.memory.close()
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""Soundcraft VU meters fan-out relay.
+
+The relay receives one meters stream per console and re-publishes it to its clients,
+so the console sees one consumer however many tablets are connected.
+
+Clients subscribe by sending a JSON datagram to the relay port, and renew it before `client_timeout`::
+
+    {"console": "192.168.1.20", "rate": 10, "channels": [0, 1, 2, 3], "nonce": "5f0c2a9e61b7d834"}
+
+- console: console IPv4 address
+- rate: optional maximum frames per second, frames in between are dropped
+- channels: optional meters to keep, by index in the frame. All of them by default.
+- nonce: the relay's answer to the first request
+
+``{"console": "192.168.1.20", "unsubscribe": true, "nonce": "5f0c2a9e61b7d834"}`` ends the subscription.
+
+The frames are sent to the address and port the subscription came from.
+Since a datagram source is easily spoofed, a request without the right nonce
+is answered with ``{"nonce": "5f0c2a9e61b7d834"}`` instead of being applied.
+Only the client really listening at the source address gets it, so it has to repeat its requests with it.
+The nonce is derived from the client address and a secret of the relay, nothing is kept until it's confirmed.
+
+Invalid subscriptions are rejected: the rate must be a positive number
+and the channels indexes of meters in the console frames.
+The number of clients is capped, per console and in total.
+
+Frames are made of 4 bytes meters (see :doc:`meterpacketdecoding`), filtering keeps the selected ones in order.
+
+The listeners are told when a console gets its first client (CONSOLE_NEEDED)
+and loses its last one (CONSOLE_IDLE), to start and stop the upstream meters subscription.
+
+Run headless with ``python relay.py``.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import hashlib
+import hmac
+import json
+import numbers
+import os
+
+from twisted.internet import protocol
+
+from ip import VUMETER_IP_PORT, VuMeterUDPPRotocol
+
+RELAY_PORT = 3334
+METER_SIZE = 4
+"""Bytes per meter in a frame"""
+MAX_FRAME_METERS = 65507 // METER_SIZE
+"""Meters in the largest UDP payload"""
+DEFAULT_CLIENT_TIMEOUT = 10.0  # s
+DEFAULT_MAX_CLIENTS = 64
+DEFAULT_MAX_CONSOLE_CLIENTS = 16
+"""Clients per console"""
+
+CONSOLE_NEEDED = 'needed'
+CONSOLE_IDLE = 'idle'
+
+
+class RelayClient(object):
+    """A client of the relay."""
+    host = None
+    port = VUMETER_IP_PORT
+    console = None
+    interval = 0.0
+    """Minimum time between frames in seconds"""
+    channels = None
+    """:type: tuple of int"""
+    last_sent = None
+    expires = None
+    frames = 0
+    bytes_sent = 0
+    decimated = 0
+
+    def __init__(self, host, port, console, rate=None, channels=None):
+        """Build a client.
+
+        :param host: Client IPv4 address
+        :type host: str
+        :param port: Client UDP port
+        :type port: int
+        :param console: Console IPv4 address
+        :type console: str
+        :param rate: Maximum frames per second. Unlimited by default.
+        :type rate: float
+        :param channels: Meters to keep, by index. All of them by default.
+        :type channels: list of int
+        """
+        self.host = host
+        self.port = port
+        self.console = console
+        self.update(rate, channels)
+
+    def update(self, rate=None, channels=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.channels = tuple(channels) if channels is not None else None
+
+    def stats(self):
+        """:rtype: dict"""
+        return {
+            'console': self.console,
+            'frames': self.frames,
+            'bytes_sent': self.bytes_sent,
+            'decimated': self.decimated,
+        }
+
+
+def filter_frame(frame, channels):
+    """Keep some meters of a frame.
+
+    :param frame: Meters frame
+    :type frame: bytes
+    :param channels: Meters to keep, by index
+    :type channels: tuple of int
+    :rtype: bytes
+    """
+    return b''.join([frame[index * METER_SIZE:(index + 1) * METER_SIZE] for index in channels])
+
+
+class MeterRelay(object):
+    """Re-publishes the consoles meters streams to many clients."""
+    transport = None
+    """Sends to the clients, :type: twisted.internet.interfaces.IUDPTransport"""
+    clock = None
+    """:type: twisted.internet.interfaces.IReactorTime"""
+    client_timeout = DEFAULT_CLIENT_TIMEOUT
+    clients = None
+    """:type: dict of RelayClient by (host, port)"""
+    by_console = None
+    """:type: dict of list of RelayClient by console address"""
+    frames_received = None
+    """Frames by console address"""
+    meters = None
+    """Meters in the last frame by console address"""
+    max_clients = DEFAULT_MAX_CLIENTS
+    max_console_clients = DEFAULT_MAX_CONSOLE_CLIENTS
+    refused = 0
+    """Subscriptions refused for lack of room"""
+    _listeners = None
+    _timer = None
+
+    def __init__(self, client_timeout=DEFAULT_CLIENT_TIMEOUT, clock=None, max_clients=DEFAULT_MAX_CLIENTS,
+                 max_console_clients=DEFAULT_MAX_CONSOLE_CLIENTS):
+        """Build a relay.
+
+        :param client_timeout: Time before a client that didn't renew its subscription is dropped, in seconds
+        :type client_timeout: float
+        :param clock: Scheduler. Defaults to the global reactor.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        :param max_clients: Clients in total
+        :type max_clients: int
+        :param max_console_clients: Clients per console
+        :type max_console_clients: int
+        """
+        self.client_timeout = client_timeout
+        self.max_clients = max_clients
+        self.max_console_clients = max_console_clients
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.clients = {}
+        self.by_console = {}
+        self.frames_received = {}
+        self.meters = {}
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Be told about consoles getting their first client or losing their last one.
+
+        :param callback: Called with the event (CONSOLE_NEEDED or CONSOLE_IDLE) and the console address
+        :type callback: callable
+        """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def _notify(self, event, console):
+        for callback in list(self._listeners):
+            callback(event, console)
+
+    def subscribe(self, host, port, console, rate=None, channels=None):
+        """Add or renew a client subscription.
+
+        :param host: Client IPv4 address
+        :type host: str
+        :param port: Client UDP port
+        :type port: int
+        :param console: Console IPv4 address
+        :type console: str
+        :param rate: Maximum frames per second. Unlimited by default.
+        :type rate: float
+        :param channels: Meters to keep, by index. All of them by default.
+        :type channels: list of int
+        :return: None when there are too many clients already
+        :rtype: RelayClient
+        """
+        client = self.clients.get((host, port))
+        if client is not None and client.console != console:
+            self.unsubscribe(host, port)
+            client = None
+        if client is None:
+            if len(self.clients) >= self.max_clients \
+                    or len(self.by_console.get(console, ())) >= self.max_console_clients:
+                self.refused += 1
+                return None
+            client = self.clients[(host, port)] = RelayClient(host, port, console, rate, channels)
+            clients = self.by_console.setdefault(console, [])
+            clients.append(client)
+            if len(clients) == 1:
+                self._notify(CONSOLE_NEEDED, console)
+        else:
+            client.update(rate, channels)
+        client.expires = self.clock.seconds() + self.client_timeout
+        if self._timer is None:
+            self._timer = self.clock.callLater(self.client_timeout / 2, self._expire)
+        return client
+
+    def unsubscribe(self, host, port):
+        """Remove a client.
+
+        :param host: Client IPv4 address
+        :type host: str
+        :param port: Client UDP port
+        :type port: int
+        """
+        client = self.clients.pop((host, port), None)
+        if client is None:
+            return
+        clients = self.by_console[client.console]
+        clients.remove(client)
+        if not clients:
+            del self.by_console[client.console]
+            self._notify(CONSOLE_IDLE, client.console)
+
+    def _expire(self):
+        self._timer = None
+        now = self.clock.seconds()
+        for key, client in list(self.clients.items()):
+            if client.expires <= now:
+                self.unsubscribe(*key)
+        if self.clients:
+            self._timer = self.clock.callLater(self.client_timeout / 2, self._expire)
+
+    def stop(self):
+        """Drop every client."""
+        for key in list(self.clients):
+            self.unsubscribe(*key)
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    # noinspection PyUnusedLocal
+    def handle_message(self, message, host, protocol_name):
+        """Relay a frame received from a console.
+
+        :param message: Meters frame
+        :type message: bytes
+        :param host: Console IPv4 address
+        :type host: str
+        :param protocol_name: Protocol that received
+        :type protocol_name: str
+        """
+        self.relay(message, host)
+
+    def relay(self, frame, console):
+        """Send a frame to the clients of its console.
+
+        :param frame: Meters frame
+        :type frame: bytes
+        :param console: Console IPv4 address
+        :type console: str
+        """
+        self.frames_received[console] = self.frames_received.get(console, 0) + 1
+        self.meters[console] = len(frame) // METER_SIZE
+        clients = self.by_console.get(console)
+        if not clients:
+            return
+        now = self.clock.seconds()
+        # Filtered frames by channels selection, clients often share one
+        filtered = {}
+        for client in clients:
+            if client.last_sent is not None and now - client.last_sent < client.interval:
+                client.decimated += 1
+                continue
+            if client.channels is None:
+                data = frame
+            else:
+                data = filtered.get(client.channels)
+                if data is None:
+                    data = filtered[client.channels] = filter_frame(frame, client.channels)
+            client.last_sent = now
+            client.frames += 1
+            client.bytes_sent += len(data)
+            self.transport.write(data, (client.host, client.port))
+
+    def stats(self):
+        """Counters.
+
+        :rtype: dict
+        """
+        return {
+            'frames_received': dict(self.frames_received),
+            'refused': self.refused,
+            'clients': dict(('%s:%d' % key, client.stats()) for key, client in self.clients.items()),
+        }
+
+
+class RelayProtocol(protocol.DatagramProtocol):
+    """Receives the clients subscriptions and sends them the frames."""
+
+    name = "SoundcraftRelay"
+    rejected = 0
+    """Invalid subscriptions"""
+    challenged = 0
+    """Requests answered with a nonce instead of being applied"""
+    _secret = None
+
+    def __init__(self, relay):
+        """Build the protocol.
+
+        :param relay: The relay
+        :type relay: MeterRelay
+        """
+        self.relay = relay
+        self._secret = os.urandom(16)
+
+    def nonce(self, host, port):
+        """Get the nonce of a client address.
+
+        :param host: Client IPv4 address
+        :type host: str
+        :param port: Client UDP port
+        :type port: int
+        :rtype: str
+        """
+        return hmac.new(self._secret, ('%s:%d' % (host, port)).encode('ascii'), hashlib.sha256).hexdigest()[:16]
+
+    def startProtocol(self):
+        """Called after protocol started listening."""
+        self.relay.transport = self.transport
+
+    def datagramReceived(self, data, addr):
+        """Called when a subscription is received.
+
+        :param data: JSON subscription
+        :type data: bytes
+        :param addr: IPv4 address and port of the client
+        :type addr: tuple
+        """
+        (host, port) = addr
+        try:
+            request = json.loads(data.decode('utf-8'))
+            console = request['console']
+        except (ValueError, KeyError, TypeError):
+            request = console = None
+        if not self.valid(request, console):
+            self.rejected += 1
+            print("Invalid relay subscription from %s:%d" % addr)
+            return
+        nonce = self.nonce(host, port)
+        if request.get('nonce') != nonce:
+            # Make sure the client is really there before sending it anything big
+            self.challenged += 1
+            self.transport.write(json.dumps({'nonce': nonce}).encode('utf-8'), addr)
+            return
+        if request.get('unsubscribe'):
+            self.relay.unsubscribe(host, port)
+            return
+        if self.relay.subscribe(host, port, console, request.get('rate'), request.get('channels')) is None:
+            print("Too many relay clients to subscribe %s:%d" % addr)
+
+    def valid(self, request, console):
+        """Check a subscription from a client.
+
+        :param request: Decoded JSON subscription
+        :type request: dict
+        :param console: Console IPv4 address
+        :type console: str
+        :rtype: bool
+        """
+        if not isinstance(request, dict) or not isinstance(console, basestring):
+            return False
+        rate = request.get('rate')
+        if rate is not None and (not isinstance(rate, numbers.Real) or isinstance(rate, bool) or not rate > 0):
+            return False
+        channels = request.get('channels')
+        if channels is not None:
+            if not isinstance(channels, list):
+                return False
+            meters = self.relay.meters.get(console, MAX_FRAME_METERS)
+            for channel in channels:
+                if not _integer(channel) or not 0 <= channel < meters:
+                    return False
+        return True
+
+
+def _integer(value):
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+
+def listen(relay, port=RELAY_PORT, reactor=None):
+    """Start relaying.
+
+    :param relay: The relay
+    :type relay: MeterRelay
+    :param port: UDP port for the clients subscriptions
+    :type port: int
+    :param reactor: Defaults to the global reactor
+    :type reactor: twisted.internet.interfaces.IReactorUDP
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    reactor.listenUDP(VUMETER_IP_PORT, VuMeterUDPPRotocol(relay))
+    reactor.listenUDP(port, RelayProtocol(relay))
+
+
+def main():
+    from twisted.internet import reactor
+    relay = MeterRelay()
+    relay.add_listener(lambda event, console: print("Console %s %s" % (console, event)))
+    listen(relay)
+    print("Relaying meters to clients subscribing on UDP port %d" % RELAY_PORT)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
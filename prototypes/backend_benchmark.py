@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# *- coding: utf-8 -*
+"""Prototype side by side benchmark of the Twisted and asyncio HiQnet backends.
+
+A local echo peer sends every command back. For each backend we measure:
+- Throughput: commands sent and received back per second, with a window of commands in flight
+- Receive latency: round trip time of a single command at a time
+
+Each backend runs in its own interpreter. Linux only: the echo peer listens on 127.0.0.2.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import json
+import os
+import subprocess
+import sys
+
+import hiqnet
+
+COMMANDS = 20000
+WINDOW = 64
+PINGS = 2000
+PEER = '127.0.0.2'
+
+
+class Driver(object):
+    """Runs the measures on top of any backend through its Connection and clock."""
+    udp_transport = None
+    tcp_transport = None
+    connection = None
+    clock = None
+
+    def __init__(self, clock, done):
+        self.clock = clock
+        self.done = done
+        self.results = {}
+        source = hiqnet.protocol.FullyQualifiedAddress(device_address=1)
+        destination = hiqnet.protocol.FullyQualifiedAddress(device_address=2)
+        command = hiqnet.protocol.Command(source=source, destination=destination)
+        command.locate_on(b'HiQontrolBench')
+        self.command = command
+        self.handler = None
+
+    # noinspection PyUnusedLocal
+    def handle_message(self, message, host, protocol_name):
+        self.handler()
+
+    def start(self, connection):
+        self.connection = connection
+        self.sent = self.received = 0
+        self.started = self.clock.seconds()
+        self.handler = self._throughput_reply
+        for _ in range(WINDOW):
+            self._send()
+
+    def _send(self):
+        self.sent += 1
+        self.connection.sendto(self.command, PEER)
+
+    def _throughput_reply(self):
+        self.received += 1
+        if self.sent < COMMANDS:
+            self._send()
+        elif self.received == COMMANDS:
+            self.results['commands/s'] = COMMANDS / (self.clock.seconds() - self.started)
+            self.latencies = []
+            self.handler = self._ping_reply
+            self._ping()
+
+    def _ping(self):
+        self.ping_sent = self.clock.seconds()
+        self.connection.sendto(self.command, PEER)
+
+    def _ping_reply(self):
+        self.latencies.append(self.clock.seconds() - self.ping_sent)
+        if len(self.latencies) < PINGS:
+            self._ping()
+            return
+        latencies = sorted(self.latencies)
+        self.results['latency median (us)'] = latencies[len(latencies) // 2] * 1e6
+        self.results['latency p99 (us)'] = latencies[int(len(latencies) * .99)] * 1e6
+        self.done(self.results)
+
+
+def run_twisted():
+    from twisted.internet import protocol, reactor
+
+    class Echo(protocol.DatagramProtocol):
+        def datagramReceived(self, data, addr):
+            self.transport.write(data, addr)
+
+    results = {}
+
+    def done(measures):
+        results.update(measures)
+        reactor.stop()
+
+    driver = Driver(reactor, done)
+    reactor.listenUDP(hiqnet.service.ip.PORT, Echo(), interface=PEER)
+    reactor.listenUDP(0, hiqnet.service.ip.UDPProtocol(driver), interface='127.0.0.1')
+    connection = hiqnet.service.ip.Connection(driver.udp_transport, None)
+    reactor.callWhenRunning(driver.start, connection)
+    reactor.run()
+    return results
+
+
+def run_asyncio():
+    try:
+        import hiqnet.service.aio as aio
+    except ImportError:
+        return None
+    loop = aio.asyncio.new_event_loop()
+    aio.asyncio.set_event_loop(loop)
+
+    class Echo(aio.asyncio.DatagramProtocol):
+        transport = None
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            self.transport.sendto(data, addr)
+
+    results = {}
+
+    def done(measures):
+        results.update(measures)
+        loop.stop()
+
+    clock = aio.Clock(loop)
+    driver = Driver(clock, done)
+    loop.run_until_complete(loop.create_datagram_endpoint(Echo, local_addr=(PEER, hiqnet.protocol.PORT)))
+    loop.run_until_complete(loop.create_datagram_endpoint(lambda: aio.UDPProtocol(driver, clock=clock),
+                                                          local_addr=('127.0.0.1', 0)))
+    connection = aio.Connection(driver.udp_transport)
+    loop.call_soon(driver.start, connection)
+    loop.run_forever()
+    return results
+
+
+BACKENDS = [
+    ('twisted', run_twisted),
+    ('asyncio', run_asyncio),
+]
+
+
+def main():
+    names = [name for name, _ in BACKENDS]
+    rows = []
+    for name in names:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), name],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        try:
+            rows.append((name, json.loads(out.decode('ascii').strip().splitlines()[-1])))
+        except (ValueError, IndexError):
+            rows.append((name, None))
+    print("%-16s %14s %20s %18s" % ("backend", "commands/s", "latency median (us)", "latency p99 (us)"))
+    for name, results in rows:
+        if not results:
+            print("%-16s %14s" % (name, "unavailable"))
+            continue
+        print("%-16s %14.0f %20.1f %18.1f" % (name, results['commands/s'], results['latency median (us)'],
+                                               results['latency p99 (us)']))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # Commands decoding and the Twisted protocols print debugging output
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        measures = dict(BACKENDS)[sys.argv[1]]()
+        sys.stdout = stdout
+        print(json.dumps(measures))
+    else:
+        main()
@@ -7,7 +7,7 @@ __author__ = 'Raphaël Doursenaud'
 import logging
 import socket
 
-import hiqnet
+import hiqnet.discovery
 
 from twisted.internet import reactor
 
@@ -63,7 +63,7 @@ if __name__ == '__main__':
     logger = init_logging()
     logger.info("RUN")
 
-    my_device_address = hiqnet.device.Device.negotiate_address()
+    my_device_address = hiqnet.device.negotiate_address()
     my_device = hiqnet.device.Device(MY_DEVICE_NAME, my_device_address)
 
     logger.debug(my_device.network_info.mac_address)
@@ -77,10 +77,7 @@ if __name__ == '__main__':
     c = hiqnet.service.ip.Connection(app.udp_transport, app.tcp_transport)
 
     source_address = my_device.get_address()
-    destination_address = hiqnet.protocol.FullyQualifiedAddress.broadcast_address()  # Broadcast
-    message = hiqnet.protocol.Command(source=source_address, destination=destination_address)
-    message.disco_info(device=my_device)
-    c.sendto(message)
+    hiqnet.discovery.DiscoveryScheduler(my_device, c).start()
 
     destination_address = hiqnet.protocol.FullyQualifiedAddress(device_address=SI_COMPACT_16_DEVICE_ADDRESS)
     message = hiqnet.protocol.Command(source=source_address, destination=destination_address)
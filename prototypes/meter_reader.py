@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# *- coding: utf-8 -*
+"""Prototype reader of the meters exported by HiQontrol into shared memory.
+
+Standalone on purpose: any local tool can follow the layout documented in soundcraft.meters.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import mmap
+import os
+import socket
+import struct
+import sys
+import time
+
+PATH = '/dev/shm/hiqontrol-meters'
+MAX_RETRIES = 10000
+HEADER = struct.Struct('<IId4sHHI4s')
+METERS_OFFSET = 32
+
+
+def read(buf):
+    """Read a consistent frame.
+
+    :return: Frame counter, console IPv4 address, levels and peaks. None if HiQontrol is stuck writing.
+    """
+    for _ in range(MAX_RETRIES):
+        sequence, length, stamp, magic, version, count, frame, console = HEADER.unpack_from(buf, 0)
+        if sequence & 1:
+            # Being written
+            continue
+        meters = struct.unpack_from('<%df' % (2 * count), buf, METERS_OFFSET)
+        if struct.unpack_from('<I', buf, 0)[0] == sequence:
+            return frame, socket.inet_ntoa(console), meters[0::2], meters[1::2]
+    return None
+
+
+def main(argv):
+    path = argv[1] if len(argv) > 1 else PATH
+    fd = os.open(path, os.O_RDONLY)
+    buf = mmap.mmap(fd, os.fstat(fd).st_size, access=mmap.ACCESS_READ)
+    os.close(fd)
+    if HEADER.unpack_from(buf, 0)[3] != b'HQMT':
+        print("Not a meters block: " + path)
+        return
+    last = None
+    while True:
+        result = read(buf)
+        if result is None:
+            print("No consistent frame, did HiQontrol die while writing?")
+            time.sleep(1)
+            continue
+        frame, console, levels, peaks = result
+        if frame != last:
+            last = frame
+            print("%s frame %d: " % (console, frame)
+                  + " ".join("%3d" % (level * 100) for level in levels[:16]))
+        # Any rate will do
+        time.sleep(0.1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
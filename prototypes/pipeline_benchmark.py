@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# *- coding: utf-8 -*
+"""Prototype measure of the UI frame times under a burst of incoming commands.
+
+A simulated 60 Hz main loop receives a burst of Multiple Parameter Set commands, like a full parameter sync:
+- inline: commands are decoded and handled as they arrive, as the reactor does inside the Kivy main loop
+- thread: commands are handed to the decode pipeline and handled in batches on each frame
+- processes: same with the large payloads decoded in a process pool
+
+The frame time is the main loop time spent on the commands during a frame.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import os
+import struct
+import sys
+import time
+
+import hiqnet.service.pipeline
+
+FRAME = 1 / 60.
+BURST = 5000
+BURST_DURATION = 0.5  # s
+PARAMETERS = 64
+"""Parameters by command"""
+
+
+class App(object):
+    handled = 0
+
+    # noinspection PyUnusedLocal
+    def handle_message(self, message, host, protocol_name):
+        self.handled += 1
+
+
+def burst():
+    """One command per object, the inbound queues would coalesce the notifications of a same object."""
+    destination = hiqnet.protocol.FullyQualifiedAddress(device_address=2)
+    commands = []
+    for index in range(BURST):
+        source = hiqnet.protocol.FullyQualifiedAddress(device_address=1, object_address=struct.pack('!L', index)[1:])
+        command = hiqnet.protocol.Command(source=source, destination=destination)
+        command.multi_param_set([(parameter_id, hiqnet.datatypes.LONG, parameter_id)
+                                 for parameter_id in range(PARAMETERS)])
+        commands.append(bytes(command))
+    return commands
+
+
+def run(mode):
+    app = App()
+    pipeline = None
+    if mode != 'inline':
+        pipeline = hiqnet.service.pipeline.DecodePipeline(app, processes=2 if mode == 'processes' else 0,
+                                                           process_threshold=256)
+        pipeline.start()
+    commands = burst()
+    frames = []
+    received = 0
+    started = time.time()
+    while app.handled < BURST:
+        frame_start = time.time()
+        # Commands arrived since the last frame
+        arrived = min(BURST, int((frame_start - started) / BURST_DURATION * BURST))
+        while received < arrived:
+            data = commands[received]
+            received += 1
+            if pipeline is None:
+                app.handle_message(hiqnet.protocol.Command(command=data), '127.0.0.1', 'HiQnetUDP')
+            else:
+                pipeline.submit(data, '127.0.0.1', 'HiQnetUDP')
+        if pipeline is not None:
+            pipeline.drain()
+        frame_end = time.time()
+        frames.append(frame_end - frame_start)
+        time.sleep(max(0, FRAME - (frame_end - frame_start)))
+    total = time.time() - started
+    if pipeline is not None:
+        pipeline.stop()
+    return frames, total
+
+
+def main():
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        size = len(burst()[0])
+    finally:
+        sys.stdout = stdout
+    print("%d commands of %d bytes in %.1f s" % (BURST, size, BURST_DURATION))
+    print("%-10s %8s %14s %14s %14s %12s" % ("mode", "frames", "median (ms)", "p99 (ms)", "max (ms)", "done (s)"))
+    for mode in ('inline', 'thread', 'processes'):
+        # Commands decoding prints debugging output
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            frames, total = run(mode)
+        finally:
+            sys.stdout = stdout
+        frames.sort()
+        print("%-10s %8d %14.2f %14.2f %14.2f %12.2f"
+              % (mode, len(frames), frames[len(frames) // 2] * 1000, frames[int(len(frames) * .99)] * 1000,
+                 frames[-1] * 1000, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# *- coding: utf-8 -*
+"""Prototype benchmark of the read-cache proxy against a simulated console.
+
+A control surface keeps WINDOW MULTPARMGET queries in flight for DURATION seconds:
+- direct: to the simulated console, which takes SERVICE_TIME per query like an embedded CPU would
+- proxy: to the proxy, which answers from its mirror once the first query filled it
+
+Linux only: the console listens on 127.0.0.2, the proxy on 127.0.0.3 and the surface on 127.0.0.1.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import os
+import sys
+
+import hiqnet.proxy
+import hiqnet.subscription
+
+from twisted.internet import defer, protocol, reactor, task
+
+CONSOLE_IP = '127.0.0.2'
+PROXY_IP = '127.0.0.3'
+SURFACE_IP = '127.0.0.1'
+CONSOLE_ADDRESS = 1619
+PROXY_ADDRESS = 2
+SURFACE_ADDRESS = 3
+PARAMETERS = list(range(1, 17))
+WINDOW = 32
+DURATION = 2.0  # s
+SERVICE_TIME = 0.001  # s
+
+OBJECT = hiqnet.protocol.FullyQualifiedAddress(device_address=CONSOLE_ADDRESS, vd_address=b'\x03',
+                                               object_address=b'\x00\x00\x01')
+
+
+class Console(protocol.DatagramProtocol):
+    """A simulated console answering queries one at a time."""
+    busy_until = 0.0
+    queries = 0
+
+    def datagramReceived(self, data, addr):
+        query = hiqnet.protocol.Command(command=data)
+        if query.message.name != 'MULTPARMGET' or query.flags.info:
+            # Subscriptions are accepted silently
+            return
+        self.queries += 1
+        now = reactor.seconds()
+        self.busy_until = max(now, self.busy_until) + SERVICE_TIME
+        reply = hiqnet.protocol.Command(source=query.destination_address, destination=query.source_address)
+        reply.multi_param_get_reply([(parameter_id, hiqnet.datatypes.LONG, parameter_id)
+                                     for parameter_id in query.requested_ids])
+        reactor.callLater(self.busy_until - now, self.transport.write, bytes(reply),
+                          (addr[0], hiqnet.service.ip.PORT))
+
+
+class Proxy(object):
+    """Routes the commands to the proxy then to the subscriptions."""
+    udp_transport = None
+    tcp_transport = None
+    proxy = None
+
+    # noinspection PyUnusedLocal
+    def handle_message(self, message, host, protocol_name):
+        if not self.proxy.handle_command(message, host):
+            self.proxy.subscriptions.handle_command(message)
+
+
+class Surface(object):
+    """Keeps WINDOW queries in flight and counts the replies."""
+    udp_transport = None
+    tcp_transport = None
+    connection = None
+    target = None
+    replies = 0
+    counting = False
+
+    # noinspection PyUnusedLocal
+    def handle_message(self, message, host, protocol_name):
+        if message.message.name == 'MULTPARMGET' and message.flags.info:
+            if self.counting:
+                self.replies += 1
+            self.query()
+
+    def query(self):
+        command = hiqnet.protocol.Command(source=hiqnet.protocol.FullyQualifiedAddress(device_address=SURFACE_ADDRESS),
+                                          destination=OBJECT)
+        command.multi_param_get(PARAMETERS)
+        self.connection.sendto(command, self.target)
+
+
+@defer.inlineCallbacks
+def measure(surface, target):
+    surface.target = target
+    # Warm up, filling the proxy mirror
+    surface.counting = False
+    surface.query()
+    yield task.deferLater(reactor, 0.2, lambda: None)
+    surface.replies = 0
+    surface.counting = True
+    for _ in range(WINDOW - 1):
+        surface.query()
+    yield task.deferLater(reactor, DURATION, lambda: None)
+    surface.counting = False
+    defer.returnValue(surface.replies / DURATION)
+
+
+@defer.inlineCallbacks
+def main():
+    console = Console()
+    reactor.listenUDP(hiqnet.service.ip.PORT, console, interface=CONSOLE_IP)
+
+    proxy_app = Proxy()
+    reactor.listenUDP(hiqnet.service.ip.PORT, hiqnet.service.ip.UDPProtocol(proxy_app), interface=PROXY_IP)
+    network_info = hiqnet.networkinfo.IPNetworkInfo('02:00:00:00:00:03', False, PROXY_IP, '255.0.0.0')
+    device = hiqnet.device.Device('Proxy', PROXY_ADDRESS, network_info)
+    connection = hiqnet.service.ip.Connection(proxy_app.udp_transport, None)
+    subscriptions = hiqnet.subscription.SubscriptionManager(device, connection)
+    proxy_app.proxy = hiqnet.proxy.ReadCacheProxy(device, connection, CONSOLE_IP, CONSOLE_ADDRESS, subscriptions)
+
+    surface = Surface()
+    reactor.listenUDP(hiqnet.service.ip.PORT, hiqnet.service.ip.UDPProtocol(surface), interface=SURFACE_IP)
+    surface.connection = hiqnet.service.ip.Connection(surface.udp_transport, None)
+
+    # Commands decoding prints debugging output
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        direct = yield measure(surface, CONSOLE_IP)
+        # Let the direct queries still in flight drain
+        yield task.deferLater(reactor, WINDOW * SERVICE_TIME * 2, lambda: None)
+        queries = console.queries
+        proxied = yield measure(surface, PROXY_IP)
+        proxied_queries = console.queries - queries
+    finally:
+        sys.stdout = stdout
+        reactor.stop()
+    print("%d parameters per query, %d in flight, console service time %.1f ms"
+          % (len(PARAMETERS), WINDOW, SERVICE_TIME * 1000))
+    print("direct: %8.0f queries/s" % direct)
+    print("proxy:  %8.0f queries/s, %d queries reached the console, %s"
+          % (proxied, proxied_queries, proxy_app.proxy.stats()))
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# *- coding: utf-8 -*
+"""Prototype benchmark of the startup time.
+
+Each measure runs in a fresh interpreter so imports are not cached:
+- import hiqnet
+- network information autodetection, first and cached call
+- local device construction
+- app module import and construction, when Kivy is available
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import json
+import os
+import subprocess
+import sys
+
+RUNS = 5
+
+HIQONTROL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'hiqontrol')
+
+HIQNET = """
+import json, time
+start = time.time()
+import hiqnet
+imported = time.time()
+hiqnet.networkinfo.IPNetworkInfo.autodetect()
+detected = time.time()
+hiqnet.networkinfo.IPNetworkInfo.autodetect()
+cached = time.time()
+hiqnet.device.Device('Benchmark')
+built = time.time()
+print(json.dumps([
+    ['import hiqnet', imported - start],
+    ['autodetect', detected - imported],
+    ['autodetect (cached)', cached - detected],
+    ['Device()', built - cached],
+]))
+"""
+
+APP = """
+import json, os, time
+os.environ['KIVY_NO_ARGS'] = '1'
+os.environ['KIVY_NO_CONSOLELOG'] = '1'
+start = time.time()
+import main
+imported = time.time()
+main.HiQontrolApp()
+built = time.time()
+print(json.dumps([
+    ['import main', imported - start],
+    ['HiQontrolApp()', built - imported],
+]))
+"""
+
+
+def measure(script):
+    """Run a script in a fresh interpreter.
+
+    :return: Timings as (name, seconds) pairs or None if the script failed
+    :rtype: list
+    """
+    process = subprocess.Popen([sys.executable, '-c', script], cwd=HIQONTROL_PATH,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               env=dict(os.environ, PYTHONPATH=os.pathsep.join(
+                                   [HIQONTROL_PATH] + os.environ.get('PYTHONPATH', '').split(os.pathsep))))
+    out, err = process.communicate()
+    if process.returncode:
+        return None
+    return json.loads(out.decode('ascii').strip().splitlines()[-1])
+
+
+def report(name, script):
+    runs = [measure(script) for _ in range(RUNS)]
+    if None in runs:
+        print("%s: failed, missing dependencies?" % name)
+        return
+    for index, (key, _) in enumerate(runs[0]):
+        timings = sorted(run[index][1] for run in runs)
+        print("%-24s median %8.2f ms  min %8.2f ms  max %8.2f ms"
+              % (key, timings[len(timings) // 2] * 1000, timings[0] * 1000, timings[-1] * 1000))
+
+
+if __name__ == '__main__':
+    report("hiqnet", HIQNET)
+    report("app", APP)
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# *- coding: utf-8 -*
+"""Prototype unicast sweep of a /22 against simulated HiQnet devices on the loopback network.
+
+One in RESPONDER_EVERY addresses of the range answers DISCOINFO queries. Linux only:
+the whole 127.0.0.0/8 network is routed to the loopback interface.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import os
+import sys
+
+import hiqnet.discovery
+import hiqnet.sweep
+
+from twisted.internet import defer, protocol, reactor
+
+RANGE = '127.0.4.0/22'
+RESPONDER_EVERY = 8
+TIMEOUT = 0.2  # s
+
+
+class Responder(protocol.DatagramProtocol):
+    """A simulated device answering DISCOINFO queries."""
+
+    def __init__(self, device):
+        self.device = device
+
+    def datagramReceived(self, data, addr):
+        query = hiqnet.protocol.Command(command=data)
+        reply = hiqnet.protocol.Command(source=self.device.address, destination=query.source_address)
+        reply.disco_info(self.device, 'I')
+        self.transport.write(bytes(reply), addr)
+
+
+class App(object):
+    """Routes the replies to the sweep and the registry."""
+    udp_transport = None
+    tcp_transport = None
+    sweep = None
+    registry = None
+
+    # noinspection PyUnusedLocal
+    def handle_message(self, message, host, protocol_name):
+        if not self.sweep.handle_command(message, host):
+            self.registry.handle_command(message, host)
+
+
+@defer.inlineCallbacks
+def main():
+    listeners = []
+    for index, host in enumerate(hiqnet.sweep.hosts(RANGE)):
+        if index % RESPONDER_EVERY:
+            continue
+        network_info = hiqnet.protocol.IPNetworkInfo('02:00:00:00:%02x:%02x' % divmod(index, 256), False,
+                                                     host, '255.255.252.0')
+        device = hiqnet.device.Device('Sim', 1000 + index, network_info)
+        device.manager.serial_number = 'SIM%05d' % index
+        listeners.append(reactor.listenUDP(hiqnet.service.ip.PORT, Responder(device), interface=host))
+    app = App()
+    listeners.append(reactor.listenUDP(0, hiqnet.service.ip.UDPProtocol(app), interface='127.0.0.1'))
+    connection = hiqnet.service.ip.Connection(app.udp_transport, None)
+    local = hiqnet.device.Device('Sweeper', 1)
+    app.registry = hiqnet.discovery.DiscoveryRegistry()
+    app.sweep = hiqnet.sweep.Sweep(local, connection, app.registry, timeout=TIMEOUT)
+    # Commands decoding prints debugging output
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        found = yield app.sweep.sweep([RANGE])
+    finally:
+        sys.stdout = stdout
+        for listener in listeners:
+            listener.stopListening()
+        reactor.stop()
+    sweep = app.sweep
+    print("%s: %d probes, %d answers, %d timeouts, %d devices registered in %.3f s (%d responders, window %d)"
+          % (RANGE, sweep.sent, sweep.answered, sweep.timeouts, len(app.registry), sweep.elapsed,
+             len(listeners) - 1, sweep.window))
+    assert len(found) == len(app.registry) == len(listeners) - 1
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# *- coding: utf-8 -*
+"""Prototype benchmark of the HiQnet TCP connections pool against a local echo peer.
+
+Compares a connection per command with pooled connections, sequential and pipelined.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Raphaël Doursenaud'
+
+import os
+import sys
+import time
+
+import hiqnet.service.pool
+
+from twisted.internet import defer, protocol, reactor
+
+COMMANDS = 2000
+
+
+class Echo(protocol.Protocol):
+    """Sends everything back."""
+
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+class App(object):
+    """Counts replies."""
+    waiting = None
+
+    def __init__(self):
+        self.waiting = []
+
+    def expect(self, count):
+        d = defer.Deferred()
+        self.waiting.append([count, d])
+        return d
+
+    # noinspection PyUnusedLocal
+    def handle_message(self, message, host, protocol_name):
+        entry = self.waiting[0]
+        entry[0] -= 1
+        if not entry[0]:
+            self.waiting.pop(0)
+            entry[1].callback(None)
+
+
+def build_command():
+    source = hiqnet.protocol.FullyQualifiedAddress(device_address=1)
+    destination = hiqnet.protocol.FullyQualifiedAddress(device_address=2)
+    command = hiqnet.protocol.Command(source=source, destination=destination)
+    command.flags.guaranteed = 1
+    command.locate_on(b'HiQontrolBench')
+    return bytes(command)
+
+
+@defer.inlineCallbacks
+def connection_per_command(app, port, data, count):
+    start = time.time()
+    for _ in range(count):
+        pool = hiqnet.service.pool.TCPConnectionPool(app, port=port)
+        d = app.expect(1)
+        pool.write(data, '127.0.0.1')
+        yield d
+        pool.close()
+    defer.returnValue(time.time() - start)
+
+
+@defer.inlineCallbacks
+def pooled_sequential(app, pool, data, count):
+    start = time.time()
+    for _ in range(count):
+        d = app.expect(1)
+        pool.write(data, '127.0.0.1')
+        yield d
+    defer.returnValue(time.time() - start)
+
+
+@defer.inlineCallbacks
+def pooled_pipelined(app, pool, data, count):
+    start = time.time()
+    d = app.expect(count)
+    for _ in range(count):
+        pool.write(data, '127.0.0.1')
+    yield d
+    defer.returnValue(time.time() - start)
+
+
+def report(name, count, elapsed):
+    print("%-24s %6d commands %8.3f s %10.1f commands/s %8.3f ms/command"
+          % (name, count, elapsed, count / elapsed, elapsed * 1000 / count), file=sys.stderr)
+
+
+@defer.inlineCallbacks
+def main():
+    listener = reactor.listenTCP(0, protocol.Factory.forProtocol(Echo), interface='127.0.0.1')
+    port = listener.getHost().port
+    app = App()
+    data = build_command()
+    # Commands decoding prints debugging output
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        report("Connection per command", COMMANDS // 10,
+               (yield connection_per_command(app, port, data, COMMANDS // 10)))
+        pool = hiqnet.service.pool.TCPConnectionPool(app, port=port)
+        # Warm up
+        yield pooled_sequential(app, pool, data, 1)
+        report("Pooled sequential", COMMANDS, (yield pooled_sequential(app, pool, data, COMMANDS)))
+        report("Pooled pipelined", COMMANDS, (yield pooled_pipelined(app, pool, data, COMMANDS)))
+        pool.close()
+    finally:
+        sys.stdout = stdout
+        listener.stopListening()
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()